@@ -0,0 +1,313 @@
+# A local stand-in for the Pushshift search API that serves synthetic pages.
+#
+# Posts are generated from their position in a fixed timeline, so every
+# request is answered the same way and pages can be fetched in any order.
+# Latency, throttling, server errors, timed out searches and failed shards
+# can be injected to see how the crawler copes with them.
+#
+# Run on its own to point the scraper at it with [pushshift] base_url:
+#   python benchmarks/fake_pushshift.py --port 8080
+
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Number of distinct post texts
+TEXTS = 1024
+
+# Words for post text, including characters that have to be escaped in JSON
+WORDS = ('the a to of and in is it that for you was on with this I but be are have not they at as so like '
+         'just what can if about people would one all my there more do your get think from or when out '
+         'Reddit subreddit comment post thread upvote moderator karma edit: "quoted" café naïve ☃ \U0001F600 '
+         'tab\there back\\slash\nnewline 42 2020 https://example.com/r/AskReddit').split(' ')
+
+
+class Timeline:
+    """Synthetic posts, newest first. Post i was created at
+    end - floor(i / posts_per_second), so several posts can share a second."""
+
+    def __init__(self, end:int=1600000000, posts:int=1000000, posts_per_second:float=2.0, record_bytes:int=1000) -> None:
+        self.end = end
+        self.posts = posts
+        self.posts_per_second = posts_per_second
+        self.record_bytes = record_bytes
+        self.start = self.created_utc(posts - 1)
+
+        # Post text is drawn from a pool of random word sequences, so posts
+        # compress like real text without generating text for every post
+        length = max(0, record_bytes - len(json.dumps(self.fields(0, ('AskReddit',)))) - 12)
+        rng = random.Random(0)
+        self.texts = [self._text(rng, length) for _ in range(TEXTS)]
+
+    def created_utc(self, i:int) -> int:
+        return self.end - self._seconds_back(i)
+
+    def first_before(self, before:int) -> int:
+        """Index of the newest post with created_utc < before"""
+        return self._first_index(self.end - before + 1)
+
+    def first_not_after(self, after:int) -> int:
+        """Index of the newest post with created_utc <= after"""
+        return min(self.posts, self._first_index(self.end - after))
+
+    def _seconds_back(self, i:int) -> int:
+        # The epsilon keeps e.g. 1999 / 0.05 from flooring to 39979
+        return math.floor(i / self.posts_per_second + 1e-9)
+
+    def _first_index(self, seconds:int) -> int:
+        """Index of the newest post created at least seconds before end"""
+        if seconds <= 0:
+            return 0
+        # Estimate, then step to the exact bound so it agrees with created_utc
+        i = max(0, math.ceil(seconds * self.posts_per_second) - 1)
+        while i > 0 and self._seconds_back(i - 1) >= seconds:
+            i -= 1
+        while self._seconds_back(i) < seconds:
+            i += 1
+        return i
+
+    def search(self, before:int=None, after:int=None, size:int=100, sort:str='desc') -> tuple:
+        """Indexes of the posts on the page and the number of posts that match"""
+        lo = 0 if before is None else self.first_before(before)
+        hi = self.posts if after is None else self.first_not_after(after)
+        lo = min(lo, self.posts)
+        total = max(0, hi - lo)
+        if sort == 'asc':
+            return list(range(hi - 1, max(lo, hi - size) - 1, -1)), total
+        return list(range(lo, min(hi, lo + size))), total
+
+    def fields(self, i:int, subreddits:tuple) -> dict:
+        id = self.posts - i + 36 ** 5
+        return {
+            'author': f'user_{id % 997}',
+            'created_utc': self.created_utc(i),
+            'id': base36(id),
+            'permalink': f'/r/{subreddits[i % len(subreddits)]}/comments/{base36(id)}/',
+            'retrieved_on': self.end + 3600,
+            'score': id % 113,
+            'subreddit': subreddits[i % len(subreddits)],
+            'subreddit_id': f't5_{base36(id % 1000)}',
+        }
+
+    def post(self, endpoint:str, i:int, subreddits:tuple) -> dict:
+        post = self.fields(i, subreddits)
+        post['body' if endpoint == 'comment' else 'selftext'] = self.texts[i % TEXTS]
+        return dict(sorted(post.items()))
+
+    def _text(self, rng:random.Random, length:int) -> str:
+        words = []
+        while length > 0:
+            word = rng.choice(WORDS)
+            words.append(word)
+            length -= len(json.dumps(word)) - 1
+        return ' '.join(words)
+
+
+def base36(n:int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    s = ''
+    while n:
+        n, r = divmod(n, 36)
+        s = digits[r] + s
+    return s or '0'
+
+
+class FakePushshift(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address:tuple, timeline:Timeline, latency:float=0.0, jitter:float=0.0, error_rate:float=0.0, error_statuses:list=None, timed_out_rate:float=0.0, failed_shard_rate:float=0.0, stall_rate:float=0.0, stall:float=10.0, scan_latency:float=0.0, scan_limit:int=0, indent:int=4, seed:int=0) -> None:
+        super().__init__(address, Handler)
+        self.timeline = timeline
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses or [429, 500, 502, 503, 504]
+        self.timed_out_rate = timed_out_rate
+        self.failed_shard_rate = failed_shard_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.scan_latency = scan_latency
+        self.scan_limit = scan_limit
+        self.indent = indent
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # Track stats
+        self.requests = 0
+        self.errors = 0
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out or hedged close the connection before the reply is sent
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def draw(self) -> tuple:
+        """Decide the latency and faults of a request"""
+        with self.lock:
+            self.requests += 1
+            latency = max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            if self.random.random() < self.stall_rate:
+                latency += self.stall
+            error = self.random.choice(self.error_statuses) if self.random.random() < self.error_rate else None
+            timed_out = self.random.random() < self.timed_out_rate
+            failed_shards = self.random.random() < self.failed_shard_rate
+            if error is not None:
+                self.errors += 1
+        return latency, error, timed_out, failed_shards
+
+    @lru_cache(maxsize=100000)
+    def render_post(self, endpoint:str, i:int, subreddits:tuple, fields:tuple=None) -> bytes:
+        """A post as it appears in the data array of the response, with only the given fields"""
+        post = self.timeline.post(endpoint, i, subreddits)
+        if fields is not None:
+            post = {key: value for key, value in post.items() if key in fields}
+        if not self.indent:
+            return json.dumps(post).encode('utf-8')
+        pad = ' ' * (self.indent * 2)
+        return (pad + json.dumps(post, indent=self.indent).replace('\n', '\n' + pad)).encode('utf-8')
+
+    def render_page(self, endpoint:str, indexes:list, subreddits:tuple, metadata:dict, fields:tuple=None) -> bytes:
+        """A response body laid out the way json.dumps would, but from cached posts"""
+        posts = [self.render_post(endpoint, i, subreddits, fields) for i in indexes]
+        if not self.indent:
+            return b'{"data": [' + b', '.join(posts) + b'], "metadata": ' + json.dumps(metadata).encode('utf-8') + b'}'
+
+        pad = b' ' * self.indent
+        data = b'[]' if not posts else b'[\n' + b',\n'.join(posts) + b'\n' + pad + b']'
+        metadata = json.dumps(metadata, indent=self.indent).replace('\n', '\n' + ' ' * self.indent).encode('utf-8')
+        return b'{\n' + pad + b'"data": ' + data + b',\n' + pad + b'"metadata": ' + metadata + b'\n}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'reddit' or parts[1] not in ('submission', 'comment') or parts[2] != 'search':
+            return self.reply(404, b'{"detail": "Not Found"}')
+        endpoint = parts[1]
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        latency, error, timed_out, failed_shards = server.draw()
+        if latency:
+            time.sleep(latency)
+        if error is not None:
+            headers = {'Retry-After': '0'} if error == 429 else {}
+            return self.reply(error, b'{"detail": "Injected error"}', headers)
+
+        started = time.monotonic()
+        before = int(query['before']) if 'before' in query else None
+        after = int(query['after']) if 'after' in query else None
+        size = int(query.get('size', 25))
+        sort = query.get('sort', 'desc')
+        subreddits = tuple(query.get('subreddit', 'all').split(','))
+        fields = tuple(sorted(query['fields'].split(','))) if 'fields' in query else None
+        indexes, total = server.timeline.search(before, after, size, sort)
+
+        # Like Elasticsearch, searches that match more posts take longer, and
+        # time out with only part of the page if they match too many
+        if server.scan_latency:
+            time.sleep(server.scan_latency * total / 1000000)
+        if server.scan_limit and total > server.scan_limit:
+            timed_out = True
+            indexes = indexes[:len(indexes) // 2]
+
+        metadata = {
+            'after': after,
+            'agg_size': 100,
+            'api_version': '3.0',
+            'before': before,
+            'execution_time_milliseconds': 0.0,
+            'frequency': 'second',
+            'index': endpoint,
+            'metadata': 'true',
+            'ranges': [],
+            'results_returned': len(indexes),
+            'shards': {'failed': 1 if failed_shards else 0, 'skipped': 0, 'successful': 3 if failed_shards else 4, 'total': 4},
+            'size': size,
+            'sort': sort,
+            'sort_type': query.get('sort_type', 'created_utc'),
+            'subreddit': list(subreddits),
+            'timed_out': timed_out,
+            'total_results': total
+        }
+        metadata['execution_time_milliseconds'] = round((time.monotonic() - started) * 1000, 2)
+        self.reply(200, server.render_page(endpoint, indexes, subreddits, metadata, fields))
+
+    def reply(self, status:int, body:bytes, headers:dict=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_arguments(parser:argparse.ArgumentParser):
+    """Server options, shared with the benchmark runner"""
+    parser.add_argument('--end', type=int, default=1600000000, help='created_utc of the newest post.')
+    parser.add_argument('--posts', type=int, default=1000000, help='Number of posts in the timeline.')
+    parser.add_argument('--posts_per_second', type=float, default=2.0, help='Posts created each second.')
+    parser.add_argument('--record_bytes', type=int, default=1000, help='Approximate size of each post in bytes.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each request.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the latency in seconds.')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests answered with an error status.')
+    parser.add_argument('--error_statuses', default='429,500,502,503,504', help='Comma separated error statuses to inject.')
+    parser.add_argument('--timed_out_rate', type=float, default=0.0, help='Fraction of pages with timed_out set.')
+    parser.add_argument('--failed_shard_rate', type=float, default=0.0, help='Fraction of pages with a failed shard.')
+    parser.add_argument('--stall_rate', type=float, default=0.0, help='Fraction of requests that stall, like a stuck shard.')
+    parser.add_argument('--stall', type=float, default=10.0, help='Extra seconds a stalled request takes.')
+    parser.add_argument('--scan_latency', type=float, default=0.0, help='Extra seconds per million posts a search matches.')
+    parser.add_argument('--scan_limit', type=int, default=0, help='Searches matching more posts than this time out. 0 for no limit.')
+    parser.add_argument('--indent', type=int, default=4, help='Indent of the response body like Pushshift. 0 for compact JSON.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for injected latency and faults.')
+
+
+def create_server(args, host:str='127.0.0.1', port:int=0) -> FakePushshift:
+    timeline = Timeline(end=args.end, posts=args.posts, posts_per_second=args.posts_per_second, record_bytes=args.record_bytes)
+    return FakePushshift(
+        (host, port),
+        timeline,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_statuses=[int(status) for status in args.error_statuses.split(',')],
+        timed_out_rate=args.timed_out_rate,
+        failed_shard_rate=args.failed_shard_rate,
+        stall_rate=args.stall_rate,
+        stall=args.stall,
+        scan_latency=args.scan_latency,
+        scan_limit=args.scan_limit,
+        indent=args.indent,
+        seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve synthetic Pushshift pages')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=0, help='Port to listen on. 0 picks a free port.')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = create_server(args, host=args.host, port=args.port)
+
+    # The runner reads the address from the first line
+    print(f'http://{server.server_address[0]}:{server.server_address[1]}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
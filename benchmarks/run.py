@@ -0,0 +1,334 @@
+# Benchmark the scraper end to end without touching the network or AWS.
+#
+# Starts the fake Pushshift server in a separate process, then crawls it with
+# PushshiftAPI, MetadataLog and the crawl loop used by the scraper, sending
+# posts to Firehose with stub boto3 clients. Prints the results as JSON and
+# appends them to --output so runs can be compared between commits:
+#
+#   python benchmarks/run.py --pages 500 --output results.jsonl
+#   python benchmarks/run.py --pages 500 --passthrough --compare results.jsonl
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import fake_pushshift
+from stubs import FakeFirehoseClient, FakeLogsClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'pushshift_scraper'))
+
+from utils.cloudwatch import CloudWatchLog
+from utils.crawler import Crawler
+from utils.firehose import Firehose
+from utils.local_logs import MetadataLog
+from utils.local_sink import LocalSink, SINKS
+from utils.memory_budget import MemoryBudget
+from utils.metrics import Metrics
+from utils.pipeline import Pipeline
+from utils.process_pool import DecodePool
+from utils.pushshift_api import PushshiftAPI
+from utils.rate_limiter import AdaptiveRateLimiter
+from utils.query_window import WindowPlanner
+from utils.record_filter import RecordFilter
+from utils.response_cache import ResponseCache, CACHE_MODES
+from utils.serialization import SERIALIZERS, COMPRESSIONS
+from utils.sharding import ShardedCrawler
+
+# Results compared with --compare. Higher is better unless listed in LOWER_IS_BETTER.
+COMPARED_METRICS = ['pages_per_s', 'records_per_s', 'bytes_received_per_s', 'latency_p50_ms', 'latency_p99_ms', 'peak_rss_mb']
+LOWER_IS_BETTER = {'latency_p50_ms', 'latency_p99_ms', 'peak_rss_mb'}
+
+# Options passed on to the fake Pushshift server
+_server_parser = argparse.ArgumentParser(add_help=False)
+fake_pushshift.add_arguments(_server_parser)
+SERVER_OPTIONS = [action.dest for action in _server_parser._actions]
+
+
+class TimedPushshiftAPI(PushshiftAPI):
+    """Records the latency and size of every page, including retries and parsing"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self.records = 0
+        self.bytes_received = 0
+
+    def _get(self, endpoint:str, params:dict):
+        start = time.perf_counter()
+        try:
+            result = super()._get(endpoint, params)
+        finally:
+            with self.lock:
+                self.latencies.append(time.perf_counter() - start)
+        with self.lock:
+            self.records += len(result.data)
+            self.bytes_received += result.bytes_received
+        return result
+
+
+def percentile(values:list, p:float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def start_server(args) -> tuple:
+    """Start the fake Pushshift server in another process so it doesn't compete for the GIL"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_pushshift.py')]
+    for name in SERVER_OPTIONS:
+        command += [f'--{name}', str(getattr(args, name))]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    base_url = server.stdout.readline().strip()
+    if not base_url:
+        server.kill()
+        raise Exception('Fake Pushshift server failed to start')
+    return server, base_url
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def run(args, base_url:str, directory:str) -> dict:
+    logs_client = FakeLogsClient()
+    firehose_client = FakeFirehoseClient(latency=args.firehose_latency, failure_rate=args.firehose_failure_rate, seed=args.seed)
+
+    cloudwatch = CloudWatchLog(log_group='benchmark', log_stream='benchmark', flush_interval=1.0, client=logs_client)
+    metrics = Metrics(cloudwatch_logger=cloudwatch, destination='none')
+    record_filter = RecordFilter(fields=args.fields, exclude_fields=args.exclude_fields, drop_removed=args.drop_removed, min_score=args.min_score)
+    decode_pool = None
+    sink_filter = record_filter
+    if args.processes > 0:
+        decode_pool = DecodePool(workers=args.processes, serializer=args.serializer, record_filter=record_filter, metrics=metrics)
+        sink_filter = None
+    if args.sink == 'local':
+        sink = LocalSink(
+            cloudwatch_logger=cloudwatch,
+            directory=os.path.join(directory, 'output'),
+            prefix=args.post_type,
+            serializer=args.serializer,
+            compression=args.compression,
+            metrics=metrics,
+            record_filter=sink_filter)
+    else:
+        sink = Firehose(
+            cloudwatch_logger=cloudwatch,
+            delivery_stream='benchmark',
+            buffered=args.buffered,
+            base_backoff=0.001,
+            serializer=args.serializer,
+            compression=args.compression,
+            client=firehose_client,
+            metrics=metrics,
+            record_filter=sink_filter)
+    metadata_log = MetadataLog(
+        cloudwatch_logger=cloudwatch,
+        filename=os.path.join(directory, 'metadata.log'),
+        filter_subreddits=args.subreddits,
+        post_type=args.post_type,
+        history=not args.no_history,
+        metrics=metrics)
+
+    cache = None
+    if args.cache is not None:
+        cache = ResponseCache(cloudwatch_logger=cloudwatch, directory=args.cache, mode=args.cache_mode)
+
+    # Don't let the rate limit cap throughput, but keep it in the loop
+    rate = args.requests_per_second
+    rate_limiter = AdaptiveRateLimiter(rate=rate, min_rate=rate / 100, max_rate=rate, burst=max(1.0, rate / 10), metrics=metrics)
+    api = TimedPushshiftAPI(
+        cloudwatch_logger=cloudwatch,
+        pool_maxsize=max(args.workers, 10),
+        rate_limiter=rate_limiter,
+        passthrough=args.passthrough,
+        base_url=base_url,
+        metrics=metrics,
+        cache=cache,
+        fields=record_filter.api_fields(),
+        read_timeout=args.read_timeout,
+        hedge_percentile=args.hedge_percentile,
+        memory_budget=MemoryBudget(args.memory_budget) if args.memory_budget is not None else None,
+        decode_pool=decode_pool,
+        window_planner=WindowPlanner(target_results=args.window_target_results) if args.window_target_results is not None else None)
+
+    # Crawl the whole timeline unless --pages stops it first
+    before = args.end + 1
+    after = args.end - int(args.posts / args.posts_per_second) - 1
+    started = time.perf_counter()
+    if args.mode == 'sequential':
+        crawler = Crawler(api=api, firehose=sink, metadata_log=metadata_log, cloudwatch_logger=cloudwatch)
+        crawler.run(post_type=args.post_type, subreddits=args.subreddits, before=before, after=after, size=args.size, max_requests=args.pages)
+    elif args.mode == 'pipeline':
+        pipeline = Pipeline(api=api, firehose=sink, metadata_log=metadata_log, cloudwatch_logger=cloudwatch, queue_size=args.queue_size)
+        pipeline.run(post_type=args.post_type, subreddits=args.subreddits, before=before, after=after, size=args.size, max_requests=args.pages)
+    elif args.mode == 'sharded':
+        crawler = ShardedCrawler(
+            api=api, firehose=sink, metadata_log=metadata_log, cloudwatch_logger=cloudwatch,
+            checkpoint_filename=os.path.join(directory, 'shards.json'), num_workers=args.workers, min_shard_seconds=1)
+        crawler.run(post_type=args.post_type, subreddits=args.subreddits, before=before, after=after, size=args.size, num_shards=args.workers, max_requests=args.pages)
+    sink.close()
+    elapsed = time.perf_counter() - started
+    if cache is not None:
+        cache.close()
+    if decode_pool is not None:
+        decode_pool.close()
+    cloudwatch.close()
+
+    pages = len(api.latencies)
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'requests': api.request_count,
+        'pages': pages,
+        'records': api.records,
+        'duplicates': api.duplicates,
+        'cache_hits': api.cache_hits,
+        'records_filtered': record_filter.records_dropped,
+        'bytes_received': api.bytes_received,
+        'bytes_sent': sink.bytes_out,
+        'pages_per_s': round(pages / elapsed, 2),
+        'records_per_s': round(api.records / elapsed, 1),
+        'bytes_received_per_s': round(api.bytes_received / elapsed),
+        'bytes_sent_per_s': round(sink.bytes_out / elapsed),
+        'latency_p50_ms': round(percentile(api.latencies, 50) * 1000, 3) if pages else None,
+        'latency_p99_ms': round(percentile(api.latencies, 99) * 1000, 3) if pages else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'firehose_batches': firehose_client.calls,
+        'firehose_retries': getattr(sink, 'retries', 0),
+        'throttles': rate_limiter.throttle_events,
+        'hedges': api.hedges,
+        'hedge_wins': api.hedge_wins,
+        'incomplete_pages': api.incomplete_pages,
+        'log_events': logs_client.events,
+        'stages': metrics.stages()
+    }
+
+
+def compare(result:dict, filename:str, threshold:float) -> bool:
+    """Compare with the last result in filename that has the same config
+
+    Returns:
+        bool: False if a metric got worse by more than threshold
+    """
+    baseline = None
+    with open(filename, 'r') as f:
+        for line in f:
+            line = json.loads(line)
+            if line['config'] == result['config']:
+                baseline = line
+    if baseline is None:
+        print(f'No result with the same config in {filename} to compare with.', file=sys.stderr)
+        return True
+
+    ok = True
+    print(f"Compared with {baseline['commit']} ({baseline['timestamp']}):", file=sys.stderr)
+    for metric in COMPARED_METRICS:
+        old, new = baseline['results'].get(metric), result['results'].get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if metric not in LOWER_IS_BETTER else change
+        flag = ''
+        if worse > threshold:
+            flag = '  REGRESSION'
+            ok = False
+        print(f'  {metric}: {old} -> {new} ({change:+.1%}){flag}', file=sys.stderr)
+
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the scraper against a local fake Pushshift and stub AWS clients')
+    parser.add_argument('--mode', choices=['sequential', 'pipeline', 'sharded'], default='sequential', help='How to crawl.')
+    parser.add_argument('--pages', type=int, default=200, help='Stop after this many requests.')
+    parser.add_argument('--size', type=int, default=100, help='Posts per page.')
+    parser.add_argument('--post_type', choices=['submissions', 'comments'], default='comments', help='Type of posts to crawl.')
+    parser.add_argument('--subreddits', nargs='+', default=['AskReddit'], help='Subreddits to crawl.')
+    parser.add_argument('--passthrough', action='store_true', help='Send posts without decoding them.')
+    parser.add_argument('--sink', choices=SINKS, default='firehose', help='Send posts to the Firehose stub or write local files.')
+    parser.add_argument('--fields', nargs='+', help='Only request and send these fields of each post.')
+    parser.add_argument('--exclude_fields', nargs='+', help='Remove these fields from each post before sending it.')
+    parser.add_argument('--drop_removed', action='store_true', help='Drop posts whose body is [removed] or [deleted].')
+    parser.add_argument('--min_score', type=int, help='Drop posts with a lower score.')
+    parser.add_argument('--buffered', action='store_true', help='Buffer Firehose records across pages.')
+    parser.add_argument('--serializer', choices=SERIALIZERS, default='json', help='JSON serializer for Firehose records.')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='none', help='Compression of Firehose records.')
+    parser.add_argument('--queue_size', type=int, default=4, help='Pipeline queue size.')
+    parser.add_argument('--workers', type=int, default=4, help='Workers in sharded mode.')
+    parser.add_argument('--cache', help='Cache responses in this directory. Run again with --cache_mode replay to measure cached crawls.')
+    parser.add_argument('--cache_mode', choices=CACHE_MODES, default='use', help='Response cache mode.')
+    parser.add_argument('--read_timeout', type=float, default=60.0, help='Seconds to wait for Pushshift to send data.')
+    parser.add_argument('--hedge_percentile', type=float, help='Hedge requests slower than this percentile of recent latencies.')
+    parser.add_argument('--memory_budget', type=int, help='Bytes of fetched posts to hold before waiting for the sink.')
+    parser.add_argument('--processes', type=int, default=0, help='Decode pages in this many worker processes.')
+    parser.add_argument('--window_target_results', type=int, help='Limit searches to windows expected to match this many posts.')
+    parser.add_argument('--requests_per_second', type=float, default=10000.0, help='Rate limit.')
+    parser.add_argument('--no_history', action='store_true', help='Do not write the metadata history log.')
+    parser.add_argument('--firehose_latency', type=float, default=0.0, help='Seconds each PutRecordBatch call takes.')
+    parser.add_argument('--firehose_failure_rate', type=float, default=0.0, help='Fraction of Firehose records rejected.')
+    parser.add_argument('--base_url', help='Use an already running server instead of starting one. Its options must match.')
+    parser.add_argument('--name', help='Name to record with the results.')
+    parser.add_argument('--output', help='Append results to this JSON lines file.')
+    parser.add_argument('--compare', help='Compare with the last result with the same config in this JSON lines file.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change counted as a regression by --compare.')
+    parser.add_argument('--verbose', action='store_true', help='Show log messages.')
+
+    fake_pushshift.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server, base_url = start_server(args)
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            output = sys.stdout if args.verbose else open(os.devnull, 'w')
+            with contextlib.redirect_stdout(output):
+                results = run(args, base_url, directory)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    config = {key: value for key, value in vars(args).items() if key not in ('base_url', 'name', 'output', 'compare', 'threshold', 'verbose')}
+    result = {
+        'name': args.name,
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'results': results
+    }
+    print(json.dumps(result))
+
+    ok = True
+    if args.compare is not None:
+        ok = compare(result, args.compare, args.threshold)
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+    sys.exit(0 if ok else 1)
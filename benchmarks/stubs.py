@@ -0,0 +1,86 @@
+# In-process stand-ins for the boto3 firehose and logs clients. They accept
+# the calls the scraper makes, keep count of what was sent and can inject
+# latency and failures.
+
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+
+class FakeFirehoseClient:
+    """Accepts PutRecordBatch calls. failure_rate is the fraction of records
+    rejected with ServiceUnavailableException, which the scraper retries."""
+
+    def __init__(self, latency:float=0.0, failure_rate:float=0.0, seed:int=0) -> None:
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # Track stats
+        self.calls = 0
+        self.records = 0
+        self.bytes = 0
+        self.failed_records = 0
+
+    def put_record_batch(self, DeliveryStreamName:str, Records:list) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+
+        responses = []
+        failed = 0
+        with self.lock:
+            self.calls += 1
+            for record in Records:
+                if self.failure_rate and self.random.random() < self.failure_rate:
+                    responses.append({'ErrorCode': 'ServiceUnavailableException', 'ErrorMessage': 'Injected failure'})
+                    failed += 1
+                    continue
+                responses.append({'RecordId': str(self.records)})
+                self.records += 1
+                self.bytes += len(record['Data'])
+            self.failed_records += failed
+
+        return {'FailedPutCount': failed, 'Encrypted': False, 'RequestResponses': responses}
+
+
+class FakeLogsExceptions:
+    """The exceptions the scraper catches from client.exceptions"""
+
+    class ResourceAlreadyExistsException(botocore.exceptions.ClientError):
+        pass
+
+    class InvalidSequenceTokenException(botocore.exceptions.ClientError):
+        pass
+
+    class DataAlreadyAcceptedException(botocore.exceptions.ClientError):
+        pass
+
+
+class FakeLogsClient:
+    """Accepts CreateLogStream and PutLogEvents calls"""
+    exceptions = FakeLogsExceptions
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.streams = set()
+
+        # Track stats
+        self.calls = 0
+        self.events = 0
+
+    def create_log_stream(self, logGroupName:str, logStreamName:str) -> dict:
+        with self.lock:
+            if (logGroupName, logStreamName) in self.streams:
+                raise FakeLogsExceptions.ResourceAlreadyExistsException(
+                    {'Error': {'Code': 'ResourceAlreadyExistsException', 'Message': 'The specified log stream already exists'}}, 'CreateLogStream')
+            self.streams.add((logGroupName, logStreamName))
+        return {}
+
+    def put_log_events(self, logGroupName:str, logStreamName:str, logEvents:list, sequenceToken:str=None) -> dict:
+        with self.lock:
+            self.calls += 1
+            self.events += len(logEvents)
+            return {'nextSequenceToken': str(self.calls)}
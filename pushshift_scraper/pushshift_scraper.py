@@ -1,27 +1,24 @@
 import argparse
-import configparser
 import json
+from datetime import datetime
 
-from utils.cloudwatch import CloudWatchLog
-from utils.firehose import Firehose
-from utils.pushshift_api import PushshiftAPI
-from utils.local_logs import MetadataLog
+from utils.crawler import Crawler
+from utils.follow import Follower
+from utils.setup import Settings, create_api, create_cloudwatch, create_decode_pool, create_metadata_log, create_metrics, create_record_filter, create_sink, close_services, service_stats
+from utils.startup import StartupTimer
+from utils.pipeline import Pipeline
+from utils.sharding import ShardedCrawler
 
 
 if __name__ == "__main__":
 
+    # Time startup up to the first page from Pushshift
+    startup = StartupTimer()
+
     """Config file"""
-    config = configparser.ConfigParser()
-    config.read('pushshift_scraper/settings.cfg')
+    settings = Settings()
 
-    LOCAL_LOG_FILENAME = config['local_log']['filename']
-    CLOUDWATCH_LOG_GROUP = config['cloudwatch']['log_group']
-    CLOUDWATCH_LOG_STREAM = config['cloudwatch']['log_stream']
-    FIREHOSE_TEST = config['firehose']['test_destination']
-    FIREHOSE_COMMENTS = config['firehose']['comments_destination']
-    FIREHOSE_SUBMISSIONS = config['firehose']['submissions_destination']
 
-    
     """Command line arguments"""
     parser = argparse.ArgumentParser(description='Request reddit posts from the pushshift API')
     parser.add_argument('post_type', choices=['submissions', 'comments'], help='Type of posts to return: submissions or comments')
@@ -29,12 +26,14 @@ if __name__ == "__main__":
     parser.add_argument('--after', type=int, nargs=1, help='Return posts after this date. Takes a UNIX timestamp.')
     parser.add_argument('--before', type=int, nargs=1, help='Return posts before this date. Takes a UNIX timestamp.')
     parser.add_argument('--size', type=int, nargs=1, default=100, help='Number of posts to return.')
-    parser.add_argument('--local_log', help='Local log file to write metadata to.')
-    parser.add_argument('--cloudwatch_log_group', help='Cloudwatch log group to write to.')
-    parser.add_argument('--cloudwatch_log_stream', help='Cloudwatch log stream to write to.')
     parser.add_argument('--firehose', help='Firehose delivery stream to send results to.')
     parser.add_argument('--no_resume', action='store_true', help='Do not use timestamps from metadata file and resume previous search.')
-    parser.add_argument('--test', action='store_true', help='Do a test run.')
+    parser.add_argument('--pipeline', action='store_true', help='Fetch the next page while sending and logging previous pages.')
+    parser.add_argument('--queue_size', type=int, help='Max pages waiting between pipeline stages.')
+    parser.add_argument('--shards', type=int, help='Split the time range into this many windows and crawl them concurrently.')
+    parser.add_argument('--workers', type=int, help='Number of concurrent workers when crawling shards.')
+    parser.add_argument('--follow', action='store_true', help='Once caught up, keep polling for new posts until stopped.')
+    Settings.add_arguments(parser)
 
     parsed_args = parser.parse_args()
     args = vars(parsed_args) # Access args as dict
@@ -54,51 +53,69 @@ if __name__ == "__main__":
     FIREHOSE = args['firehose']
     NO_RESUME = args['no_resume']
     TEST = args['test']
+    PIPELINE = args['pipeline']
+    SHARDS = args['shards']
+    FOLLOW = args['follow']
 
     # Override settings.cfg if arguments supplied via cmd line
-    if args['local_log'] is not None:
-        LOCAL_LOG_FILENAME = args['local_log']
-    if args['cloudwatch_log_group'] is not None:
-        CLOUDWATCH_LOG_GROUP = args['cloudwatch_log_group']
-    if args['cloudwatch_log_stream'] is not None:
-        CLOUDWATCH_LOG_STREAM = args['cloudwatch_log_stream']
-    if args['firehose'] is not None:
-        FIREHOSE = args['firehose']
+    settings.override(args)
+    if args['queue_size'] is not None:
+        settings.pipeline_queue_size = args['queue_size']
+    if args['workers'] is not None:
+        settings.shard_workers = args['workers']
+
 
 
+    startup.phase('config')
 
     """Configure services"""
     # Configure AWS CloudWatch logging
-    cloudwatch = CloudWatchLog(
-        log_group=CLOUDWATCH_LOG_GROUP,
-        log_stream=CLOUDWATCH_LOG_STREAM)
+    cloudwatch = create_cloudwatch(settings)
+    startup.phase('logging')
 
     # Configure AWS Firehose
     # Override settings.cfg if firehose delivery stream passed via cmd line
     if FIREHOSE is None:
         if TEST:
-            FIREHOSE = FIREHOSE_TEST
+            FIREHOSE = settings.firehose_test
         elif POST_TYPE == 'comments':
-            FIREHOSE = FIREHOSE_COMMENTS
+            FIREHOSE = settings.firehose_comments
         elif POST_TYPE == 'submissions':
-            FIREHOSE = FIREHOSE_SUBMISSIONS
+            FIREHOSE = settings.firehose_submissions
         else:
             raise Exception('Firehose delivery stream not specified')
-        
-    firehose = Firehose(
-        cloudwatch_logger=cloudwatch,
-        delivery_stream=FIREHOSE)
+
+    metrics = create_metrics(
+        settings,
+        cloudwatch,
+        dimensions={'PostType': POST_TYPE, 'DeliveryStream': FIREHOSE if settings.sink == 'firehose' else settings.sink})
+    record_filter = create_record_filter(settings)
+    decode_pool, sink_filter = create_decode_pool(settings, cloudwatch, record_filter, metrics, fetchers=settings.shard_workers if SHARDS is not None else 1)
+    sink = create_sink(
+        settings,
+        cloudwatch,
+        delivery_stream=FIREHOSE,
+        prefix=POST_TYPE,
+        metrics=metrics,
+        record_filter=sink_filter)
+    startup.phase('sinks')
 
     # Configure local metadata log
     # This is useful when the scraper needs to be restarted. This will let it
     # pick up from where it left off.
-    metadata_log = MetadataLog(
-        cloudwatch_logger=cloudwatch,
-        filename=LOCAL_LOG_FILENAME,
-        filter_subreddits=SUBREDDITS)
+    metadata_log = create_metadata_log(settings, cloudwatch, metrics, filter_subreddits=SUBREDDITS, post_type=POST_TYPE)
+    startup.phase('checkpoints')
 
     # Configure Pushshift API
-    api = PushshiftAPI(cloudwatch_logger=cloudwatch)
+    api = create_api(
+        settings,
+        cloudwatch,
+        metrics,
+        record_filter,
+        decode_pool=decode_pool,
+        pool_maxsize=max(settings.shard_workers, 10),
+        startup=startup)
+    startup.phase('api')
 
 
     """Configure parameters"""
@@ -110,40 +127,97 @@ if __name__ == "__main__":
         Size: {SIZE}
         No resume: {NO_RESUME}
         Test: {TEST}
-        Local log: {LOCAL_LOG_FILENAME}
-        Cloudwatch log group:{CLOUDWATCH_LOG_GROUP}
-        Cloudwatch log stream: {CLOUDWATCH_LOG_STREAM}
+        Pipeline: {PIPELINE} (queue size {settings.pipeline_queue_size})
+        Shards: {SHARDS} ({settings.shard_workers} workers)
+        Follow: {FOLLOW}
+        Checkpoints: {metadata_log.checkpoint_filename}
         Firehose delivery stream: {FIREHOSE}
+        Sink: {settings.sink} ({settings.local_directory if settings.sink == 'local' else FIREHOSE})
+        {settings.describe()}
     """)
     
-    # Use previous result timestamp from metadata log if possible and --no_resume is False
-    if metadata_log.filtered_log_last_line is not None and BEFORE is not None and metadata_log.min_created_utc < BEFORE:
+    # Plan which time ranges to crawl. Once the coverage map has ranges for
+    # these subreddits, only the gaps in the requested range are crawled,
+    # newest first. Sharded crawls plan their own shards from the gaps.
+    windows = [(BEFORE, AFTER)]
+    if SHARDS is None and not NO_RESUME and metadata_log.get_coverage():
+        now = int(datetime.utcnow().timestamp())
+        gaps = metadata_log.uncovered(0 if AFTER is None else AFTER + 1, now if BEFORE is None else BEFORE - 1)
+        windows = [(hi + 1, None if lo <= 0 else lo - 1) for lo, hi in gaps]
+        cloudwatch.log(f"Crawling {len(gaps)} gaps in coverage: {gaps}")
+
+    # Otherwise use previous result timestamp from metadata log if possible and --no_resume is False.
+    elif SHARDS is None and metadata_log.filtered_log_last_line is not None and BEFORE is not None and metadata_log.min_created_utc < BEFORE:
         if NO_RESUME:
             cloudwatch.log(f"INFO: 'before' timestamp {metadata_log.min_created_utc} from metadata log less than CLI arg {BEFORE}, but --no_resume is set.")
         else:
             cloudwatch.log(f"Using 'before' timestamp {metadata_log.min_created_utc} from metadata log instead of CLI arg {BEFORE}")
-            BEFORE = metadata_log.min_created_utc
+            # Overlap the last second, which may have had more posts
+            windows = [(metadata_log.min_created_utc + 1, AFTER)]
 
 
     """Get results"""
-    # Get first page of results
-    result = api.get(post_type=POST_TYPE, subreddits=SUBREDDITS, before=BEFORE, after=AFTER, size=SIZE)
-    firehose.send_result(result.data)
-    metadata_log.add_result_metadata(result)
-
-    # Continue getting results
-    while result.metadata['total_results'] > 0:
-        result = api.get_next(result)
-        firehose.send_result(result.data)
-        metadata_log.add_result_metadata(result)
-        
-        # Record progress at regular intervals
-        api.log_progress()
-
-        # If testing, retrieve up to two pages
+    result = None
+    if SHARDS is not None:
+        crawler = ShardedCrawler(
+            api=api,
+            firehose=sink,
+            metadata_log=metadata_log,
+            cloudwatch_logger=cloudwatch,
+            checkpoint_filename=settings.shard_checkpoint_filename,
+            num_workers=settings.shard_workers,
+            min_shard_seconds=settings.shard_min_seconds)
+
+        result = crawler.run(
+            post_type=POST_TYPE, subreddits=SUBREDDITS, before=BEFORE, after=AFTER, size=SIZE,
+            num_shards=SHARDS, no_resume=NO_RESUME, max_requests=10 if TEST else None)
+        windows = []
+
+    for window_before, window_after in windows:
+        # If testing, retrieve up to ten pages
         if TEST and api.request_count >= 10:
-            cloudwatch.log("Stopping test.")
             break
 
+        if PIPELINE:
+            pipeline = Pipeline(
+                api=api,
+                firehose=sink,
+                metadata_log=metadata_log,
+                cloudwatch_logger=cloudwatch,
+                queue_size=settings.pipeline_queue_size)
+
+            result = pipeline.run(
+                post_type=POST_TYPE, subreddits=SUBREDDITS, before=window_before, after=window_after, size=SIZE,
+                max_requests=10 if TEST else None) or result
+            continue
+
+        crawler = Crawler(
+            api=api,
+            firehose=sink,
+            metadata_log=metadata_log,
+            cloudwatch_logger=cloudwatch)
+
+        result = crawler.run(
+            post_type=POST_TYPE, subreddits=SUBREDDITS, before=window_before, after=window_after, size=SIZE,
+            max_requests=10 if TEST else None) or result
+
+    # Keep polling for new posts, starting from the newest post delivered
+    if FOLLOW:
+        follower = Follower(
+            api=api,
+            firehose=sink,
+            metadata_log=metadata_log,
+            cloudwatch_logger=cloudwatch,
+            min_interval=settings.follow_min_interval,
+            max_interval=settings.follow_max_interval,
+            target_posts=settings.follow_target_posts,
+            max_batch=settings.follow_max_batch)
+
+        follower.run(post_type=POST_TYPE, subreddits=SUBREDDITS, size=SIZE, max_requests=api.request_count + 10 if TEST else None)
+
+    # Send anything still buffered
+    close_services([sink], api, metrics)
+
     # Log result of scrape
-    cloudwatch.log(f"Finished crawl. Result: {api.progress()} Last result metadata:\n{json.dumps(result.metadata, indent=4)}")
\ No newline at end of file
+    last_metadata = json.dumps(result.metadata, indent=4) if result is not None else None
+    cloudwatch.log(f"Finished crawl. Result: {api.progress()} {sink.stats()} {service_stats(api, record_filter)} {metrics.summary()} Last result metadata:\n{last_metadata}")
\ No newline at end of file
@@ -0,0 +1,117 @@
+import argparse
+
+from utils.jobs import JobScheduler
+from utils.setup import Settings, create_api, create_cloudwatch, create_decode_pool, create_metadata_log, create_metrics, create_record_filter, create_sink, close_services, service_stats
+from utils.startup import StartupTimer
+
+
+if __name__ == "__main__":
+
+    # Time startup up to the first page from Pushshift
+    startup = StartupTimer()
+
+    """Config file"""
+    settings = Settings()
+
+
+    """Command line arguments"""
+    parser = argparse.ArgumentParser(description='Run several Pushshift crawl jobs with one rate limit')
+    parser.add_argument('job_file', help='JSON file with a list of jobs. Each job has post_type and subreddits, and optionally after, before, firehose, priority, size and name.')
+    parser.add_argument('--workers', type=int, help='Number of jobs to crawl concurrently.')
+    parser.add_argument('--no_resume', action='store_true', help='Crawl the whole range of every job again.')
+    Settings.add_arguments(parser)
+
+    args = vars(parser.parse_args())
+
+    # Override settings.cfg if arguments supplied via cmd line
+    settings.override(args)
+    if args['workers'] is not None:
+        settings.scheduler_workers = args['workers']
+    NO_RESUME = args['no_resume']
+    TEST = args['test']
+
+
+    startup.phase('config')
+
+    """Configure services"""
+    cloudwatch = create_cloudwatch(settings)
+    startup.phase('logging')
+
+    # Metrics are shared by all jobs
+    metrics = create_metrics(settings, cloudwatch)
+
+    jobs = JobScheduler.read_job_file(args['job_file'])
+
+    # Send each job to its own delivery stream, or the default for its post type
+    for job in jobs:
+        if TEST:
+            job.firehose = settings.firehose_test
+        elif job.firehose is None:
+            job.firehose = settings.firehose_comments if job.post_type == 'comments' else settings.firehose_submissions
+
+    record_filter = create_record_filter(settings)
+    decode_pool, sink_filter = create_decode_pool(settings, cloudwatch, record_filter, metrics, fetchers=settings.scheduler_workers)
+
+    # One sink per delivery stream, shared by the jobs sending to it. Local
+    # sinks and spools write each stream's posts to its own subdirectory.
+    sinks = {}
+    for stream in sorted(set(job.firehose for job in jobs)):
+        sinks[stream] = create_sink(
+            settings,
+            cloudwatch,
+            delivery_stream=stream,
+            prefix=stream,
+            metrics=metrics,
+            record_filter=sink_filter,
+            subdirectory=stream)
+    startup.phase('sinks')
+
+    # Checkpoints for all jobs are kept in one file, keyed by post type and subreddits
+    metadata_log = create_metadata_log(settings, cloudwatch, metrics)
+    startup.phase('checkpoints')
+
+    # All jobs share one rate limit and connection pool
+    api = create_api(
+        settings,
+        cloudwatch,
+        metrics,
+        record_filter,
+        decode_pool=decode_pool,
+        pool_maxsize=max(settings.scheduler_workers, 10),
+        startup=startup)
+    startup.phase('api')
+
+    cloudwatch.log(f"""Using paramters:
+        Job file: {args['job_file']} ({len(jobs)} jobs)
+        Workers: {settings.scheduler_workers}
+        No resume: {NO_RESUME}
+        Test: {TEST}
+        Checkpoints: {metadata_log.checkpoint_filename}
+        Firehose delivery streams: {list(sinks)}
+        Sink: {settings.sink}{f' ({settings.local_directory})' if settings.sink == 'local' else ''}
+        {settings.describe()}
+    """)
+
+
+    """Get results"""
+    scheduler = JobScheduler(
+        api=api,
+        sinks=sinks,
+        metadata_log=metadata_log,
+        cloudwatch_logger=cloudwatch,
+        num_workers=settings.scheduler_workers,
+        progress_interval=settings.scheduler_progress_interval)
+    scheduler.run(jobs, no_resume=NO_RESUME, max_requests=10 if TEST else None)
+
+    # Send anything still buffered
+    close_services(sinks.values(), api, metrics)
+
+    # Log result of scrape
+    stats = ' '.join(sink.stats() for sink in sinks.values())
+    cloudwatch.log(f"Finished jobs. Result:\n{scheduler.progress()}\n{stats}\n{service_stats(api, record_filter)}\n{metrics.summary()}")
+
+    failed = [job.name for job in jobs if job.error is not None]
+    if failed:
+        message = f"ERROR: {len(failed)} jobs failed: {failed}"
+        cloudwatch.log(message)
+        raise Exception(message)
@@ -0,0 +1,76 @@
+# Create AWS clients from one shared session, in the background and only when
+# they're needed, so startup doesn't wait on boto3 before the first Pushshift
+# request
+
+import threading
+
+_lock = threading.Lock()
+_session = None
+_settings = {'max_pool_connections': 50, 'connect_timeout': 10, 'read_timeout': 60}
+
+
+def configure(max_pool_connections:int=50, connect_timeout:float=10, read_timeout:float=60):
+    """Set the connection settings of clients created after this"""
+    with _lock:
+        _settings.update(max_pool_connections=max_pool_connections, connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+
+def client(service:str):
+    """Create a client for an AWS service from the shared session
+
+    The session loads the credentials and service models once for all
+    clients. Each client keeps up to max_pool_connections connections alive,
+    enough for the threads sending to it.
+    """
+    # boto3 takes a while to import, so it's only imported when a client is needed
+    import boto3
+    from botocore.config import Config
+
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session.client(service, config=Config(tcp_keepalive=True, **_settings))
+
+
+class LazyClient:
+    """A boto3 client that's created on first use.
+
+    Attributes are looked up on the client, so it can be used in place of
+    one. With warm set, the client is created in a background thread straight
+    away, so it's ready by the time it's first used. on_create is called
+    with the client once it's created.
+    """
+
+    def __init__(self, service:str, on_create=None, warm:bool=False) -> None:
+        self.service = service
+        self.on_create = on_create
+        self._client = None
+        self._lock = threading.Lock()
+
+        if warm:
+            threading.Thread(target=self._warm, name=f'{service}-client', daemon=True).start()
+
+
+    def get(self):
+        """The client, created if it doesn't exist yet"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    client_ = client(self.service)
+                    if self.on_create is not None:
+                        self.on_create(client_)
+                    self._client = client_
+        return self._client
+
+
+    def __getattr__(self, name:str):
+        return getattr(self.get(), name)
+
+
+    def _warm(self):
+        try:
+            self.get()
+        except Exception:
+            # Raised again when the client is used
+            pass
@@ -1,16 +1,59 @@
-import boto3
+import atexit
+import threading
 import time
+from collections import deque
+
+from utils.aws import LazyClient
+
+# PutLogEvents limits
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD_BYTES = 26
+MAX_EVENT_BYTES = 262144 - EVENT_OVERHEAD_BYTES
+MAX_BATCH_SPAN_MS = 24 * 60 * 60 * 1000
 
 class CloudWatchLog:
+    """Log messages to the console and to a CloudWatch log stream.
+
+    Messages are printed immediately and queued in memory. A background thread
+    ships them to CloudWatch in batches every flush_interval seconds, or sooner
+    if a full batch is waiting, so logging never blocks on the network.
+    Queued messages are flushed when the process exits.
 
-    def __init__(self, log_group:str, log_stream:str):
-        self.client = boto3.client('logs')
-        self.SEQUENCE_TOKEN = 'none'
+    The client is created and the log stream set up in the background, so
+    logging can start straight away. Set create_stream to False if the stream
+    already exists to skip creating it. With remote False, messages are only
+    printed.
+    """
+
+    def __init__(self, log_group:str, log_stream:str, flush_interval:float=5.0, max_queued_events:int=100000, client=None, create_stream:bool=True, remote:bool=True):
+        if client is not None:
+            self._register_emf_header(client)
+        elif remote:
+            client = LazyClient('logs', on_create=self._register_emf_header, warm=True)
+        self.client = client
+        self.remote = remote
+        self.SEQUENCE_TOKEN = None
         self.LOG_GROUP = log_group
         self.LOG_STREAM = log_stream
-       
-        
-        self.create_log_stream()
+        self.flush_interval = flush_interval
+
+        # Events waiting to be shipped. The oldest are dropped if CloudWatch
+        # is unreachable for long enough to fill the queue.
+        self.events = deque()
+        self.queued_bytes = 0
+        self.max_queued_events = max_queued_events
+        self.dropped_events = 0
+
+        self.lock = threading.Condition()
+        self.closing = False
+        self.stream_ready = not create_stream
+
+        self.shipper = None
+        if remote:
+            self.shipper = threading.Thread(target=self._ship, name='cloudwatch', daemon=True)
+            self.shipper.start()
+            atexit.register(self.close)
 
 
     def create_log_stream(self):
@@ -22,58 +65,175 @@ class CloudWatchLog:
         except self.client.exceptions.ResourceAlreadyExistsException as e:
             # Keep going if already exists, adding event should update sequence token
             message = f'Log stream {self.LOG_STREAM} already exists.'
-            self.log(message)
         else:
             message = f'Created log stream {self.LOG_STREAM}.'
 
-            # Don't use sequence token if log stream is new
-            self.log(message, use_sequence_token=False)
+        self.log(message)
+        self.stream_ready = True
+
+
+    def _register_emf_header(self, client):
+        # Have CloudWatch extract metrics from events in embedded metric
+        # format. Other events are stored as usual.
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is not None:
+            events.register('before-sign.logs.PutLogEvents', self._add_emf_header)
+
 
-    
+    def _add_emf_header(self, request, **kwargs):
+        request.headers['x-amzn-logs-format'] = 'json/emf'
+
+
+    def log(self, message):
 
-    def log(self, message, use_sequence_token=True):
-        
         # Output message to console
         print(f"CloudWatch: {message}")
+        if not self.remote:
+            return
 
-        try:
-            response = self._put_event(message, use_sequence_token=use_sequence_token)
-        except self.client.exceptions.InvalidSequenceTokenException as e:
-            # Use sequence token if returned. If expected sequence token is null, don't send a sequence token.
-            if 'expectedSequenceToken' in e.response:
-                # Update sequence token and retry
-                self.SEQUENCE_TOKEN = e.response['expectedSequenceToken']
-                response = self._put_event(message)
-            elif e.response['Error']['Message'] == 'The given sequenceToken is invalid. The next expected sequenceToken is: null':
-                response = self._put_event(message, use_sequence_token=False)
-        else:
-            self.SEQUENCE_TOKEN = response['nextSequenceToken']
-            return response
+        message = message.encode('utf-8')[:MAX_EVENT_BYTES].decode('utf-8', errors='ignore')
+        with self.lock:
+            # Timestamps are taken under the lock so events stay in order
+            event = {
+                'timestamp': int(time.time() * 1000),
+                'message': message
+            }
+            self.events.append(event)
+            self.queued_bytes += self._event_size(event)
+
+            if len(self.events) > self.max_queued_events:
+                dropped = self.events.popleft()
+                self.queued_bytes -= self._event_size(dropped)
+                self.dropped_events += 1
+
+            if len(self.events) >= MAX_BATCH_EVENTS or self.queued_bytes >= MAX_BATCH_BYTES:
+                self.lock.notify_all()
+
+
+    def flush(self, timeout:float=30.0):
+        """Wait until queued events have been shipped
+
+        Args:
+            timeout (float, optional): Max seconds to wait. Defaults to 30.
+
+        Returns:
+            bool: True if the queue was emptied
+        """
+        if not self.remote:
+            return True
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            self.lock.notify_all()
+            while self.events and self.shipper.is_alive() and time.monotonic() < deadline:
+                self.lock.wait(timeout=0.1)
+
+            return not self.events
+
+
+    def close(self):
+        """Ship everything still queued and stop the background thread"""
+        if not self.remote:
+            return
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+            self.lock.notify_all()
+
+        self.shipper.join(timeout=30)
+
+
+    def _event_size(self, event:dict) -> int:
+        return len(event['message'].encode('utf-8')) + EVENT_OVERHEAD_BYTES
+
+
+    def _ship(self):
+        """Send queued events in batches until closed"""
+        while True:
+            # Set up the stream straight away rather than after the first interval
+            if not self.stream_ready:
+                try:
+                    self.create_log_stream()
+                except Exception as e:
+                    print(f"CloudWatch: Failed to create log stream {self.LOG_STREAM}. Exception {e}")
+
+            with self.lock:
+                if not self.closing and len(self.events) < MAX_BATCH_EVENTS and self.queued_bytes < MAX_BATCH_BYTES:
+                    self.lock.wait(timeout=self.flush_interval)
+                closing = self.closing
+
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    break
+                try:
+                    self._put_events(batch)
+                except Exception as e:
+                    # Put the batch back and try again on the next interval
+                    print(f"CloudWatch: Failed to send {len(batch)} log events. Exception {e}")
+                    with self.lock:
+                        self.events.extendleft(reversed(batch))
+                        self.queued_bytes += sum(self._event_size(event) for event in batch)
+                    if closing:
+                        return
+                    break
+
+            with self.lock:
+                self.lock.notify_all()
+                if closing and not self.events:
+                    return
+
+
+    def _next_batch(self) -> list:
+        """Take the oldest events that fit in one PutLogEvents call"""
+        batch = []
+        batch_bytes = 0
+        with self.lock:
+            while self.events and len(batch) < MAX_BATCH_EVENTS:
+                event = self.events[0]
+                size = self._event_size(event)
+                if batch and (batch_bytes + size > MAX_BATCH_BYTES or event['timestamp'] - batch[0]['timestamp'] > MAX_BATCH_SPAN_MS):
+                    break
+                batch.append(self.events.popleft())
+                batch_bytes += size
+                self.queued_bytes -= size
+
+        return batch
+
+
+    def _put_events(self, events:list):
+        """Send events, updating the sequence token if CloudWatch expects a different one"""
+        for attempt in range(3):
+            try:
+                response = self._put_event(events)
+            except (self.client.exceptions.InvalidSequenceTokenException, self.client.exceptions.DataAlreadyAcceptedException) as e:
+                # Use sequence token if returned. If expected sequence token is null, don't send a sequence token.
+                token = e.response.get('expectedSequenceToken')
+                if token is None:
+                    token = e.response['Error']['Message'].rsplit(' ', 1)[-1]
+                self.SEQUENCE_TOKEN = None if token == 'null' else token
+                if isinstance(e, self.client.exceptions.DataAlreadyAcceptedException):
+                    return None
+            else:
+                self.SEQUENCE_TOKEN = response.get('nextSequenceToken')
+                return response
+
+        raise Exception(f'Could not find sequence token for log stream {self.LOG_STREAM}')
 
 
-    def _put_event(self, message, use_sequence_token=True):
+    def _put_event(self, events:list):
         """Omit sequence token when initializing log stream with first message"""
-        if use_sequence_token:
+        if self.SEQUENCE_TOKEN is not None:
             response = self.client.put_log_events(
                 logGroupName=self.LOG_GROUP,
                 logStreamName=self.LOG_STREAM,
-                logEvents=[
-                    {
-                        'timestamp': int(time.time() * 1000),
-                        'message': message
-                    }
-                ],
+                logEvents=events,
                 sequenceToken = self.SEQUENCE_TOKEN
             )
         else:
             response = self.client.put_log_events(
                 logGroupName=self.LOG_GROUP,
                 logStreamName=self.LOG_STREAM,
-                logEvents=[
-                    {
-                        'timestamp': int(time.time() * 1000),
-                        'message': message
-                    }
-                ]
+                logEvents=events
             )
         return response
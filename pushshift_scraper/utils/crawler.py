@@ -0,0 +1,60 @@
+from functools import partial
+
+from utils.pushshift_api import NoResultsError
+
+
+class Crawler:
+    """Crawl one page at a time: fetch a page, hand it to Firehose, then fetch the next.
+
+    Pages are written to the metadata log once Firehose has delivered them,
+    and the end of results once the pages before it have been delivered.
+    """
+
+    def __init__(self, api, firehose, metadata_log, cloudwatch_logger) -> None:
+        self.api = api
+        self.firehose = firehose
+        self.metadata_log = metadata_log
+        self.cloudwatch = cloudwatch_logger
+
+
+    def run(self, post_type:str, subreddits:list, before:int=None, after:int=None, size:int=100, max_requests:int=None):
+        """Crawl until Pushshift runs out of results.
+
+        Args:
+            post_type (str): Submissions or comments.
+            subreddits (list): List of subreddits to search.
+            before (int, optional): Max created_utc of posts to get (epoch timestamp). Defaults to None.
+            after (int, optional): Min created_utc of posts to get (epoch timestamp). Defaults to None.
+            size (int, optional): Number of results per page. Defaults to 100.
+            max_requests (int, optional): Stop after this many requests. Defaults to None.
+
+        Returns:
+            PushshiftResponse: The last page fetched, or None.
+        """
+        # Get first page of results
+        try:
+            result = self.api.get(post_type=post_type, subreddits=subreddits, before=before, after=after, size=size)
+        except NoResultsError as e:
+            self.firehose.send_result([], callback=partial(self.metadata_log.add_end_of_results, e.request_params, incomplete=e.incomplete))
+            return None
+        self.firehose.send_result(result.take(), callback=partial(self.metadata_log.add_result_metadata, result))
+
+        # Continue getting results
+        while result.metadata['total_results'] > 0:
+            try:
+                next_result = self.api.get_next(result)
+            except NoResultsError as e:
+                self.firehose.send_result([], callback=partial(self.metadata_log.add_end_of_results, e.request_params, incomplete=e.incomplete))
+                break
+            result = next_result
+            self.firehose.send_result(result.take(), callback=partial(self.metadata_log.add_result_metadata, result))
+
+            # Record progress at regular intervals
+            self.api.log_progress()
+
+            # If testing, stop after max_requests
+            if max_requests is not None and self.api.request_count >= max_requests:
+                self.cloudwatch.log("Stopping test.")
+                break
+
+        return result
@@ -1,54 +1,280 @@
-import boto3
-import json
+import random
+import threading
+import time
+
+from utils.aws import LazyClient
+from utils.metrics import Metrics
+from utils.record_filter import RecordFilter
+from utils.serialization import filter_records, get_serializer, get_compressor, serialize_records
+
+# PutRecordBatch limits
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+MAX_RECORD_BYTES = 1000 * 1024
+
+# Error codes returned when Firehose is throttling or temporarily unavailable
+THROTTLE_ERROR_CODES = {
+    'ServiceUnavailableException',
+    'ThrottlingException',
+    'LimitExceededException',
+    'InternalFailure'
+}
+
+
+class FailedRecordsError(Exception):
+    """Firehose kept failing to ingest some records of a batch until the retries ran out"""
+    pass
+
+
+def is_retryable(e:Exception) -> bool:
+    """Throttling, service and connection errors, and records Firehose failed to ingest, are worth retrying"""
+    if isinstance(e, FailedRecordsError):
+        return True
+    import botocore.exceptions
+    if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return True
+    response = getattr(e, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    return response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES
+
 
 class Firehose:
 
-    def __init__(self, cloudwatch_logger, delivery_stream:str) -> None:
-        self.firehose = boto3.client('firehose')
+    def __init__(self, cloudwatch_logger, delivery_stream:str, buffered:bool=False, max_latency:float=60.0, max_record_bytes:int=MAX_RECORD_BYTES, max_retries:int=8, base_backoff:float=0.1, max_backoff:float=20.0, serializer:str='json', compression:str=None, compression_level:int=None, client=None, metrics:Metrics=None, record_filter:RecordFilter=None) -> None:
+        # Create the client in the background while the first page is fetched
+        self.firehose = client or LazyClient('firehose', warm=True)
         self.cloudwatch = cloudwatch_logger
+        self.metrics = metrics or Metrics()
         self.delivery_stream = delivery_stream
-        
-        # Track stats (not implemented)
+        self.max_record_bytes = max_record_bytes
+
+        # Posts are serialized to JSON lines, which are packed into records.
+        # Each record is compressed before it is sent if compression is set,
+        # so the destination must decompress it or store it compressed.
+        self.serializer = get_serializer(serializer)
+        self.compressor = get_compressor(compression, compression_level)
+
+        # Optionally drop unwanted posts and fields before serializing
+        self.record_filter = record_filter
+
+        # Retry failed records up to max_retries times per batch
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        # Track stats
         self.batches_sent = 0
         self.total_records_sent = 0
+        self.posts_sent = 0
+        self.failed_records = 0
+        self.retries = 0
+        self.throttles = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        # Buffer records across pages and send full batches. Records are
+        # Pushshift posts packed into Firehose records of up to
+        # max_record_bytes. A batch is sent when it is full or when the oldest
+        # buffered post has waited max_latency seconds.
+        self.buffered = buffered
+        self.max_latency = max_latency
+        self.lock = threading.RLock()
+        self.error = None
+        self._reset_buffer()
 
-    def send_result(self, data:list):
+        if self.buffered:
+            self.timer = threading.Thread(target=self._flush_on_timer, name='firehose-timer', daemon=True)
+            self.timer.start()
+
+
+    def send_result(self, data:list, callback=None):
         """Send Pushshift results to AWS firehose
 
         Args:
             data (list): A list of records
+            callback (callable, optional): Called without arguments once the
+                records have been delivered. In buffered mode this happens
+                when the batch containing them is flushed. Defaults to None.
 
         Returns:
             bool: Returns True if successful
         """
-        records = self._process_data(data)
-        put_records = self._put_batch(records)
+        lines = self.serialize(data)
+
+        if not self.buffered:
+            put_records = self.send_lines(lines)
+            if callback is not None:
+                callback()
+            return put_records
+
+        with self.lock:
+            self._raise_timer_error()
+
+            if self.buffer_started is None:
+                self.buffer_started = time.monotonic()
+
+            for line in lines:
+                self._add_to_buffer(line)
+
+            if callback is not None:
+                self.buffer_callbacks.append(callback)
+
+        return True
+
+
+    def flush(self):
+        """Send buffered records and run their callbacks"""
+        with self.lock:
+            self._raise_timer_error()
+            self._send_buffer()
+
+        return True
+
+
+    def close(self):
+        """Flush remaining records. Call when the crawl is finished."""
+        if self.buffered:
+            self.buffered = False
+            self.flush()
+
+
+    def send_lines(self, lines:list):
+        """Send encoded JSON lines in as few PutRecordBatch calls as possible
+
+        Args:
+            lines (list): Newline terminated, UTF-8 encoded JSON lines
+
+        Returns:
+            bool: True if successful
+        """
+        batch = []
+        batch_bytes = 0
+        for record in self._pack_records(lines):
+            if len(batch) == MAX_BATCH_RECORDS or batch_bytes + len(record) > MAX_BATCH_BYTES:
+                self._put_batch(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(record)
+            batch_bytes += len(record)
 
-        return put_records
+        if batch:
+            self._put_batch(batch)
 
+        return True
 
-    def _process_data(self, data:list) -> str:
-        """Process result data before sending to Firehose
+
+    def serialize(self, data:list) -> list:
+        """Filter records and convert them to JSON lines the way this sink sends them"""
+        return serialize_records(filter_records(data, self.record_filter, self.metrics), self.serializer, self.metrics)
+
+
+    def _pack_records(self, lines:list) -> list:
+        """Pack JSON lines into as few Firehose records as possible
 
         Args:
-            data (list): PushshiftResponse data
+            lines (list): Encoded JSON lines
 
         Returns:
-            str: A UTF-8 encoded string
+            list: Data blobs no larger than max_record_bytes
         """
-        # Convert records to a string
-        records = [json.dumps(record) for record in data]
-        records = '\n'.join(records) + '\n'
-        records = records.encode('utf-8')
+        records = []
+        record = []
+        record_bytes = 0
+        for line in lines:
+            self._check_line_size(line)
+            if record and record_bytes + len(line) > self.max_record_bytes:
+                records.append(b''.join(record))
+                record = []
+                record_bytes = 0
+            record.append(line)
+            record_bytes += len(line)
+
+        if record:
+            records.append(b''.join(record))
 
         return records
 
 
-    def _put_batch(self, records:str):
-        """Send batch of records to firehose
+    def _add_to_buffer(self, line:bytes):
+        """Add a JSON line to the open record, flushing first if the batch is full"""
+        self._check_line_size(line)
+
+        # Close the open record if the line doesn't fit
+        if self.buffer_lines and self.buffer_record_bytes + len(line) > self.max_record_bytes:
+            self.buffer_records.append(b''.join(self.buffer_lines))
+            self.buffer_lines = []
+            self.buffer_record_bytes = 0
+
+        # Send the batch if another record or the line won't fit
+        open_records = len(self.buffer_records) + (1 if self.buffer_lines else 0)
+        if (not self.buffer_lines and open_records >= MAX_BATCH_RECORDS) or self.buffer_bytes + len(line) > MAX_BATCH_BYTES:
+            self._send_buffer()
+            self.buffer_started = time.monotonic()
+
+        self.buffer_lines.append(line)
+        self.buffer_record_bytes += len(line)
+        self.buffer_bytes += len(line)
+
+
+    def _send_buffer(self):
+        """Send all buffered records as one batch and run their callbacks"""
+        records = self.buffer_records
+        if self.buffer_lines:
+            records = records + [b''.join(self.buffer_lines)]
+        callbacks = self.buffer_callbacks
+        self._reset_buffer()
+
+        if records:
+            self._put_batch(records)
+        for callback in callbacks:
+            callback()
+
+
+    def _check_line_size(self, line:bytes):
+        if len(line) > self.max_record_bytes:
+            message = f'ERROR: Post of {len(line)} bytes is larger than the Firehose record limit of {self.max_record_bytes} bytes.'
+            self.cloudwatch.log(message)
+            raise Exception(message)
+
+
+    def _reset_buffer(self):
+        self.buffer_records = []
+        self.buffer_lines = []
+        self.buffer_record_bytes = 0
+        self.buffer_bytes = 0
+        self.buffer_callbacks = []
+        self.buffer_started = None
+
+
+    def _flush_on_timer(self):
+        """Flush the buffer when the oldest buffered post is max_latency seconds old"""
+        while self.buffered:
+            time.sleep(min(1.0, self.max_latency))
+            with self.lock:
+                if self.error is not None or self.buffer_started is None:
+                    continue
+                if time.monotonic() - self.buffer_started < self.max_latency:
+                    continue
+                try:
+                    self.flush()
+                except Exception as e:
+                    self.error = e
+
+
+    def _raise_timer_error(self):
+        # Surface errors from the timer thread in the crawling thread
+        if self.error is not None:
+            raise self.error
+
+
+    def _put_batch(self, records:list):
+        """Send batch of records to firehose. Records that Firehose fails to
+        ingest are resent with jittered exponential backoff until the retry
+        budget runs out.
 
         Args:
-            records (str): Data blob to send
+            records (list): Data blobs to send
 
         Raises:
             e: Fail to send to Firehose
@@ -56,15 +282,88 @@ class Firehose:
         Returns:
             bool: True if successful
         """
-        try:
-            self.firehose.put_record_batch(
-                DeliveryStreamName=self.delivery_stream,
-                Records=[{'Data': records}]
-            )
+        # Each record holds several posts, one per line
+        posts = {i: record.count(b'\n') for i, record in enumerate(records)}
+        records = self._compress(records)
+        pending = list(range(len(records)))
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.metrics.timer('firehose_put'):
+                    response = self.firehose.put_record_batch(
+                        DeliveryStreamName=self.delivery_stream,
+                        Records=[{'Data': records[i]} for i in pending]
+                    )
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self.cloudwatch.log(f'ERROR: Failed to send results to firehose {self.delivery_stream}. Exception {e}')
+                    raise e
+                self.throttles += 1
+                self.retries += 1
+                self.metrics.count('firehose_throttles')
+                self.metrics.count('firehose_retries')
+                self._backoff(attempt)
+                continue
 
             self.batches_sent += 1
-        except Exception as e:
-            self.cloudwatch.log(f'ERROR: Failed to send results to firehose {self.delivery_stream}. Exception {e}')
-            raise e
-        else:
-            return True
\ No newline at end of file
+            self.metrics.count('firehose_batches')
+            if response.get('FailedPutCount', 0) == 0:
+                self._count_sent(pending, posts)
+                return True
+
+            # Only resend the records that failed
+            failed = []
+            for i, record_response in zip(pending, response['RequestResponses']):
+                if 'ErrorCode' not in record_response:
+                    continue
+                failed.append(i)
+                if record_response['ErrorCode'] in THROTTLE_ERROR_CODES:
+                    self.throttles += 1
+                    self.metrics.count('firehose_throttles')
+
+            self._count_sent(set(pending) - set(failed), posts)
+            self.failed_records += len(failed)
+            self.metrics.count('firehose_failed_records', len(failed))
+            pending = failed
+
+            if attempt < self.max_retries:
+                self.retries += 1
+                self.metrics.count('firehose_retries')
+                self._backoff(attempt)
+
+        message = f'ERROR: Failed to send {len(pending)} of {len(records)} records to firehose {self.delivery_stream} after {self.max_retries} retries.'
+        self.cloudwatch.log(message)
+        raise FailedRecordsError(message)
+
+
+    def _count_sent(self, sent:list, posts:dict):
+        """Count the records and the posts in them that Firehose ingested"""
+        sent_posts = sum(posts[i] for i in sent)
+        self.total_records_sent += len(sent)
+        self.posts_sent += sent_posts
+        self.metrics.count('firehose_records', len(sent))
+        self.metrics.count('firehose_posts', sent_posts)
+
+
+    def _compress(self, records:list) -> list:
+        """Compress records once, before any attempts to send them"""
+        self.bytes_in += sum(len(record) for record in records)
+        if self.compressor is not None:
+            with self.metrics.timer('compression'):
+                records = [self.compressor.compress(record) for record in records]
+        bytes_out = sum(len(record) for record in records)
+        self.bytes_out += bytes_out
+        self.metrics.count('bytes_sent', bytes_out)
+
+        return records
+
+
+    def _backoff(self, attempt:int):
+        """Sleep for a random time up to an exponentially growing limit ("full jitter")"""
+        time.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt)))
+
+
+    def stats(self) -> str:
+        ratio = round(self.bytes_in / self.bytes_out, 2) if self.bytes_out else None
+        return (f"Sent {self.total_records_sent} records ({self.posts_sent} posts) in {self.batches_sent} batches to {self.delivery_stream}. "
+                f"Failed records: {self.failed_records}. Retries: {self.retries}. Throttles: {self.throttles}. "
+                f"Bytes sent: {self.bytes_out} (compression ratio {ratio}).")
@@ -0,0 +1,271 @@
+# Follow subreddits for new posts, polling each at a rate that suits it
+
+import threading
+import time
+from datetime import datetime
+from functools import partial
+
+from utils.pushshift_api import NoResultsError, SeenIds
+
+# Post type prefix of follow checkpoints, so they don't clash with backfill checkpoints
+FOLLOW_POST_TYPE_PREFIX = 'follow-'
+
+
+class FollowedSubreddit:
+    """Cursor and polling schedule for one subreddit.
+
+    Every post with created_utc <= after has been delivered, as have the
+    posts in seen, which are at the second after that.
+    """
+    def __init__(self, name:str, after:int) -> None:
+        self.name = name
+        self.after = after
+        self.seen = SeenIds()
+
+        # Posts per second, or None until the first poll
+        self.rate = None
+        self.last_poll = None
+        self.next_poll = 0.0
+        self.posts = 0
+
+    def expected_posts(self, now:float) -> float:
+        """Posts expected to be waiting since the last poll"""
+        if self.rate is None:
+            return float('inf')
+        return self.rate * (now - self.last_poll)
+
+    def is_new(self, created_utc:int, id:str) -> bool:
+        return created_utc > self.after and (created_utc, id) not in self.seen
+
+
+class Follower:
+    """Tail subreddits for new posts, paging forward in time.
+
+    Each subreddit is polled at an interval that adapts to its post rate, so
+    that a poll returns about target_posts posts, within [min_interval,
+    max_interval] seconds. Quiet subreddits are polled together in one
+    comma-joined request. Each subreddit keeps its own cursor, which is
+    checkpointed once its posts have been delivered, so following resumes
+    where it left off. Delivered ranges are also recorded in the coverage of
+    each subreddit and of the whole set of subreddits, like backfill crawls,
+    so a crawl without --follow doesn't fetch them again.
+    """
+
+    def __init__(self, api, firehose, metadata_log, cloudwatch_logger, min_interval:float=30.0, max_interval:float=900.0, target_posts:int=50, max_batch:int=25, smoothing:float=0.3) -> None:
+        self.api = api
+        self.firehose = firehose
+        self.metadata_log = metadata_log
+        self.cloudwatch = cloudwatch_logger
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_posts = target_posts
+        self.max_batch = max_batch
+        self.smoothing = smoothing
+
+        self.subreddits = []
+        self.polls = 0
+        self.skipped_seconds = 0
+
+        # Newest created_utc delivered for each subreddit, and for the whole
+        # set. The set's coverage doesn't reach back past incomplete pages.
+        self.delivered = {}
+        self.delivered_all = None
+        self.incomplete_until = None
+        self.lock = threading.Lock()
+
+
+    def run(self, post_type:str, subreddits:list, after:int=None, size:int=100, max_requests:int=None):
+        """Poll for new posts until stopped.
+
+        Args:
+            post_type (str): Submissions or comments.
+            subreddits (list): List of subreddits to follow.
+            after (int, optional): Start from this created_utc for subreddits without a
+                follow checkpoint. Defaults to the newest post crawled for these subreddits, or now.
+            size (int, optional): Number of results per page. Defaults to 100.
+            max_requests (int, optional): Stop after this many requests, or once every
+                subreddit has been polled and none is due. For test runs. Defaults to None.
+        """
+        self.post_type = post_type
+        self.size = size
+        start = self._start_after(post_type, subreddits, after)
+        self.subreddits = [FollowedSubreddit(name, self._checkpointed_after(post_type, name, start)) for name in subreddits]
+        self.delivered = {s.name: s.after for s in self.subreddits}
+        self.delivered_all = min(self.delivered.values())
+        self.cloudwatch.log(f"Following {len(self.subreddits)} subreddits: " + ', '.join(f"{s.name} after {s.after}" for s in self.subreddits))
+
+        while max_requests is None or self.api.request_count < max_requests:
+            now = time.time()
+            batch = self._next_batch(now)
+            if not batch:
+                if max_requests is not None:
+                    # Test runs stop once every subreddit has been polled,
+                    # rather than waiting up to max_interval for the next poll
+                    break
+                time.sleep(max(0.0, min(s.next_poll for s in self.subreddits) - now))
+                continue
+
+            self._poll(batch, max_requests)
+            if self.polls % 100 == 0:
+                self.cloudwatch.log(self.progress())
+
+        self.cloudwatch.log("Stopping test.")
+
+
+    def _start_after(self, post_type:str, subreddits:list, after:int) -> int:
+        """Where to start following subreddits that haven't been followed before"""
+        if after is not None:
+            return after
+
+        # Continue from the newest post delivered by backfill crawls
+        coverage = self.metadata_log.get_coverage(post_type, subreddits)
+        if coverage:
+            return coverage[-1][1]
+        checkpoint = self.metadata_log.get_checkpoint(post_type, subreddits)
+        if checkpoint is not None:
+            return checkpoint['last_result_timestamps']['max_created_utc']
+
+        return int(datetime.utcnow().timestamp())
+
+
+    def _checkpointed_after(self, post_type:str, subreddit:str, default:int) -> int:
+        checkpoint = self.metadata_log.get_checkpoint(FOLLOW_POST_TYPE_PREFIX + post_type, [subreddit])
+        if checkpoint is None:
+            return default
+        return checkpoint['last_result_timestamps']['max_created_utc']
+
+
+    def _next_batch(self, now:float) -> list:
+        """Subreddits to poll now. A busy subreddit is polled on its own. Quiet
+        subreddits are polled together with others that are due soon, as long
+        as about target_posts are expected between them."""
+        due = sorted([s for s in self.subreddits if s.next_poll <= now], key=lambda s: s.next_poll)
+        if not due:
+            return []
+
+        batch = [due[0]]
+        expected = due[0].expected_posts(now)
+        if expected >= self.target_posts:
+            return batch
+
+        soon = sorted([s for s in self.subreddits if s is not due[0] and s.next_poll <= now + self.min_interval], key=lambda s: s.next_poll)
+        for subreddit in soon:
+            if len(batch) >= self.max_batch:
+                break
+            if expected + subreddit.expected_posts(now) > self.target_posts:
+                continue
+            batch.append(subreddit)
+            expected += subreddit.expected_posts(now)
+
+        return batch
+
+
+    def _poll(self, batch:list, max_requests:int=None):
+        """Page forward through new posts in the batch's subreddits"""
+        by_name = {s.name.lower(): s for s in batch}
+        after = min(s.after for s in batch)
+        started = time.time()
+        new_posts = {s.name: 0 for s in batch}
+        self.polls += 1
+
+        while True:
+            try:
+                result = self.api.get(post_type=self.post_type, subreddits=[s.name for s in batch], after=after, size=self.size, sort='asc')
+            except NoResultsError:
+                break
+            page_size = len(result.data)
+
+            # Drop posts each subreddit has already delivered
+            keep = []
+            for i, (created_utc, id, name) in enumerate(zip(result.created_utcs, result.ids, result.subreddits)):
+                subreddit = by_name.get((name or '').lower())
+                if subreddit is None or subreddit.is_new(created_utc, id):
+                    keep.append(i)
+                    if subreddit is not None:
+                        new_posts[subreddit.name] += 1
+            oldest = result.min_created_at
+            newest = result.max_created_at
+            result.select(keep)
+
+            if not keep and page_size >= self.size and oldest == newest:
+                # The page is full of posts from one second that have already
+                # been returned, so paging can't get past that second
+                self.cloudwatch.log(f"WARNING: More than {page_size} posts at {newest}. Skipping the rest of that second. Subreddits: {list(by_name)}.")
+                self.skipped_seconds += 1
+                newest += 1
+
+            # All posts older than the newest second on the page have been
+            # returned. Posts at that second may continue on the next page.
+            for subreddit in batch:
+                if subreddit.after < newest - 1:
+                    subreddit.after = newest - 1
+                if subreddit.after == newest - 1 and subreddit.seen.second != newest:
+                    subreddit.seen = SeenIds(newest)
+            for created_utc, id, name in zip(result.created_utcs, result.ids, result.subreddits):
+                subreddit = by_name.get((name or '').lower())
+                if created_utc == newest and subreddit is not None and subreddit.seen.second == newest:
+                    subreddit.seen.add(id)
+
+            checkpoint = partial(self._checkpoint, {s.name: s.after for s in batch}, result.incomplete is not None)
+            self.firehose.send_result(result.take(), callback=checkpoint)
+
+            if page_size < self.size or (max_requests is not None and self.api.request_count >= max_requests):
+                break
+            after = newest - 1
+
+        self._reschedule(batch, new_posts, started)
+
+
+    def _reschedule(self, batch:list, new_posts:dict, now:float):
+        """Update each subreddit's post rate and schedule its next poll"""
+        for subreddit in batch:
+            count = new_posts[subreddit.name]
+            subreddit.posts += count
+            if subreddit.rate is None:
+                # First poll: rate since the cursor
+                elapsed = max(now - subreddit.after, 1.0) if count else self.max_interval
+                subreddit.rate = count / elapsed
+            else:
+                elapsed = max(now - subreddit.last_poll, 1.0)
+                subreddit.rate = self.smoothing * count / elapsed + (1 - self.smoothing) * subreddit.rate
+            subreddit.last_poll = now
+
+            interval = self.target_posts / subreddit.rate if subreddit.rate > 0 else self.max_interval
+            subreddit.next_poll = now + min(self.max_interval, max(self.min_interval, interval))
+
+
+    def _checkpoint(self, cursors:dict, incomplete:bool=False):
+        """Save each subreddit's cursor and coverage once its posts have been delivered
+
+        Args:
+            cursors (dict): Newest created_utc delivered, by subreddit.
+            incomplete (bool, optional): The page may be missing posts. Its range
+                is left out of the coverage and the cursors aren't saved. Defaults to False.
+        """
+        retrieved = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self.lock:
+            for name, after in cursors.items():
+                if after <= self.delivered[name]:
+                    continue
+                if incomplete:
+                    self.incomplete_until = max(after, self.incomplete_until or after)
+                else:
+                    self.metadata_log.add_coverage(self.delivered[name] + 1, after, self.post_type, [name])
+                    self.metadata_log.set_checkpoint(FOLLOW_POST_TYPE_PREFIX + self.post_type, [name], {
+                        'last_result_timestamps': {'max_created_utc': after, 'min_created_utc': None},
+                        'retrieved_from_pushshift': retrieved
+                    })
+                self.delivered[name] = after
+
+            # Posts up to the oldest cursor have been delivered for every subreddit
+            delivered_all = min(self.delivered.values())
+            if delivered_all > self.delivered_all:
+                lo = max(self.delivered_all, self.incomplete_until or self.delivered_all) + 1
+                self.metadata_log.add_coverage(lo, delivered_all, self.post_type, list(self.delivered))
+                self.delivered_all = delivered_all
+
+
+    def progress(self) -> str:
+        busiest = sorted(self.subreddits, key=lambda s: -(s.rate or 0))[:5]
+        rates = ', '.join(f"{s.name} {round((s.rate or 0) * 3600, 1)}/h" for s in busiest)
+        return f"Followed {len(self.subreddits)} subreddits in {self.polls} polls. Skipped {self.skipped_seconds} crowded seconds. {self.api.progress()} Busiest: {rates}."
@@ -0,0 +1,248 @@
+# Run many crawl jobs on one worker pool with a shared rate limit
+
+import heapq
+import itertools
+import json
+import threading
+from datetime import datetime
+from functools import partial
+
+from utils.pushshift_api import NoResultsError
+
+
+class Job:
+    """One post type and set of subreddits to crawl into a delivery stream.
+
+    A job is crawled one page at a time, so the scheduler can interleave many
+    jobs on a few workers. Only the gaps in the job's coverage are crawled,
+    newest first, and each page is checkpointed once its sink has delivered it.
+    """
+
+    def __init__(self, name:str, post_type:str, subreddits:list, firehose:str=None, after:int=None, before:int=None, priority:int=0, size:int=100) -> None:
+        self.name = name
+        self.post_type = post_type
+        self.subreddits = subreddits
+        self.firehose = firehose
+        self.after = after
+        self.before = before
+        self.priority = priority
+        self.size = size
+
+        # Crawl state
+        self.windows = []
+        self.result = None
+        self.last_result = None
+        self.done = False
+        self.error = None
+
+        # Track stats
+        self.pages = 0
+        self.posts = 0
+        self.started = None
+        self.finished = None
+
+
+    @classmethod
+    def from_dict(cls, d:dict, index:int):
+        for key in ['post_type', 'subreddits']:
+            if key not in d:
+                raise Exception(f"Job {index} in job file is missing '{key}'")
+        if d['post_type'] not in ['submissions', 'comments']:
+            raise Exception(f"Job {index} in job file has unknown post type {d['post_type']}")
+        subreddits = d['subreddits']
+        if not isinstance(subreddits, list) or not subreddits or not all(isinstance(s, str) and s for s in subreddits):
+            raise ValueError(f"Job {d.get('name') or index} in job file needs 'subreddits' as a list of subreddit names, got {subreddits!r}")
+
+        return cls(
+            name=d.get('name') or f"{d['post_type']}:{','.join(d['subreddits'])}",
+            post_type=d['post_type'],
+            subreddits=d['subreddits'],
+            firehose=d.get('firehose'),
+            after=d.get('after'),
+            before=d.get('before'),
+            priority=d.get('priority', 0),
+            size=d.get('size', 100))
+
+
+    def plan(self, metadata_log, no_resume:bool=False):
+        """Find the time windows to crawl from the job's coverage"""
+        self.windows = [(self.before, self.after)]
+        if no_resume or not metadata_log.get_coverage(self.post_type, self.subreddits):
+            return
+
+        now = int(datetime.utcnow().timestamp())
+        gaps = metadata_log.uncovered(
+            0 if self.after is None else self.after + 1,
+            now if self.before is None else self.before - 1,
+            self.post_type, self.subreddits)
+        self.windows = [(hi + 1, None if lo <= 0 else lo - 1) for lo, hi in gaps]
+
+
+    def step(self, api, sink, metadata_log):
+        """Fetch the next page and send it to the sink
+
+        Returns:
+            bool: True if the job has more pages to crawl
+        """
+        if self.started is None:
+            self.started = datetime.utcnow()
+
+        if not self.windows:
+            self._finish()
+            return False
+
+        try:
+            if self.result is None:
+                before, after = self.windows[0]
+                result = api.get(post_type=self.post_type, subreddits=self.subreddits, before=before, after=after, size=self.size)
+            else:
+                result = api.get_next(self.result)
+        except NoResultsError as e:
+            # Record the end of the window once the pages before it are delivered
+            sink.send_result([], callback=partial(metadata_log.add_end_of_results, e.request_params, self.post_type, self.subreddits, incomplete=e.incomplete))
+            self.windows.pop(0)
+            self.result = None
+            if not self.windows:
+                self._finish()
+            return not self.done
+
+        self.result = result
+        self.last_result = result
+        self.pages += 1
+        self.posts += len(result.data)
+        sink.send_result(result.take(), callback=partial(metadata_log.add_result_metadata, result, self.post_type, self.subreddits))
+
+        return True
+
+
+    def _finish(self):
+        self.done = True
+        self.finished = datetime.utcnow()
+
+
+    def progress(self) -> str:
+        state = 'failed' if self.error is not None else 'done' if self.done else 'crawling' if self.started else 'waiting'
+        cursor = None if self.result is None else self.result.min_created_at
+        return f"{self.name}: {state}. {self.pages} pages, {self.posts} posts. {len(self.windows)} windows left. Cursor: {cursor}."
+
+
+class JobScheduler:
+    """Crawl several jobs concurrently with one rate limit.
+
+    Workers take the waiting job with the highest priority, fetch one page
+    and put it back. Jobs with the same priority take turns, the one with the
+    fewest pages going first, so no job starves the others. A job is only
+    worked on by one worker at a time since its cursor is sequential. All
+    workers share one PushshiftAPI instance and so one rate limit and
+    connection pool. A job that fails is logged and the others carry on.
+    """
+
+    def __init__(self, api, sinks:dict, metadata_log, cloudwatch_logger, num_workers:int=4, progress_interval:int=100) -> None:
+        self.api = api
+        self.sinks = sinks
+        self.metadata_log = metadata_log
+        self.cloudwatch = cloudwatch_logger
+        self.num_workers = num_workers
+        self.progress_interval = progress_interval
+
+        self.lock = threading.Condition()
+        self.queue = []
+        self.in_flight = 0
+        self.pages = 0
+        self.counter = itertools.count()
+        self.jobs = []
+        self.max_requests = None
+        self.stopped = False
+
+
+    @staticmethod
+    def read_job_file(filename:str) -> list:
+        """Read jobs from a JSON file holding a list of job objects"""
+        with open(filename, 'r') as f:
+            jobs = json.load(f)
+        if not isinstance(jobs, list):
+            raise Exception(f"Job file {filename} should contain a list of jobs")
+
+        return [Job.from_dict(d, i) for i, d in enumerate(jobs)]
+
+
+    def run(self, jobs:list, no_resume:bool=False, max_requests:int=None) -> list:
+        """Crawl all jobs until each has run out of results.
+
+        Args:
+            jobs (list): Jobs to crawl. Each job's firehose must be a key of sinks.
+            no_resume (bool, optional): Crawl each job's whole range again. Defaults to False.
+            max_requests (int, optional): Stop after this many requests. Defaults to None.
+
+        Returns:
+            list: The jobs, with their stats.
+        """
+        self.jobs = jobs
+        self.max_requests = max_requests
+        for job in jobs:
+            job.plan(self.metadata_log, no_resume)
+            self._push(job)
+        self.cloudwatch.log(f"Scheduling {len(jobs)} jobs on {self.num_workers} workers.")
+
+        workers = [threading.Thread(target=self._worker, name=f'job-{i}', daemon=True) for i in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        return jobs
+
+
+    def _push(self, job:Job):
+        """Queue a job. Call while holding the lock or before workers start."""
+        heapq.heappush(self.queue, (-job.priority, job.pages, next(self.counter), job))
+
+
+    def _next_job(self) -> Job:
+        """Wait for the next job to work on. Returns None when all jobs are finished."""
+        with self.lock:
+            while True:
+                if self.stopped:
+                    return None
+                if self.queue:
+                    job = heapq.heappop(self.queue)[-1]
+                    self.in_flight += 1
+                    return job
+                if self.in_flight == 0:
+                    return None
+                self.lock.wait()
+
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+
+            more = False
+            try:
+                more = job.step(self.api, self.sinks[job.firehose], self.metadata_log)
+            except Exception as e:
+                job.error = e
+                self.cloudwatch.log(f"ERROR: Job {job.name} failed. Exception {e}")
+
+            with self.lock:
+                self.in_flight -= 1
+                self.pages += 1
+                if more:
+                    self._push(job)
+                self._log_progress()
+                if self.max_requests is not None and self.api.request_count >= self.max_requests and not self.stopped:
+                    self.cloudwatch.log("Stopping test.")
+                    self.stopped = True
+                self.lock.notify_all()
+
+
+    def _log_progress(self):
+        # Record progress of every job at regular intervals. Call while holding the lock.
+        if self.pages % self.progress_interval == 0:
+            self.cloudwatch.log(self.progress())
+
+
+    def progress(self) -> str:
+        return '\n'.join([self.api.progress()] + [job.progress() for job in self.jobs])
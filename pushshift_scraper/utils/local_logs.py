@@ -2,70 +2,267 @@
 
 import os
 import json
+import sqlite3
+import logging
+import threading
 from datetime import datetime
-from collections import deque
+from logging.handlers import RotatingFileHandler
+
+from utils.metrics import Metrics
+
+# Post type used for checkpoints imported from metadata logs written before
+# checkpoints were keyed by post type
+LEGACY_POST_TYPE = '*'
+
+
+def checkpoint_key(post_type:str, subreddits:list) -> str:
+    """Canonical checkpoint key, so the order and case of subreddits don't matter"""
+    return f"{post_type}:{','.join(sorted(set(s.lower() for s in subreddits)))}"
+
 
 class MetadataLog:
-    def __init__(self, cloudwatch_logger, filename:str, filter_subreddits:list=None) -> None:
+    """Checkpoints and metadata history for the crawler.
+
+    The resume cursor for each (post_type, subreddits) pair is kept in a SQLite
+    checkpoint store, so looking it up at startup doesn't depend on how long
+    the crawler has been running. The metadata of every page is also appended
+    to a size-rotated history log for debugging, which can be turned off.
+
+    Pushshift can take a while to ingest new posts, so coverage is never
+    recorded past ingest_lag seconds ago. The latest posts are searched for
+    again by the next crawl.
+    """
+
+    def __init__(self, cloudwatch_logger, filename:str, filter_subreddits:list=None, post_type:str=None, checkpoint_filename:str=None, history:bool=True, history_max_bytes:int=100 * 1024 * 1024, history_backups:int=5, metrics:Metrics=None, ingest_lag:int=0) -> None:
         self.cloudwatch = cloudwatch_logger
+        self.metrics = metrics or Metrics()
+        self.ingest_lag = ingest_lag
         self.filename = f'{filename}'
+        self.checkpoint_filename = checkpoint_filename or f'{os.path.splitext(self.filename)[0]}.db'
+        self.subreddits = filter_subreddits
+        self.post_type = post_type
+        self.lock = threading.Lock()
 
         self.filtered_log_last_line = None
         self.max_created_utc = None
         self.min_created_utc = None
 
-        # If file exists, get timestamps
-        if self._log_exists():
-            self.cloudwatch.log(f"Local log file found")
-
-            # Get last line mentioning subreddits from log. Return None if subreddits not in log
-            self.filtered_log_last_line = self._filtered_log_last_line(filter_subreddits)
-
-            # If subreddits found in log
-            if self.filtered_log_last_line is not None:
-
-                # Set timestamps
-                timestamps = self.filtered_log_last_line.get('last_result_timestamps')
-                self.max_created_utc = timestamps.get('max_created_utc')
-                self.min_created_utc = timestamps.get('min_created_utc')
-                
-                self.cloudwatch.log(f"Found subreddits {filter_subreddits} in local log. min_created_utc={self.min_created_utc}; max_created_utc={self.max_created_utc}\nLast filtered line from local log file is {self.filtered_log_last_line}.")
-            else:
-                self.filtered_log_last_line = None
+        self.db = sqlite3.connect(self.checkpoint_filename, check_same_thread=False)
+        self._create_tables()
+
+        # Import checkpoints from a metadata log written by an older version
+        if not self._legacy_log_imported():
+            self._import_legacy_log()
+
+        # Get checkpoint for subreddits. Returns None if subreddits haven't been crawled
+        if filter_subreddits is not None:
+            self.filtered_log_last_line = self.get_checkpoint(post_type, filter_subreddits)
+
+        # If subreddits found in checkpoints
+        if self.filtered_log_last_line is not None:
+
+            # Set timestamps
+            timestamps = self.filtered_log_last_line.get('last_result_timestamps')
+            self.max_created_utc = timestamps.get('max_created_utc')
+            self.min_created_utc = timestamps.get('min_created_utc')
+
+            self.cloudwatch.log(f"Found subreddits {filter_subreddits} in checkpoints. min_created_utc={self.min_created_utc}; max_created_utc={self.max_created_utc}\nLast checkpoint is {self.filtered_log_last_line}.")
         else:
-            print("Local log file does not exist")
+            print("No checkpoint found")
+
+        # Verbose metadata history
+        self.history = None
+        if history:
+            self.history = logging.getLogger(f'metadata_history.{self.filename}')
+            self.history.setLevel(logging.INFO)
+            self.history.propagate = False
+            if not self.history.handlers:
+                handler = RotatingFileHandler(self.filename, maxBytes=history_max_bytes, backupCount=history_backups, encoding='utf-8')
+                self.history.addHandler(handler)
+
+
+    def _create_tables(self):
+        with self.lock, self.db:
+            # WAL with synchronous=NORMAL keeps checkpoint writes to one append
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    key TEXT PRIMARY KEY,
+                    metadata TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )''')
+            # Time ranges (inclusive created_utc bounds) that have been fully delivered
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS coverage (
+                    key TEXT NOT NULL,
+                    lo INTEGER NOT NULL,
+                    hi INTEGER NOT NULL,
+                    PRIMARY KEY (key, lo)
+                )''')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    name TEXT PRIMARY KEY,
+                    value TEXT
+                )''')
+
+
+    def get_checkpoint(self, post_type:str, subreddits:list) -> dict:
+        """Get the last metadata checkpointed for a post type and set of subreddits
+
+        Args:
+            post_type (str): Submissions or comments.
+            subreddits (list): List of subreddits.
+
+        Returns:
+            dict: Metadata of the last page checkpointed, or None.
+        """
+        keys = [checkpoint_key(post_type, subreddits), checkpoint_key(LEGACY_POST_TYPE, subreddits)]
+        with self.lock:
+            for key in keys:
+                row = self.db.execute('SELECT metadata FROM checkpoints WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    return json.loads(row[0])
+
+        return None
+
+
+    def set_checkpoint(self, post_type:str, subreddits:list, metadata:dict):
+        key = checkpoint_key(post_type, subreddits)
+        with self.metrics.timer('checkpoint_write'), self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO checkpoints (key, metadata, updated_at) VALUES (?, ?, ?)',
+                (key, json.dumps(metadata), metadata['retrieved_from_pushshift']))
+
+        return True
+
+
+    def add_coverage(self, lo:int, hi:int, post_type:str=None, subreddits:list=None):
+        """Record that all posts with lo <= created_utc <= hi have been delivered.
+        Overlapping and adjacent ranges are merged. Ranges are cut off at
+        ingest_lag seconds ago, as Pushshift may not have all posts after that yet."""
+        hi = min(hi, int(datetime.utcnow().timestamp()) - self.ingest_lag)
+        if hi < lo:
+            return False
+
+        key = checkpoint_key(post_type or self.post_type, subreddits or self.subreddits)
+        with self.metrics.timer('coverage_write'), self.lock, self.db:
+            rows = self.db.execute(
+                'SELECT lo, hi FROM coverage WHERE key = ? AND lo <= ? AND hi >= ?',
+                (key, hi + 1, lo - 1)).fetchall()
+            self.db.execute(
+                'DELETE FROM coverage WHERE key = ? AND lo <= ? AND hi >= ?',
+                (key, hi + 1, lo - 1))
+            lo = min([lo] + [row[0] for row in rows])
+            hi = max([hi] + [row[1] for row in rows])
+            self.db.execute('INSERT INTO coverage (key, lo, hi) VALUES (?, ?, ?)', (key, lo, hi))
+
+        return True
+
+
+    def get_coverage(self, post_type:str=None, subreddits:list=None) -> list:
+        """Get delivered time ranges as a list of inclusive (lo, hi) tuples, oldest first"""
+        key = checkpoint_key(post_type or self.post_type, subreddits or self.subreddits)
+        with self.lock:
+            return self.db.execute('SELECT lo, hi FROM coverage WHERE key = ? ORDER BY lo', (key,)).fetchall()
+
+
+    def uncovered(self, lo:int, hi:int, post_type:str=None, subreddits:list=None) -> list:
+        """Get the gaps in coverage between lo and hi
+
+        Args:
+            lo (int): Earliest created_utc wanted (inclusive).
+            hi (int): Latest created_utc wanted (inclusive).
+            post_type (str, optional): Defaults to the log's post type.
+            subreddits (list, optional): Defaults to the log's subreddits.
+
+        Returns:
+            list: Inclusive (lo, hi) tuples that haven't been delivered, newest first.
+        """
+        gaps = []
+        start = lo
+        for covered_lo, covered_hi in self.get_coverage(post_type, subreddits):
+            if covered_hi < start:
+                continue
+            if covered_lo > hi:
+                break
+            if covered_lo > start:
+                gaps.append((start, covered_lo - 1))
+            start = covered_hi + 1
+        if start <= hi:
+            gaps.append((start, hi))
+
+        return list(reversed(gaps))
+
+
+    def add_end_of_results(self, request_params:dict, post_type:str=None, subreddits:list=None, incomplete:bool=False):
+        """Record coverage for a query that returned no results
+
+        Args:
+            request_params (dict): Params of the query. The range between 'after' and 'before' is covered.
+            incomplete (bool, optional): The search timed out or lost shards, so
+                there may be posts in the range and nothing is recorded. Defaults to False.
+        """
+        if incomplete:
+            return False
+
+        after = request_params.get('after')
+        before = request_params.get('before')
+        lo = 0 if after is None else after + 1
+        hi = int(datetime.utcnow().timestamp()) if before is None else before - 1
+
+        return self.add_coverage(lo, hi, post_type, subreddits)
+
 
     def _log_exists(self):
         return os.path.exists(self.filename)
 
+    def _legacy_marker(self) -> str:
+        """Settings row marking this log as imported. Each log file gets its own."""
+        return f'legacy_log_imported:{os.path.abspath(self.filename)}'
+
+    def _legacy_log_imported(self) -> bool:
+        with self.lock:
+            row = self.db.execute('SELECT value FROM settings WHERE name = ?', (self._legacy_marker(),)).fetchone()
+            # Older versions kept one marker holding the name of the log they imported
+            legacy = self.db.execute("SELECT value FROM settings WHERE name = 'legacy_log_imported'").fetchone()
+        return row is not None or (legacy is not None and legacy[0] == self.filename)
+
+    def _import_legacy_log(self):
+        """Scan the metadata log once and checkpoint the last line for each set of subreddits"""
+        last_lines = {}
+        if self._log_exists():
+            self.cloudwatch.log(f"Importing checkpoints from local log {self.filename}. This only happens once.")
+            for line in self._read_log():
+                subreddits = line.get('subreddit')
+                if isinstance(subreddits, list):
+                    last_lines[checkpoint_key(LEGACY_POST_TYPE, subreddits)] = line
+
+        with self.lock, self.db:
+            for key, line in last_lines.items():
+                self.db.execute(
+                    'INSERT OR IGNORE INTO checkpoints (key, metadata, updated_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(line), line.get('retrieved_from_pushshift', '')))
+            self.db.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (self._legacy_marker(), self.filename))
+
+        if last_lines:
+            self.cloudwatch.log(f"Imported {len(last_lines)} checkpoints from {self.filename}.")
+
     def _read_log(self):
         with open(self.filename, 'r') as f:
             for line in f:
-                yield json.loads(line)
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
 
-    def _filter_log(self, log, subreddits):
-        for line in log:
-            if line['subreddit'] == subreddits:
-                yield line
-
-    def _filtered_log_last_line(self, filter_subreddits:list) -> dict:
-        """Get last line of filtered log"""
-        filtered_log = self._read_log()
-        filtered_log = self._filter_log(filtered_log, filter_subreddits)
-        filtered_log_last_line = deque(filtered_log, maxlen=1)
-
-        if filtered_log_last_line:
-            return filtered_log_last_line.pop()
-        else:
-            return None
-    
     def _write_to_log(self, json_string:dict):
-        with open(self.filename, 'a+', encoding='utf-8') as outfile:
-            outfile.write(json.dumps(json_string) + '\n')
+        if self.history is not None:
+            self.history.info(json.dumps(json_string))
 
         return True
 
-    def add_result_metadata(self, result):
+    def add_result_metadata(self, result, post_type:str=None, subreddits:list=None, coverage:tuple=None):
         """Write metadata from PushshiftResponse object to metadata log. This
         function adds the min and max created_at post dates from the result to
         the metadata. This is helpful when the scraper needs to restart so it
@@ -73,9 +270,15 @@ class MetadataLog:
 
         Args:
             result (PushshiftResponse): The PushshiftResponse object containing metadata to write.
+            post_type (str, optional): Post type to checkpoint. Defaults to the log's post type.
+            subreddits (list, optional): Subreddits to checkpoint. Defaults to the log's subreddits.
+            coverage (tuple, optional): Inclusive (lo, hi) range of created_utc the
+                page completes. Defaults to from the second after the oldest post
+                up to the query's 'before'. The oldest second is completed by the
+                next page, which overlaps it.
 
         Returns:
-            bool: True
+            bool: True, or False if the page was incomplete and only written to the history.
         """
         metadata = result.metadata
 
@@ -88,24 +291,22 @@ class MetadataLog:
         # Add current time for debugging purposes
         metadata['retrieved_from_pushshift'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
 
-        # Append metadata to file
-        self._write_to_log(metadata)
+        # A page that timed out or lost shards may be missing posts, so its
+        # range is left to be crawled again
+        if getattr(result, 'incomplete', None) is not None:
+            self._write_to_log(metadata)
+            return False
 
-        return True
- 
-
-    def _get_last_line(self):
-        """Parse and return last line of log file
-
-        Returns:
-            dict: Last line of file in json format.
-        """
-        with open(self.filename, 'rb') as f:
-            f.seek(-2, os.SEEK_END)
-
-            while f.read(1) != b'\n':
-                f.seek(-2, os.SEEK_CUR)
+        # Update checkpoint and append metadata to history
+        post_type = post_type or self.post_type
+        subreddits = subreddits or self.subreddits or metadata.get('subreddit')
+        self.set_checkpoint(post_type, subreddits, metadata)
+        self._write_to_log(metadata)
 
-            last_line = f.readline().decode()
+        # Record the time range the page covers
+        if coverage is None:
+            before = getattr(result, 'request_params', {}).get('before')
+            coverage = (result.min_created_at + 1, result.max_created_at if before is None else before - 1)
+        self.add_coverage(coverage[0], coverage[1], post_type, subreddits)
 
-        return json.loads(last_line)
+        return True
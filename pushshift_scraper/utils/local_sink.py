@@ -0,0 +1,265 @@
+# Write posts to local NDJSON files instead of Firehose, for dev runs and
+# bulk backfills that are uploaded to S3 afterwards
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from utils.metrics import Metrics
+from utils.record_filter import RecordFilter
+from utils.serialization import filter_records, get_serializer, get_compressor, serialize_records
+
+SINKS = ['firehose', 'local']
+OPEN_SUFFIX = '.open'
+UNKNOWN_PARTITION = 'unknown'
+
+# created_utc of a serialized post. Posts that are dicts are partitioned
+# without looking at their JSON.
+CREATED_UTC = re.compile(rb'"created_utc": ?(\d+)')
+
+
+class LocalSink:
+    """Local file sink with the same interface as Firehose.
+
+    Posts are written as JSON lines to files partitioned by the date of
+    their created_utc, using partition_format (strftime, in UTC). Lines are
+    buffered in memory and written when buffer_bytes are waiting or the
+    oldest has waited max_latency seconds, which a timer thread checks while
+    the crawl is waiting. With compression, each write is
+    one gzip member or zstd frame, so files can be read with the usual tools
+    as they grow. Files are named <prefix>-<run>-<n>.ndjson[.gz|.zst] and
+    have an .open suffix until they reach max_file_bytes or the sink is
+    closed, so only finished files need to be uploaded. A page's callback
+    runs once its posts have been written and fsynced. One sink can be
+    shared between threads.
+    """
+
+    def __init__(self, cloudwatch_logger, directory:str, prefix:str='posts', partition_format:str='year=%Y/month=%m/day=%d', max_file_bytes:int=128 * 1024 * 1024, buffer_bytes:int=8 * 1024 * 1024, max_latency:float=60.0, max_open_files:int=32, serializer:str='json', compression:str='gzip', compression_level:int=None, metrics:Metrics=None, record_filter:RecordFilter=None) -> None:
+        self.cloudwatch = cloudwatch_logger
+        self.metrics = metrics or Metrics()
+        self.directory = directory
+        self.prefix = prefix
+        self.partition_format = partition_format
+        self.max_file_bytes = max_file_bytes
+        self.buffer_bytes = buffer_bytes
+        self.max_latency = max_latency
+        self.max_open_files = max_open_files
+
+        self.serializer = get_serializer(serializer)
+        self.compressor = get_compressor(compression, compression_level)
+        self.extension = '.ndjson' + {None: '', 'gzip': '.gz', 'zstd': '.zst'}[getattr(self.compressor, 'name', None)]
+
+        # Optionally drop unwanted posts and fields before serializing
+        self.record_filter = record_filter
+
+        # Files are named after the run so restarts don't append to old files
+        self.run = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        self.next_file = 0
+
+        # Lines waiting to be written, by partition
+        self.lock = threading.RLock()
+        self.buffer = {}
+        self.buffered_bytes = 0
+        self.buffer_started = None
+        self.buffer_callbacks = []
+        self.error = None
+        self.closed = False
+
+        # Open files by partition, least recently used first
+        self.files = OrderedDict()
+
+        # Track stats
+        self.records_written = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.files_finished = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+
+        self.timer = threading.Thread(target=self._flush_on_timer, name='local-sink-timer', daemon=True)
+        self.timer.start()
+
+
+    def send_result(self, data:list, callback=None):
+        """Buffer Pushshift results and write them once enough are waiting
+
+        Args:
+            data (list): A list of records
+            callback (callable, optional): Called without arguments once the
+                records have been written and fsynced. Defaults to None.
+
+        Returns:
+            bool: Returns True if successful
+        """
+        data = filter_records(data, self.record_filter, self.metrics)
+        lines = serialize_records(data, self.serializer, self.metrics)
+        partitions = [self._partition(record.get('created_utc') if isinstance(record, dict) else None, line) for record, line in zip(data, lines)]
+
+        with self.lock:
+            self._raise_timer_error()
+            self._add_to_buffer(lines, partitions)
+            if callback is not None:
+                self.buffer_callbacks.append(callback)
+
+            if self.buffered_bytes >= self.buffer_bytes or time.monotonic() - self.buffer_started >= self.max_latency:
+                self.flush()
+
+        return True
+
+
+    def send_lines(self, lines:list):
+        """Write encoded JSON lines straight away"""
+        partitions = [self._partition(None, line) for line in lines]
+        with self.lock:
+            self._add_to_buffer(lines, partitions)
+            return self.flush()
+
+
+    def flush(self):
+        """Write buffered lines, fsync them and run their callbacks"""
+        with self.lock:
+            self._raise_timer_error()
+            buffer = self.buffer
+            callbacks = self.buffer_callbacks
+            self.buffer = {}
+            self.buffered_bytes = 0
+            self.buffer_started = None
+            self.buffer_callbacks = []
+
+            written = []
+            with self.metrics.timer('local_write'):
+                for partition, lines in buffer.items():
+                    written.append(self._write(partition, b''.join(lines), len(lines)))
+                for f in set(written):
+                    if not f.closed:
+                        f.flush()
+                        os.fsync(f.fileno())
+
+            for callback in callbacks:
+                callback()
+
+        return True
+
+
+    def close(self):
+        """Write remaining posts and finish all open files"""
+        with self.lock:
+            self.closed = True
+            self.flush()
+            for partition in list(self.files):
+                self._finish(partition)
+
+
+    def stats(self) -> str:
+        ratio = round(self.bytes_in / self.bytes_out, 2) if self.bytes_out else None
+        return (f"Wrote {self.records_written} posts to {self.directory}. Finished files: {self.files_finished}. "
+                f"Bytes written: {self.bytes_out} (compression ratio {ratio}).")
+
+
+    def _flush_on_timer(self):
+        """Write the buffer when the oldest buffered post is max_latency seconds old"""
+        while not self.closed:
+            time.sleep(min(1.0, self.max_latency))
+            with self.lock:
+                if self.closed or self.error is not None or self.buffer_started is None:
+                    continue
+                if time.monotonic() - self.buffer_started < self.max_latency:
+                    continue
+                try:
+                    self.flush()
+                except Exception as e:
+                    self.error = e
+
+
+    def _raise_timer_error(self):
+        # Surface errors from the timer thread in the crawling thread
+        if self.error is not None:
+            raise self.error
+
+
+    def _partition(self, created_utc, line:bytes) -> str:
+        if created_utc is None:
+            match = CREATED_UTC.search(line)
+            created_utc = int(match.group(1)) if match else None
+        if not isinstance(created_utc, (int, float)):
+            return UNKNOWN_PARTITION
+        return datetime.fromtimestamp(created_utc, tz=timezone.utc).strftime(self.partition_format)
+
+
+    def _add_to_buffer(self, lines:list, partitions:list):
+        if self.buffer_started is None:
+            self.buffer_started = time.monotonic()
+        for line, partition in zip(lines, partitions):
+            self.buffer.setdefault(partition, []).append(line)
+            self.buffered_bytes += len(line)
+
+
+    def _write(self, partition:str, data:bytes, records:int):
+        """Append lines to the partition's open file, starting a new file if it's full"""
+        self.bytes_in += len(data)
+        if self.compressor is not None:
+            with self.metrics.timer('compression'):
+                data = self.compressor.compress(data)
+
+        entry = self.files.get(partition)
+        if entry is None:
+            entry = self._open(partition)
+        self.files.move_to_end(partition)
+
+        f = entry['file']
+        f.write(data)
+        entry['bytes'] += len(data)
+        self.bytes_out += len(data)
+        self.records_written += records
+        self.metrics.count('local_records', records)
+        self.metrics.count('bytes_written', len(data))
+
+        # The file is fsynced before it's renamed
+        if entry['bytes'] >= self.max_file_bytes:
+            f.flush()
+            os.fsync(f.fileno())
+            self._finish(partition)
+
+        return f
+
+
+    def _open(self, partition:str) -> dict:
+        # Finish the least recently used file if too many are open
+        if len(self.files) >= self.max_open_files:
+            oldest = next(iter(self.files))
+            self.files[oldest]['file'].flush()
+            os.fsync(self.files[oldest]['file'].fileno())
+            self._finish(oldest)
+
+        path = os.path.join(self.directory, partition, f'{self.prefix}-{self.run}-{self.next_file:05d}{self.extension}')
+        self.next_file += 1
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = self.files[partition] = {'path': path, 'file': open(path + OPEN_SUFFIX, 'ab'), 'bytes': 0}
+
+        return entry
+
+
+    def _finish(self, partition:str):
+        """Close a partition's file and drop the .open suffix"""
+        entry = self.files.pop(partition)
+        entry['file'].close()
+        os.replace(entry['path'] + OPEN_SUFFIX, entry['path'])
+        self.files_finished += 1
+
+
+    def _recover(self):
+        """Finish files left open by a previous run. Posts in them that weren't
+        checkpointed are written again by the next run."""
+        recovered = 0
+        for root, dirs, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith(self.prefix + '-') and filename.endswith(OPEN_SUFFIX):
+                    path = os.path.join(root, filename)
+                    os.replace(path, path[:-len(OPEN_SUFFIX)])
+                    recovered += 1
+        if recovered:
+            self.cloudwatch.log(f"WARNING: Found {recovered} files in {self.directory} left open by a previous run. Their last write may be incomplete.")
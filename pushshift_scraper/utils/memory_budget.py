@@ -0,0 +1,56 @@
+# Cap the memory held by pages that have been fetched but not yet handed to a
+# sink, so crawls with many workers stay within a predictable RSS
+
+import threading
+import time
+
+
+class MemoryBudget:
+    """Bytes of fetched posts that may be held at once.
+
+    Pages are counted from when they are fetched until their posts are taken
+    by a sink. Fetching waits while the pages held add up to max_bytes, so
+    pipelines and shard workers can't run further ahead of the sink than the
+    budget allows. A page is only counted once it has arrived, so each thread
+    fetching can go over the budget by one page. One budget can be shared
+    between threads.
+    """
+
+    def __init__(self, max_bytes:int) -> None:
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+
+        # Track stats
+        self.held_bytes = 0
+        self.peak_bytes = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+
+    def wait(self):
+        """Block until the pages held are under the budget"""
+        with self.condition:
+            if self.held_bytes < self.max_bytes:
+                return
+            self.waits += 1
+            start = time.monotonic()
+            while self.held_bytes >= self.max_bytes:
+                self.condition.wait()
+            self.wait_seconds += time.monotonic() - start
+
+
+    def add(self, size:int):
+        with self.condition:
+            self.held_bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.held_bytes)
+
+
+    def release(self, size:int):
+        with self.condition:
+            self.held_bytes -= size
+            self.condition.notify_all()
+
+
+    def stats(self) -> str:
+        return (f"Memory budget: {round(self.peak_bytes / 1024 ** 2, 1)} of {round(self.max_bytes / 1024 ** 2, 1)} MiB peak. "
+                f"Waited {self.waits} times for {round(self.wait_seconds, 1)}s.")
@@ -0,0 +1,242 @@
+# Stage timings and counters, reported as CloudWatch embedded metric format
+
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram buckets are a quarter of a power of two wide, from about 8
+# microseconds to 2 minutes. That keeps a distribution under the 100 values
+# CloudWatch accepts per metric, with percentiles within 10%.
+BUCKETS_PER_DOUBLING = 4
+MIN_BUCKET = -28
+MAX_BUCKET = 68
+
+DESTINATIONS = ['cloudwatch', 'file', 'both', 'none']
+
+
+class Histogram:
+    """Distribution of durations in milliseconds, in log-spaced buckets"""
+
+    __slots__ = ('buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self) -> None:
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, ms:float):
+        bucket = MIN_BUCKET if ms <= 0 else min(MAX_BUCKET, max(MIN_BUCKET, math.floor(math.log2(ms) * BUCKETS_PER_DOUBLING)))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += ms
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if self.max is None or ms > self.max:
+            self.max = ms
+
+    def percentile(self, p:float) -> float:
+        """Approximate percentile, from the middle of the bucket it falls in"""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max, max(self.min, _bucket_value(bucket)))
+        return self.max
+
+    def emf(self) -> dict:
+        """CloudWatch statistic values: each bucket's value with its count"""
+        buckets = sorted(self.buckets)
+        return {
+            'Values': [round(_bucket_value(bucket), 3) for bucket in buckets],
+            'Counts': [self.buckets[bucket] for bucket in buckets],
+            'Min': round(self.min, 3),
+            'Max': round(self.max, 3),
+            'Count': self.count,
+            'Sum': round(self.sum, 3)
+        }
+
+
+def _bucket_value(bucket:int) -> float:
+    return 2 ** ((bucket + 0.5) / BUCKETS_PER_DOUBLING)
+
+
+class Metrics:
+    """Time each stage of the crawl and count what it handles.
+
+    Stages are timed with histograms and counters are summed. Gauges hold
+    the latest value of something, such as the current rate limit, and are
+    reported with every report. Every interval
+    seconds the metrics collected since the last report are written as a
+    CloudWatch embedded metric format (EMF) line, through the CloudWatch
+    logger, to a local file, or both. CloudWatch turns EMF log events into
+    metrics without any extra API calls. Totals for the whole run are kept
+    for the summary logged at the end. One instance can be shared between
+    threads.
+    """
+
+    def __init__(self, cloudwatch_logger=None, namespace:str='PushshiftScraper', dimensions:dict=None, interval:float=60.0, destination:str='none', filename:str=None) -> None:
+        if destination not in DESTINATIONS:
+            raise Exception(f'Unknown metrics destination {destination}. Choose from {DESTINATIONS}.')
+        if destination in ('file', 'both') and not filename:
+            raise Exception(f'Metrics destination {destination} needs a filename.')
+
+        self.cloudwatch = cloudwatch_logger
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+        self.interval = interval
+        self.destination = destination
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        # Since the last report, and since the start
+        self.timers = {}
+        self.counters = {}
+        self.total_timers = {}
+        self.total_counters = {}
+        self.gauges = {}
+        self.started = time.monotonic()
+
+        self.closed = False
+        self.reporter = None
+        if destination != 'none' and interval:
+            self.reporter = threading.Thread(target=self._report_on_timer, name='metrics', daemon=True)
+            self.reporter.start()
+
+
+    @contextmanager
+    def timer(self, stage:str):
+        """Time the block as one sample of stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+
+    def observe(self, stage:str, seconds:float):
+        ms = seconds * 1000
+        with self.lock:
+            for timers in (self.timers, self.total_timers):
+                histogram = timers.get(stage)
+                if histogram is None:
+                    histogram = timers[stage] = Histogram()
+                histogram.add(ms)
+
+
+    def count(self, name:str, value:int=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.total_counters[name] = self.total_counters.get(name, 0) + value
+
+
+    def gauge(self, name:str, value:float, unit:str='None'):
+        """Set the latest value of name
+
+        Args:
+            name (str): Metric name.
+            value (float): Latest value.
+            unit (str, optional): CloudWatch unit. Defaults to None.
+        """
+        with self.lock:
+            self.gauges[name] = (value, unit)
+
+
+    def report(self):
+        """Write the metrics collected since the last report and start over"""
+        with self.lock:
+            timers, counters = self.timers, self.counters
+            self.timers, self.counters = {}, {}
+            gauges = dict(self.gauges)
+
+        if not timers and not counters:
+            return
+        line = json.dumps(self.emf(timers, counters, gauges))
+
+        if self.destination in ('cloudwatch', 'both') and self.cloudwatch is not None:
+            self.cloudwatch.log(line)
+        if self.destination in ('file', 'both'):
+            with open(self.filename, 'a') as f:
+                f.write(line + '\n')
+
+
+    def emf(self, timers:dict, counters:dict, gauges:dict=None) -> dict:
+        """An EMF log event holding the timers, counters and gauges"""
+        gauges = gauges or {}
+        definitions = [{'Name': stage, 'Unit': 'Milliseconds'} for stage in sorted(timers)]
+        definitions += [{'Name': name, 'Unit': 'Bytes' if name.startswith('bytes') else 'Count'} for name in sorted(counters)]
+        definitions += [{'Name': name, 'Unit': gauges[name][1]} for name in sorted(gauges)]
+
+        event = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [sorted(self.dimensions)],
+                    'Metrics': definitions
+                }]
+            }
+        }
+        event.update(self.dimensions)
+        event.update({stage: histogram.emf() for stage, histogram in timers.items()})
+        event.update(counters)
+        event.update({name: value for name, (value, unit) in gauges.items()})
+
+        return event
+
+
+    def close(self):
+        """Stop reporting on a timer and report what's left"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.destination != 'none':
+            self.report()
+
+
+    def _report_on_timer(self):
+        while not self.closed:
+            time.sleep(self.interval)
+            if self.closed:
+                break
+            try:
+                self.report()
+            except Exception as e:
+                print(f"Metrics: Failed to report metrics. Exception {e}")
+
+
+    def summary(self) -> str:
+        """Where time has gone since the start: p50/p99 and total per stage, and counters"""
+        with self.lock:
+            timers = dict(self.total_timers)
+            counters = dict(self.total_counters)
+            gauges = dict(self.gauges)
+
+        stages = [f"{stage} p50 {_ms(h.percentile(50))} p99 {_ms(h.percentile(99))} total {round(h.sum / 1000, 1)}s ({h.count})"
+                  for stage, h in sorted(timers.items(), key=lambda item: -item[1].sum)]
+        counts = [f"{name} {value}" for name, value in sorted(counters.items())]
+        counts += [f"{name} {round(value, 3)}" for name, (value, unit) in sorted(gauges.items())]
+        return f"Stages: {'; '.join(stages) or 'none'}. Counts: {', '.join(counts) or 'none'}."
+
+
+    def stages(self) -> dict:
+        """Totals per stage since the start, for machine-readable output"""
+        with self.lock:
+            return {stage: {
+                'count': h.count,
+                'total_s': round(h.sum / 1000, 3),
+                'p50_ms': round(h.percentile(50), 3),
+                'p99_ms': round(h.percentile(99), 3)
+            } for stage, h in self.total_timers.items()}
+
+
+def _ms(ms:float) -> str:
+    if ms is None:
+        return '-'
+    return f"{ms:.1f}ms" if ms < 1000 else f"{ms / 1000:.2f}s"
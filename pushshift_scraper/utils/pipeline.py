@@ -0,0 +1,151 @@
+import queue
+import threading
+from functools import partial
+
+from utils.pushshift_api import NoResultsError
+
+
+class Pipeline:
+    """Crawl with the fetch, send and checkpoint stages running concurrently.
+
+    Only the 'before' cursor is sequential, so pages are fetched in the main
+    thread while previous pages are sent to Firehose and written to the
+    metadata log on their own threads. Stages are connected by bounded queues
+    so a slow stage applies backpressure and limits the number of pages held
+    in memory.
+    """
+
+    _STOP = object()
+
+    def __init__(self, api, firehose, metadata_log, cloudwatch_logger, queue_size:int=4) -> None:
+        self.api = api
+        self.firehose = firehose
+        self.metadata_log = metadata_log
+        self.cloudwatch = cloudwatch_logger
+
+        self.send_queue = queue.Queue(maxsize=queue_size)
+        self.checkpoint_queue = queue.Queue(maxsize=queue_size)
+
+        self.send_thread = None
+        self.checkpoint_thread = None
+
+        self.error = None
+        self.last_result = None
+
+
+    def run(self, post_type:str, subreddits:list, before:int=None, after:int=None, size:int=100, max_requests:int=None):
+        """Crawl until Pushshift runs out of results.
+
+        Args:
+            post_type (str): Submissions or comments.
+            subreddits (list): List of subreddits to search.
+            before (int, optional): Max created_utc of posts to get (epoch timestamp). Defaults to None.
+            after (int, optional): Min created_utc of posts to get (epoch timestamp). Defaults to None.
+            size (int, optional): Number of results per page. Defaults to 100.
+            max_requests (int, optional): Stop after this many requests. Defaults to None.
+
+        Returns:
+            PushshiftResponse: The last result written to the metadata log.
+        """
+        self.send_thread = threading.Thread(target=self._send_stage, name='send', daemon=True)
+        self.checkpoint_thread = threading.Thread(target=self._checkpoint_stage, name='checkpoint', daemon=True)
+        self.send_thread.start()
+        self.checkpoint_thread.start()
+
+        try:
+            self._fetch_stage(post_type, subreddits, before, after, size, max_requests)
+        finally:
+            # Let the other stages finish pages that have already been fetched
+            self._put(self.send_queue, self._STOP, self.send_thread)
+            self.send_thread.join()
+            self.checkpoint_thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.last_result
+
+
+    def _fetch_stage(self, post_type, subreddits, before, after, size, max_requests):
+        # The end of results is passed down the pipeline too, so the range
+        # it completes is recorded once the pages before it are delivered
+        try:
+            result = self.api.get(post_type=post_type, subreddits=subreddits, before=before, after=after, size=size)
+        except NoResultsError as e:
+            self._put(self.send_queue, e, self.send_thread)
+            return
+        self._put(self.send_queue, result, self.send_thread)
+
+        while result.metadata['total_results'] > 0 and self.error is None:
+            try:
+                result = self.api.get_next(result)
+            except NoResultsError as e:
+                self._put(self.send_queue, e, self.send_thread)
+                break
+            self._put(self.send_queue, result, self.send_thread)
+
+            # Record progress at regular intervals
+            self.api.log_progress()
+
+            if max_requests is not None and self.api.request_count >= max_requests:
+                self.cloudwatch.log("Stopping test.")
+                break
+
+
+    def _send_stage(self):
+        while True:
+            result = self.send_queue.get()
+            if result is self._STOP:
+                break
+
+            # Checkpoint the page once Firehose has delivered it
+            checkpoint = partial(self._put, self.checkpoint_queue, result, self.checkpoint_thread)
+            data = [] if isinstance(result, NoResultsError) else result.take()
+            try:
+                self.firehose.send_result(data, callback=checkpoint)
+            except Exception as e:
+                self._set_error(e)
+                break
+
+        if self.error is None:
+            try:
+                self.firehose.flush()
+            except Exception as e:
+                self._set_error(e)
+
+        self._put(self.checkpoint_queue, self._STOP, self.checkpoint_thread)
+
+
+    def _checkpoint_stage(self):
+        while True:
+            result = self.checkpoint_queue.get()
+            if result is self._STOP:
+                break
+
+            try:
+                if isinstance(result, NoResultsError):
+                    self.metadata_log.add_end_of_results(result.request_params, incomplete=result.incomplete)
+                    continue
+                self.metadata_log.add_result_metadata(result)
+            except Exception as e:
+                self._set_error(e)
+                break
+
+            self.last_result = result
+
+
+    def _set_error(self, e):
+        if self.error is None:
+            self.error = e
+            self.cloudwatch.log(f"ERROR: Pipeline stopped. Exception {e}")
+
+
+    def _put(self, q, item, consumer):
+        """Put item on a queue, giving up if the consuming stage has stopped"""
+        while True:
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                if consumer is None or not consumer.is_alive():
+                    return False
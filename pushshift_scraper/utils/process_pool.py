@@ -0,0 +1,96 @@
+# Decode, filter and serialize pages in worker processes, so parsing JSON
+# isn't limited to one core by the GIL
+
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.metrics import Metrics
+from utils.raw_json import RawPage, split_response
+from utils.record_filter import RecordFilter
+from utils.serialization import get_serializer
+
+# Set up in each worker process by _init_worker
+_worker = {}
+
+
+class DecodePool:
+    """Worker processes that turn response bodies into posts ready to send.
+
+    Bodies are sent to a worker as bytes. The worker decodes the page, reads
+    the fields needed for paging, applies the record filter and serializes
+    each post, and sends back a RawPage whose records are compact JSON bytes.
+    No dicts cross between processes, and sinks only add a newline to each
+    post. Posts dropped by the filter are None so the records stay aligned
+    with their IDs for paging.
+
+    Fetching, the rate limit, paging and checkpoints stay in the main
+    process. decode() waits for its page, so pages are only decoded at the
+    same time when several threads are fetching, i.e. with shards or several
+    scheduler workers.
+    """
+
+    def __init__(self, workers:int, serializer:str='json', record_filter:RecordFilter=None, metrics:Metrics=None) -> None:
+        self.workers = workers
+        self.record_filter = record_filter
+        self.metrics = metrics or Metrics()
+
+        # Forking a process with running threads can leave locks held in the
+        # child, so workers are started fresh
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(serializer, record_filter))
+
+
+    def decode(self, content:bytes, passthrough:bool=False) -> RawPage:
+        """Decode a response body in a worker
+
+        Args:
+            content (bytes): Response body.
+            passthrough (bool, optional): Split the body into raw records rather
+                than decoding it, if it can be. Defaults to False.
+
+        Returns:
+            RawPage: Metadata and serialized posts with their created_utc, id and
+                subreddit. records is None if the body has no data.
+        """
+        page, dropped = self.executor.submit(_decode_page, content, passthrough).result()
+        if self.record_filter is not None and self.record_filter.active and page.records is not None:
+            self.record_filter.count(len(page.records), dropped)
+            self.metrics.count('records_filtered', dropped)
+        return page
+
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def _init_worker(serializer:str, record_filter:RecordFilter):
+    _worker['serializer'] = get_serializer(serializer)
+    _worker['filter'] = record_filter if record_filter is not None and record_filter.active else None
+
+
+def _decode_page(content:bytes, passthrough:bool) -> tuple:
+    page = split_response(content) if passthrough else None
+    if page is None:
+        body = json.loads(content)
+        data = body.get('data')
+        if data is None:
+            return RawPage(body.get('metadata'), None, [], [], []), 0
+        page = RawPage(
+            body.get('metadata'),
+            data,
+            [record.get('created_utc') for record in data],
+            [record.get('id') for record in data],
+            [record.get('subreddit') for record in data])
+
+    # Serialize without the trailing newline, like raw records
+    dumps = _worker['serializer'].dumps
+    record_filter = _worker['filter']
+    records = page.records if record_filter is None else [record_filter.filter_record(record) for record in page.records]
+    page.records = [record if record is None or isinstance(record, bytes) else dumps(record)[:-1] for record in records]
+
+    dropped = records.count(None)
+    return page, dropped
@@ -3,40 +3,175 @@ from urllib.parse import urlencode
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import concurrent.futures
 import json
-from ratelimiter import RateLimiter
+import time
+import threading
 
+from utils.memory_budget import MemoryBudget
+from utils.metrics import Metrics
+from utils.process_pool import DecodePool
+from utils.query_window import WindowPlanner
+from utils.rate_limiter import AdaptiveRateLimiter
+from utils.raw_json import split_response
+from utils.response_cache import ResponseCache
+from utils.startup import StartupTimer
+
+# Statuses that mean Pushshift is overloaded. These are retried by _get rather
+# than by urllib3 so the rate limiter can back off.
+THROTTLE_STATUSES = [408, 429, 500, 502, 503, 504, 522]
+
+# Most post IDs remembered for the boundary second between pages
+MAX_SEEN_IDS = 10000
+
+# Latencies of recent requests used to decide when to hedge, and the fewest
+# needed before hedging starts
+LATENCY_WINDOW = 1000
+MIN_LATENCY_SAMPLES = 20
+
+# Decoded posts take about three times the memory of the JSON they came from
+DECODED_BYTES_PER_BYTE = 3
+
+
+class NoResultsError(Exception):
+    """Raised when Pushshift returns no results for a query. This is how the
+    end of a crawl is signalled."""
+    incomplete = False
+
+    def __init__(self, message:str, request_params:dict=None) -> None:
+        super().__init__(message)
+        self.request_params = request_params
+
+
+class IncompleteResultsError(NoResultsError):
+    """Raised when a search still times out or loses shards after retries and
+    returns no new posts. The crawl of the range stops, but whether there are
+    more posts in it is unknown, so it isn't recorded as covered."""
+    incomplete = True
+
+
+class SeenIds:
+    """IDs of the posts already returned at the boundary second.
+
+    Pages overlap by one second so posts sharing the second a page ends on
+    aren't skipped. Only the IDs at that second are kept, parsed from base36
+    to ints, so the set stays small however long the crawl runs.
+    """
+    __slots__ = ('second', 'ids')
+
+    def __init__(self, second:int=None, ids:set=None) -> None:
+        self.second = second
+        self.ids = ids if ids is not None else set()
+
+    def __contains__(self, post:tuple) -> bool:
+        created_utc, id = post
+        return created_utc == self.second and _id_key(id) in self.ids
+
+    def add(self, id, max_ids:int=MAX_SEEN_IDS):
+        if len(self.ids) < max_ids:
+            self.ids.add(_id_key(id))
+
+    def next(self, result, max_ids:int=MAX_SEEN_IDS):
+        """IDs at the boundary second of result, plus these if it ends on the same second"""
+        second = result.boundary_second()
+        ids = set(self.ids) if second == self.second else set()
+        for created_utc, id in zip(result.created_utcs, result.ids):
+            if created_utc == second and len(ids) < max_ids:
+                ids.add(_id_key(id))
+
+        return SeenIds(second, ids)
+
+
+def _id_key(id):
+    # Reddit IDs are base36. Ints take less memory than strings.
+    try:
+        return int(id, 36)
+    except (TypeError, ValueError):
+        return id
 
 
 class PushshiftAPI:
-    def __init__(self, cloudwatch_logger) -> None:
+    def __init__(self, cloudwatch_logger, pool_maxsize:int=10, rate_limiter:AdaptiveRateLimiter=None, max_retries:int=5, passthrough:bool=False, base_url:str="https://api.pushshift.io", metrics:Metrics=None, cache:ResponseCache=None, fields:list=None, connect_timeout:float=10.0, read_timeout:float=60.0, hedge_percentile:float=None, incomplete_retries:int=2, memory_budget:MemoryBudget=None, decode_pool:DecodePool=None, window_planner:WindowPlanner=None, startup:StartupTimer=None) -> None:
         self.start_time = datetime.utcnow()
         self.request_count = 0
+        self.cache_hits = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.incomplete_pages = 0
+        self.duplicates = 0
+        self.skipped_seconds = 0
         self.last_request = None
         self.last_response = None
         self.cloudwatch = cloudwatch_logger
+        self.max_retries = max_retries
+        self.passthrough = passthrough
+        self.base_url = base_url.rstrip('/')
+        self.lock = threading.Lock()
+
+        # Share a rate limiter to share the request budget with other crawlers
+        self.metrics = metrics or Metrics()
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(metrics=self.metrics)
+
+        # Optionally serve pages from an on-disk cache of earlier responses
+        self.cache = cache
+
+        # Only request these fields of each post, or all if None
+        self.fields = fields
+
+        # Give up on a request that can't connect or stops sending data.
+        # Pages that come back timed out or with failed shards are requested
+        # again up to incomplete_retries times.
+        self.timeout = (connect_timeout, read_timeout)
+        self.incomplete_retries = incomplete_retries
+
+        # Hedge slow requests: if a page hasn't arrived by hedge_percentile of
+        # recent latencies, send the same request again if the rate limit
+        # allows it and use whichever answers first
+        self.hedge_percentile = hedge_percentile
+        self.recent_latencies = deque(maxlen=LATENCY_WINDOW)
+        self.hedge_pool = None
+        if hedge_percentile is not None:
+            self.hedge_pool = ThreadPoolExecutor(max_workers=2 * pool_maxsize, thread_name_prefix='pushshift-request')
+
+        # Optionally wait to fetch pages while too many are held in memory
+        self.memory_budget = memory_budget
+
+        # Optionally decode pages in worker processes
+        self.decode_pool = decode_pool
+
+        # Optionally limit searches paging back in time to windows sized to
+        # the density of posts, rather than all older posts
+        self.window_planner = window_planner
+
+        # Optionally report how long startup took once the first page arrives
+        self.startup = startup
     
         """Confgure requests module"""
-        # Define retry strategy for requests
+        # Define retry strategy for connection errors. Error statuses and
+        # read timeouts are retried in _get.
         retry_strategy = Retry(
             total=5,
-            status_forcelist=[408, 429, 500, 502, 503, 504, 522],
+            read=0,
             method_whitelist=["GET"],
             backoff_factor=4,
             respect_retry_after_header=False
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        # Keep a connection open per thread when crawling shards concurrently
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=pool_maxsize)
         self.request = requests.Session()
         self.request.mount("https://", adapter)
         self.request.mount("http://", adapter)
 
 
-    def _create_params(self, subreddits:list, before:int, after:int, size:int):
+    def _create_params(self, subreddits:list, before:int, after:int, size:int, sort:str="desc"):
 
             params = {
                 "subreddit": ','.join(subreddits),
                 "size": size,
-                "sort": "desc",
+                "sort": sort,
                 "sort_type": "created_utc",
                 "metadata": "true"
             }
@@ -47,6 +182,9 @@ class PushshiftAPI:
             if after is not None:
                 params['after'] = after
 
+            if self.fields:
+                params['fields'] = ','.join(self.fields)
+
             return params
 
     def _set_endpoint(self, post_type:str) -> str:
@@ -59,23 +197,308 @@ class PushshiftAPI:
             raise Exception("Could not specify Pushshift endpoint")
 
     def _create_url(self, endpoint:str, params:dict) -> str:
-        url = f"https://api.pushshift.io/reddit/{endpoint}/search"
+        url = f"{self.base_url}/reddit/{endpoint}/search"
         encoded_url = url + '?' + urlencode(params)
 
         return encoded_url
 
 
-    @RateLimiter(max_calls=100, period=60)
     def _get(self, endpoint:str, params:dict):
+        if self.memory_budget is not None:
+            with self.metrics.timer('memory_wait'):
+                self.memory_budget.wait()
+
+        # Cached pages don't count against the rate limit
+        if self.cache is not None:
+            response = self.cache.get(endpoint, params)
+            if response is not None:
+                with self.lock:
+                    self.request_count += 1
+                    self.cache_hits += 1
+                self.metrics.count('cache_hits')
+                result = PushshiftResponse(response, endpoint, params, cloudwatch_logger=self.cloudwatch, passthrough=self.passthrough, metrics=self.metrics, decode_pool=self.decode_pool)
+                self.metrics.count('pages')
+                self.metrics.count('records', len(result.data))
+                result.hold(self.memory_budget)
+                if self.startup is not None:
+                    self.startup.first_page(self.cloudwatch, self.metrics)
+                return result
+
         url = self._create_url(endpoint, params)
-        response = self.request.get(url)
-        
-        self.request_count += 1
 
-        return PushshiftResponse(response, endpoint, params, cloudwatch_logger=self.cloudwatch)
+        incomplete = 0
+        for attempt in range(self.max_retries + 1):
+            with self.metrics.timer('rate_limit_wait'):
+                self.rate_limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self._fetch(url)
+            except requests.exceptions.RequestException as e:
+                # Timeouts and connection errors
+                self.metrics.count('pushshift_request_errors')
+                if attempt == self.max_retries:
+                    message = f"ERROR: Request to Pushshift failed after {attempt + 1} attempts. Exception {e}. Query params: {json.dumps(params)}."
+                    self.cloudwatch.log(message)
+                    raise Exception(message)
+                self.rate_limiter.on_throttle()
+                self.cloudwatch.log(f"WARNING: Request to Pushshift failed. Exception {e}. Retrying. {self.rate_limiter.stats()}")
+                continue
+            latency = time.monotonic() - start
+            self.metrics.observe('http_wait', latency)
+
+            if response.status_code in THROTTLE_STATUSES and attempt < self.max_retries:
+                # Back off and retry
+                self.metrics.count('pushshift_throttles')
+                self.rate_limiter.on_throttle(self._retry_after(response))
+                self.cloudwatch.log(f"WARNING: Pushshift returned status code {response.status_code}. Retrying. {self.rate_limiter.stats()}")
+                continue
+
+            try:
+                result = PushshiftResponse(response, endpoint, params, cloudwatch_logger=self.cloudwatch, passthrough=self.passthrough, metrics=self.metrics, decode_pool=self.decode_pool)
+            except NoResultsError:
+                # An incomplete search can find nothing when there are posts
+                reason = self._incomplete(self._metadata(response))
+                if reason is not None and incomplete < self.incomplete_retries and attempt < self.max_retries:
+                    incomplete += 1
+                    self._retry_incomplete(reason, endpoint, params)
+                    continue
+                self.rate_limiter.on_success(latency)
+                if reason is None:
+                    self._cache_response(endpoint, params, response)
+                    raise
+                message = f"WARNING: Search still incomplete ({reason}) after {incomplete} retries and returned no posts. The rest of the range will be crawled again by the next run. Query params: {json.dumps(params)}."
+                self.cloudwatch.log(message)
+                raise IncompleteResultsError(message, params)
+
+            reason = self._incomplete(result.metadata)
+            if reason is not None and incomplete < self.incomplete_retries and attempt < self.max_retries:
+                incomplete += 1
+                self._retry_incomplete(reason, endpoint, params)
+                continue
+            break
+
+        self.metrics.count('pages')
+        self.metrics.count('records', len(result.data))
+        self.metrics.count('bytes_received', result.bytes_received)
+
+        # Searches that time out mean Pushshift is struggling
+        if result.metadata['timed_out']:
+            self.metrics.count('pushshift_timeouts')
+            self.rate_limiter.on_throttle()
+        else:
+            self.rate_limiter.on_success(latency)
 
+        # Don't cache incomplete results. They are delivered, but their range
+        # isn't checkpointed or marked as covered so it's crawled again.
+        if reason is None:
+            self._cache_response(endpoint, params, response)
+        else:
+            result.incomplete = reason
+            self.metrics.count('incomplete_pages')
+            with self.lock:
+                self.incomplete_pages += 1
+            self.cloudwatch.log(f"WARNING: Page still incomplete ({reason}) after {incomplete} retries. Sending what was returned without marking its range as covered. Query params: {json.dumps(params)}.")
+
+        result.hold(self.memory_budget)
+        if self.startup is not None:
+            self.startup.first_page(self.cloudwatch, self.metrics)
+        return result
+
+
+    def _fetch(self, url:str):
+        """Send a request, hedged with a second one if it's slower than usual"""
+        delay = self._hedge_delay()
+        if delay is None:
+            return self._send(url)
+
+        primary = self.hedge_pool.submit(self._send, url)
+        try:
+            return primary.result(timeout=delay)
+        except concurrent.futures.TimeoutError:
+            pass
+
+        # Only hedge if it fits in the rate limit right now
+        if not self.rate_limiter.try_acquire():
+            return primary.result()
+        self.metrics.count('pushshift_hedges')
+        with self.lock:
+            self.hedges += 1
+        hedge = self.hedge_pool.submit(self._send, url)
+
+        # Use the first good response. The other request finishes in the background.
+        pending = {primary, hedge}
+        response = None
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    answer = future.result()
+                except requests.exceptions.RequestException as e:
+                    error = e
+                    continue
+                if answer.ok:
+                    if future is hedge:
+                        self.metrics.count('pushshift_hedge_wins')
+                        with self.lock:
+                            self.hedge_wins += 1
+                    return answer
+                response = response or answer
+
+        if response is not None:
+            return response
+        raise error
+
+
+    def _send(self, url:str):
+        start = time.monotonic()
+        try:
+            return self.request.get(url, timeout=self.timeout)
+        finally:
+            latency = time.monotonic() - start
+            self.metrics.count('pushshift_requests')
+            with self.lock:
+                self.request_count += 1
+                self.recent_latencies.append(latency)
+
+
+    def _hedge_delay(self) -> float:
+        """Seconds to wait before hedging a request, or None to not hedge"""
+        if self.hedge_pool is None:
+            return None
+        with self.lock:
+            if len(self.recent_latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            latencies = sorted(self.recent_latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
+
+
+    def _incomplete(self, metadata:dict) -> str:
+        """Why a page may be missing posts, or None if it's complete"""
+        if not metadata:
+            return None
+        if metadata.get('timed_out'):
+            return 'search timed out'
+        # Skipped shards are ones Elasticsearch knew couldn't match, so they don't lose posts
+        shards = metadata.get('shards') or {}
+        if shards.get('failed', 0) > 0:
+            return f"{shards['failed']} failed shards"
+        return None
+
+
+    def _metadata(self, response) -> dict:
+        try:
+            return response.json().get('metadata')
+        except ValueError:
+            return None
+
+
+    def _retry_incomplete(self, reason:str, endpoint:str, params:dict):
+        self.metrics.count('incomplete_retries')
+        if self.window_planner is not None:
+            self.window_planner.on_incomplete(endpoint, params)
+        self.rate_limiter.on_throttle()
+        self.cloudwatch.log(f"WARNING: Page incomplete ({reason}). Retrying. Query params: {json.dumps(params)}.")
+
+
+    def _cache_response(self, endpoint:str, params:dict, response):
+        if self.cache is None:
+            return
+        try:
+            self.cache.put(endpoint, params, response.content)
+        except Exception as e:
+            # The crawl doesn't depend on the cache
+            self.cloudwatch.log(f"WARNING: Failed to cache response. Exception {e}")
+
+
+    def _retry_after(self, response) -> float:
+        """Seconds to wait from the Retry-After header, or None"""
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+    def _get_page(self, endpoint:str, params:dict, seen:SeenIds=None):
+        """Get a page, dropping posts at the boundary second that were on the previous page"""
+        result = self._get(endpoint, params)
+
+        if seen is not None and seen.ids:
+            page_size = len(result.data)
+            duplicates = result.drop_seen(seen)
+            with self.lock:
+                self.duplicates += duplicates
+            self.metrics.count('duplicates', duplicates)
+
+            if not result.data and page_size < params['size'] and result.incomplete is not None:
+                message = f"WARNING: Page incomplete ({result.incomplete}) and no new posts returned. The rest of the range will be crawled again by the next run. Query params: {json.dumps(params)}."
+                self.cloudwatch.log(message)
+                raise IncompleteResultsError(message, params)
+
+            if not result.data and page_size < params['size']:
+                # Everything left in the range has already been returned
+                message = f"No new posts returned for query {json.dumps(params)}."
+                self.cloudwatch.log(message)
+                raise NoResultsError(message, params)
+
+            if not result.data:
+                # The page is full of posts from the boundary second that have
+                # already been returned, so paging can't get past that second
+                self.cloudwatch.log(f"WARNING: More than {page_size} posts at {seen.second}. Skipping the rest of that second. Query params: {json.dumps(params)}.")
+                with self.lock:
+                    self.skipped_seconds += 1
+                params = dict(params)
+                if params['sort'] == 'asc':
+                    params['after'] = seen.second
+                else:
+                    params['before'] = seen.second
+                return self._get_page(endpoint, params)
+
+        result.seen = (seen or SeenIds()).next(result)
+
+        return result
+
+
+    def _get_window(self, endpoint:str, params:dict, seen:SeenIds=None, limit:int=None):
+        """Get a page from a window the planner picks, widening empty windows until the limit is reached
 
-    def get(self, post_type:str, subreddits:list, before:int=None, after:int=None, size:int=100):
+        Args:
+            limit (int, optional): 'after' of the whole crawl. Defaults to None.
+
+        Raises:
+            NoResultsError: There are no more posts down to the limit.
+            IncompleteResultsError: A window stayed incomplete and returned no posts.
+        """
+        while True:
+            params = dict(params)
+            params['after'] = self.window_planner.after(endpoint, params, limit)
+            if params['after'] is None:
+                del params['after']
+            try:
+                result = self._get_page(endpoint, params, seen)
+            except IncompleteResultsError:
+                # Not known to be empty
+                raise
+            except NoResultsError:
+                if params.get('after') == limit:
+                    raise
+                self.window_planner.on_empty(endpoint, params)
+                self.metrics.count('empty_windows')
+                continue
+
+            self.window_planner.observe(endpoint, params, result, incomplete=result.incomplete is not None)
+            result.limit = limit
+            return result
+
+
+    def get(self, post_type:str, subreddits:list, before:int=None, after:int=None, size:int=100, seen:SeenIds=None, sort:str="desc"):
         """Retrieve comments from pushshift.
 
         Args:
@@ -84,13 +507,18 @@ class PushshiftAPI:
             before (int, optional): Max created_utc of posts to get (epoch timestamp). Defaults to None.
             after (int, optional): Max created_utc of posts to get (epoch timestamp). Defaults to None.
             size (int, optional): Number of results to return. Max is 100. Defaults to 100.
+            seen (SeenIds, optional): Posts at the boundary second (before - 1, or after + 1
+                when sorting ascending) that have already been returned. Defaults to None.
+            sort (str, optional): desc to page back in time, asc to page forward. Defaults to desc.
 
         Returns:
             PushshiftResponse: Returns a PushshiftResponse object.
         """
         endpoint = self._set_endpoint(post_type)
-        params = self._create_params(subreddits=subreddits, before=before, after=after, size=size)
-        response = self._get(endpoint, params)
+        params = self._create_params(subreddits=subreddits, before=before, after=after, size=size, sort=sort)
+        if self.window_planner is not None and sort == 'desc':
+            return self._get_window(endpoint, params, seen, limit=after)
+        response = self._get_page(endpoint, params, seen)
 
         return response
 
@@ -101,9 +529,17 @@ class PushshiftAPI:
         endpoint = response.endpoint
         params = response.request_params
 
-        # Set max_created_utc to earliest result
-        params['before'] = response.min_created_at
-        response = self._get(endpoint=endpoint, params=params)
+        # Overlap the last second of the previous page, since there may be
+        # more posts at that second. Posts already returned are dropped. Copy
+        # params so the previous response keeps the params it was requested with.
+        params = dict(params)
+        if params['sort'] == 'asc':
+            params['after'] = response.max_created_at - 1
+        else:
+            params['before'] = response.min_created_at + 1
+        if self.window_planner is not None and params['sort'] == 'desc':
+            return self._get_window(endpoint, params, response.seen, limit=response.limit)
+        response = self._get_page(endpoint, params, seen=response.seen)
 
         return response
 
@@ -112,7 +548,11 @@ class PushshiftAPI:
         # Return crawler status
         current_time = datetime.utcnow()
         elapsed_time = current_time - self.start_time
-        return f"Crawled {self.request_count} pages in {round(elapsed_time.seconds / 60.0, 2)} mins."        
+        cached = f" ({self.cache_hits} from cache)" if self.cache is not None else ""
+        return (f"Crawled {self.request_count} pages{cached} in {round(elapsed_time.seconds / 60.0, 2)} mins. "
+                f"Dropped {self.duplicates} duplicate posts. Skipped {self.skipped_seconds} crowded seconds. "
+                f"Hedged {self.hedges} requests ({self.hedge_wins} won). Incomplete pages: {self.incomplete_pages} (not marked as covered). {self.rate_limiter.stats()}"
+                + (f" {self.memory_budget.stats()}" if self.memory_budget is not None else ""))
 
 
     def log_progress(self, interval:int=100):
@@ -122,24 +562,106 @@ class PushshiftAPI:
 
 
 class PushshiftResponse:
-    def __init__(self, response, endpoint, request_params, cloudwatch_logger) -> None:
-        self.cloudwatch = cloudwatch_logger
+    """A page of results from Pushshift.
 
-        self._validate_response(response)
+    With passthrough, the records in data are the raw JSON bytes of each post
+    from the response body rather than dicts, so they can be sent on without
+    being decoded and encoded again. created_utcs and ids are set either way.
+
+    Only the posts and what paging and checkpointing need are kept, not the
+    response or the decoded body. Pages are often kept until they are
+    checkpointed, which can be long after they were sent, so take() hands the
+    posts to a sink and drops them from the page.
+    """
+    __slots__ = ('cloudwatch', 'endpoint', 'request_params', 'data', 'metadata', 'created_utcs', 'ids', 'subreddits',
+                 'min_created_at', 'max_created_at', 'seen', 'duplicates', 'bytes_received', 'payload_bytes', 'budget', 'limit', 'incomplete')
+
+    def __init__(self, response, endpoint, request_params, cloudwatch_logger, passthrough:bool=False, metrics:Metrics=None, decode_pool:DecodePool=None) -> None:
+        self.cloudwatch = cloudwatch_logger
+        self.budget = None
+        metrics = metrics or Metrics()
 
-        self.response = response
         self.endpoint = endpoint
         self.request_params = request_params
-        
-        self.json = response.json()
-        self.data = self.json.get('data')
-        self.metadata = self.json.get('metadata')
 
-        self._validate_metadata(self.metadata)
-        self._validate_data(self.data)
+        self._validate_response(response)
 
-        self.min_created_at = self._min_created_at(self.data)
-        self.max_created_at = self._max_created_at(self.data)
+        # Fall back to decoding the whole body if it can't be split
+        content = response.content
+        self.bytes_received = len(content)
+        with metrics.timer('decode'):
+            if decode_pool is not None:
+                page = decode_pool.decode(content, passthrough)
+            else:
+                page = split_response(content) if passthrough else None
+            if page is not None:
+                self.data = page.records
+                self.metadata = page.metadata
+                self.payload_bytes = sum(len(record) for record in self.data if record is not None) if self.data is not None else 0
+            else:
+                body = response.json()
+                self.data = body.get('data')
+                self.metadata = body.get('metadata')
+                self.payload_bytes = len(content) * DECODED_BYTES_PER_BYTE
+
+        with metrics.timer('validation'):
+            self._validate_metadata(self.metadata)
+            self._validate_data(self.data)
+
+        if page is not None:
+            self.created_utcs = page.created_utcs
+            self.ids = page.ids
+            self.subreddits = page.subreddits
+        else:
+            self.created_utcs = [record.get('created_utc') for record in self.data]
+            self.ids = [record.get('id') for record in self.data]
+            self.subreddits = [record.get('subreddit') for record in self.data]
+
+        self.min_created_at = self._min_created_at(self.created_utcs)
+        self.max_created_at = self._max_created_at(self.created_utcs)
+
+        # Set by PushshiftAPI once duplicates have been dropped
+        self.seen = None
+        self.duplicates = 0
+
+        # 'after' of the whole crawl when searches are limited to windows
+        self.limit = None
+
+        # Set by PushshiftAPI to why the page may be missing posts, if it
+        # was still incomplete after retries
+        self.incomplete = None
+
+    def __del__(self):
+        self.release()
+
+    def hold(self, budget:MemoryBudget):
+        """Count the posts against a memory budget until they are released"""
+        if budget is not None and self.budget is None:
+            budget.add(self.payload_bytes)
+            self.budget = budget
+
+    def take(self) -> list:
+        """Hand the posts over, e.g. to a sink, and drop them from the page"""
+        data = self.posts()
+        self.release()
+        return data
+
+    def posts(self) -> list:
+        """The posts to send. Posts dropped by the filter in a worker process are left out."""
+        if self.data is None:
+            return None
+        return [record for record in self.data if record is not None]
+
+    def release(self):
+        """Drop the posts. The cursor, seen IDs and metadata are kept for paging and checkpointing."""
+        self.data = None
+        self.created_utcs = None
+        self.ids = None
+        self.subreddits = None
+        budget = self.budget
+        if budget is not None:
+            self.budget = None
+            budget.release(self.payload_bytes)
 
     def _validate_response(self, response):
         # This should only trigger if all retries failed
@@ -165,7 +687,7 @@ class PushshiftResponse:
         if metadata['total_results']==0:
             message = f"No data returned for query {json.dumps(self.request_params)}. Metadata:\n{json.dumps(metadata, indent=4)}"
             self.cloudwatch.log(message)
-            raise Exception(message)
+            raise NoResultsError(message, self.request_params)
 
         # Check shards
         shards = metadata["shards"]
@@ -181,13 +703,48 @@ class PushshiftResponse:
         if data is None:
             message = f"No data returned for query {json.dumps(self.request_params)}. Metadata:\n{json.dumps(self.metadata, indent=4)}"
             self.cloudwatch.log(message)
-            raise Exception(message)
+            raise NoResultsError(message, self.request_params)
 
         return True
 
 
-    def _max_created_at(self, data):
-        return data[0].get('created_utc')
+    def drop_seen(self, seen:SeenIds) -> int:
+        """Drop posts that have already been returned
+
+        Args:
+            seen (SeenIds): Posts returned at the boundary second.
+
+        Returns:
+            int: Number of posts dropped.
+        """
+        keep = [i for i, post in enumerate(zip(self.created_utcs, self.ids)) if post not in seen]
+        self.duplicates = len(self.data) - len(keep)
+        if self.duplicates:
+            self.select(keep)
+
+        return self.duplicates
+
+
+    def select(self, keep:list):
+        """Keep only the posts at the given indexes"""
+        self.data = [self.data[i] for i in keep]
+        self.created_utcs = [self.created_utcs[i] for i in keep]
+        self.ids = [self.ids[i] for i in keep]
+        self.subreddits = [self.subreddits[i] for i in keep]
+        if self.data:
+            self.min_created_at = self._min_created_at(self.created_utcs)
+            self.max_created_at = self._max_created_at(self.created_utcs)
+
+
+    def boundary_second(self) -> int:
+        """The second the next page overlaps: the oldest when paging back, the newest when paging forward"""
+        if self.request_params.get('sort') == 'asc':
+            return self.max_created_at
+        return self.min_created_at
+
+
+    def _max_created_at(self, created_utcs):
+        return max(created_utcs)
     
-    def _min_created_at(self, data):
-        return data[-1].get('created_utc')
\ No newline at end of file
+    def _min_created_at(self, created_utcs):
+        return min(created_utcs)
\ No newline at end of file
@@ -0,0 +1,143 @@
+# Bound searches to a window of time sized to how busy the subreddits are, so
+# Pushshift matches fewer posts and answers with complete pages
+
+import threading
+
+
+class WindowPlanner:
+    """Chooses the 'after' of searches paging back in time.
+
+    An open-ended search makes Pushshift match every older post, which on
+    busy subreddits is slow and often times out or loses shards. Instead each
+    search is limited to a window expected to match about target_results
+    posts, from the density of posts (total_results per second) seen so far.
+
+    Windows are halved each time a search comes back incomplete and grow back
+    as pages come back complete. A window that turns out to be empty is
+    widened fourfold and searched again, so quiet periods are crossed in a
+    few requests. Widths are kept between min_seconds and max_seconds. Once a
+    window would be wider than max_seconds the search is left open-ended,
+    which is how the end of the posts is found. Searches without a 'before'
+    are left open-ended too, so windows only depend on the posts returned
+    and not on the clock, and replaying a crawl from the response cache
+    requests the same pages.
+
+    Density is tracked per endpoint and set of subreddits. One planner can be
+    shared between threads.
+    """
+
+    def __init__(self, target_results:int=1000, min_seconds:int=60, max_seconds:int=365 * 24 * 3600, initial_seconds:int=3600, min_scale:float=1 / 64) -> None:
+        self.target_results = target_results
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.initial_seconds = initial_seconds
+        self.min_scale = min_scale
+        self.lock = threading.Lock()
+
+        # Posts per second and how far windows have been shrunk, by query
+        self.density = {}
+        self.scale = {}
+
+        # Track stats
+        self.windows = 0
+        self.empty_windows = 0
+        self.shrinks = 0
+
+
+    def after(self, endpoint:str, params:dict, limit:int=None) -> int:
+        """The 'after' for the next search
+
+        Args:
+            endpoint (str): Endpoint searched.
+            params (dict): Params of the search. Its 'before' is the top of the window.
+            limit (int, optional): 'after' of the whole crawl. Windows don't go past it. Defaults to None.
+
+        Returns:
+            int: The bottom of the window, or limit if the window reaches it.
+        """
+        if params.get('before') is None:
+            return limit
+        key = self._key(endpoint, params)
+        with self.lock:
+            width = self._width(key)
+            self.windows += 1
+        if width is None:
+            return limit
+        after = params['before'] - width - 1
+        if limit is not None and after <= limit:
+            return limit
+        return after
+
+
+    def observe(self, endpoint:str, params:dict, result, incomplete:bool=False):
+        """Update the density from a page
+
+        Args:
+            endpoint (str): Endpoint searched.
+            params (dict): Params the page was searched with.
+            result (PushshiftResponse): The page.
+            incomplete (bool, optional): Pushshift timed out or lost shards. Defaults to False.
+        """
+        key = self._key(endpoint, params)
+        before = params.get('before')
+        if before is not None and params.get('after') is not None:
+            # Pushshift counts every post in the window
+            density = result.metadata.get('total_results', 0) / max(1, before - params['after'] - 1)
+        else:
+            # Estimate from the posts on the page
+            top = result.max_created_at + 1 if before is None else before
+            density = result.metadata.get('results_returned', 0) / max(1, top - result.min_created_at)
+
+        with self.lock:
+            previous = self.density.get(key)
+            self.density[key] = density if previous is None else (previous + density) / 2
+            if incomplete:
+                self._shrink(key)
+            else:
+                self.scale[key] = min(1.0, self.scale.get(key, 1.0) * 1.1)
+
+
+    def on_incomplete(self, endpoint:str, params:dict):
+        """Shrink the windows for a query whose search timed out or lost shards"""
+        with self.lock:
+            self._shrink(self._key(endpoint, params))
+
+
+    def on_empty(self, endpoint:str, params:dict):
+        """Widen the windows for a query whose window had no posts"""
+        key = self._key(endpoint, params)
+        with self.lock:
+            self.empty_windows += 1
+            width = self._width(key)
+            if width is None:
+                return
+            # At most target_results posts in four times the window
+            self.density[key] = self.target_results / (self.scale.get(key, 1.0) * width * 4)
+
+
+    def stats(self) -> str:
+        return f"Query windows: {self.windows} searches, {self.empty_windows} empty windows, shrunk {self.shrinks} times."
+
+
+    def _width(self, key:tuple) -> int:
+        """Seconds in the next window, or None for no window. Call while holding the lock."""
+        density = self.density.get(key)
+        if density is None:
+            width = self.initial_seconds
+        elif density <= 0:
+            return None
+        else:
+            width = self.target_results / density * self.scale.get(key, 1.0)
+        if width > self.max_seconds:
+            return None
+        return int(max(self.min_seconds, width))
+
+
+    def _shrink(self, key:tuple):
+        """Call while holding the lock"""
+        self.shrinks += 1
+        self.scale[key] = max(self.min_scale, self.scale.get(key, 1.0) / 2)
+
+
+    def _key(self, endpoint:str, params:dict) -> tuple:
+        return (endpoint, params.get('subreddit'))
@@ -0,0 +1,150 @@
+# Adaptive rate limiting for Pushshift requests
+
+import json
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+
+from utils.metrics import Metrics
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate adapts to how Pushshift is responding.
+
+    The rate grows additively while responses are fast and clean, and is cut
+    multiplicatively on throttling (429), server errors (5xx) and searches that
+    time out (AIMD). A Retry-After header pauses all requests until it has
+    passed. One limiter can be shared between threads. Passing a state_file
+    shares the bucket between processes too, using a lock on the file.
+
+    The current rate is reported as the rate_limit gauge, in requests per
+    minute, and each cut as a rate_limit_throttles count.
+    """
+
+    def __init__(self, rate:float=100 / 60, min_rate:float=0.1, max_rate:float=4.0, burst:float=1.0, increase:float=0.01, decrease:float=0.5, target_latency:float=2.0, state_file:str=None, metrics:Metrics=None) -> None:
+        self.metrics = metrics or Metrics()
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.state_file = state_file
+
+        self.tokens = burst
+        self.updated = time.time()
+        self.blocked_until = 0.0
+
+        # Track stats
+        self.throttle_events = 0
+        self.requests = 0
+
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._state():
+                now = time.time()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return True
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+
+            time.sleep(wait)
+
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available now, without waiting
+
+        Returns:
+            bool: True if a request may be sent.
+        """
+        with self._state():
+            now = time.time()
+            self._refill(now)
+            if now >= self.blocked_until and self.tokens >= 1:
+                self.tokens -= 1
+                self.requests += 1
+                return True
+        return False
+
+
+    def on_success(self, latency:float):
+        """Increase the rate after a fast, clean response
+
+        Args:
+            latency (float): Seconds the request took.
+        """
+        if latency > self.target_latency:
+            return
+        with self._state():
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            rate = self.rate
+        self.metrics.gauge('rate_limit', rate * 60)
+
+
+    def on_throttle(self, retry_after:float=None):
+        """Cut the rate after a 429, a 5xx or a search that timed out
+
+        Args:
+            retry_after (float, optional): Seconds to pause all requests for. Defaults to None.
+        """
+        with self._state():
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0)
+            self.throttle_events += 1
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+            rate = self.rate
+        self.metrics.count('rate_limit_throttles')
+        self.metrics.gauge('rate_limit', rate * 60)
+
+
+    def stats(self) -> str:
+        return f"Rate: {round(self.rate * 60, 1)} requests/min. Throttle events: {self.throttle_events}."
+
+
+    def _refill(self, now:float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    @contextmanager
+    def _state(self):
+        """Hold the lock on the bucket, loading and saving it from the state file if shared between processes"""
+        with self.lock:
+            if self.state_file is None:
+                yield
+                return
+
+            with open(self.state_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    if content:
+                        state = json.loads(content)
+                        self.rate = state['rate']
+                        self.tokens = state['tokens']
+                        self.updated = state['updated']
+                        self.blocked_until = state['blocked_until']
+
+                    yield
+
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps({
+                        'rate': self.rate,
+                        'tokens': self.tokens,
+                        'updated': self.updated,
+                        'blocked_until': self.blocked_until
+                    }))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,119 @@
+# Split a Pushshift response body into raw per-record JSON without decoding the
+# records.
+#
+# Pushshift returns indented JSON. A raw newline can't appear inside a JSON
+# string, so a newline followed by exactly the records' indentation and a
+# brace can only be the start or end of a record. That lets the data array be
+# split with a few bytes operations, which is much faster than decoding and
+# re-encoding every record. Bodies that aren't indented return None so the
+# caller can decode them normally.
+
+import re
+import json
+
+
+class RawPage:
+    """Metadata and raw records split from a response body"""
+    __slots__ = ('metadata', 'records', 'created_utcs', 'ids', 'subreddits')
+
+    def __init__(self, metadata:dict, records:list, created_utcs:list, ids:list, subreddits:list) -> None:
+        self.metadata = metadata
+        self.records = records
+        self.created_utcs = created_utcs
+        self.ids = ids
+        self.subreddits = subreddits
+
+
+def split_response(body:bytes) -> RawPage:
+    """Split a Pushshift response body into its metadata and raw records
+
+    Args:
+        body (bytes): Indented response body with 'data' and 'metadata' keys.
+
+    Returns:
+        RawPage: Decoded metadata and the records as single line JSON bytes,
+            with their created_utc, id and subreddit. None if the body isn't indented JSON.
+    """
+    indent = _indent_unit(body)
+    if indent is None:
+        return None
+
+    # Pushshift puts the small metadata object after the data array
+    metadata = None
+    metadata_start = _find_top_level_key(body, indent, b'metadata', from_end=True)
+    if metadata_start != -1:
+        metadata_end = body.find(b'\n' + indent + b'}', metadata_start)
+        if metadata_end == -1:
+            return None
+        metadata = json.loads(body[metadata_start:metadata_end + len(indent) + 2])
+
+    data_start = _find_top_level_key(body, indent, b'data')
+    if data_start == -1 or body[data_start:data_start + 1] != b'[':
+        return None
+    if body[data_start:data_start + 2] == b'[]':
+        return RawPage(metadata, [], [], [], [])
+
+    # Records are indented by two levels and their fields by three
+    record_indent = b'\n' + indent * 2
+    first = body.find(record_indent + b'{', data_start)
+    data_end = body.rfind(b'\n' + indent + b']', data_start)
+    last = body.rfind(record_indent + b'}', data_start, data_end)
+    if first == -1 or data_end == -1 or last == -1:
+        return None
+    data = body[first:last + len(record_indent) + 1]
+
+    # Read the fields needed for paging from the record-level lines
+    created_utcs = []
+    ids = []
+    subreddits = []
+    for field, value in re.findall(rb'\n' + re.escape(indent * 3) + rb'"(created_utc|id|subreddit)": ([^\n]+?)(?=,?\n)', data):
+        if field == b'created_utc':
+            created_utcs.append(int(float(value)))
+        elif field == b'id':
+            ids.append(_string(value))
+        else:
+            subreddits.append(_string(value))
+
+    # Turn the separators between records into bare newlines, drop the
+    # indentation that follows every other newline, then split. Most lines
+    # are record fields, which are joined up first in one pass.
+    data = data.replace(record_indent + b'},' + record_indent + b'{', b'}\n{')
+    data = data.replace(record_indent + indent + b'"', b'"')
+    records = re.sub(rb'\n +', b'', data).split(b'\n')
+
+    if not subreddits:
+        subreddits = [None] * len(records)
+    if not len(created_utcs) == len(ids) == len(subreddits) == len(records):
+        return None
+
+    return RawPage(metadata, records, created_utcs, ids, subreddits)
+
+
+def _string(value:bytes) -> str:
+    # IDs and subreddit names rarely need unescaping
+    if value[:1] == b'"' and b'\\' not in value:
+        return value[1:-1].decode('utf-8')
+    return json.loads(value)
+
+
+def _indent_unit(body:bytes) -> bytes:
+    """Indentation of the first top level key, or None if the body isn't indented"""
+    pos = body.find(b'\n')
+    if pos == -1:
+        return None
+
+    end = pos + 1
+    while body[end:end + 1] == b' ':
+        end += 1
+
+    return body[pos + 1:end] or None
+
+
+def _find_top_level_key(body:bytes, indent:bytes, key:bytes, from_end:bool=False) -> int:
+    """Position of the value of a key of the outer object, or -1"""
+    prefix = b'\n' + indent + b'"' + key + b'": '
+    pos = body.rfind(prefix) if from_end else body.find(prefix)
+    if pos == -1:
+        return -1
+
+    return pos + len(prefix)
@@ -0,0 +1,131 @@
+# Trim posts to the fields that are used and drop posts that aren't wanted,
+# before they are serialized
+
+import json
+import threading
+
+# Fields needed to page, checkpoint and partition posts. They are always
+# requested from Pushshift and never removed.
+REQUIRED_FIELDS = ['created_utc', 'id', 'subreddit']
+
+# Bodies of posts removed by moderators or deleted by their authors
+REMOVED_BODIES = {'[removed]', '[deleted]'}
+
+
+class RecordFilter:
+    """Field projection and simple predicates for posts.
+
+    fields is an allow list. It is sent to Pushshift as the fields param, so
+    other fields aren't downloaded, and applied to posts again in case
+    Pushshift ignored it. exclude_fields is a deny list applied locally, for
+    large fields such as all_awardings or preview that can't be excluded in
+    the query. Posts are dropped if drop_removed is set and their body or
+    selftext is [removed] or [deleted], if their author is in exclude_authors
+    (case insensitive), or if their score is below min_score.
+
+    Raw JSON posts from passthrough are only decoded if there are predicates
+    or a deny list. The allow list is left to Pushshift for them.
+    """
+
+    def __init__(self, fields:list=None, exclude_fields:list=None, drop_removed:bool=False, exclude_authors:list=None, min_score:int=None) -> None:
+        self.fields = set(fields) | set(REQUIRED_FIELDS) if fields else None
+        self.exclude_fields = set(exclude_fields or []) - set(REQUIRED_FIELDS)
+        self.drop_removed = drop_removed
+        self.exclude_authors = set(author.lower() for author in exclude_authors or [])
+        self.min_score = min_score
+        self.lock = threading.Lock()
+
+        # Track stats
+        self.records_in = 0
+        self.records_dropped = 0
+
+        self.has_predicates = drop_removed or bool(self.exclude_authors) or min_score is not None
+        self.active = self.has_predicates or self.fields is not None or bool(self.exclude_fields)
+        self.decode = self.has_predicates or bool(self.exclude_fields)
+
+
+    def __getstate__(self):
+        # Filters are copied to worker processes without their lock
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+
+    def __setstate__(self, state:dict):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+    def api_fields(self) -> list:
+        """Fields to request from Pushshift, including those the predicates need, or None for all"""
+        if self.fields is None:
+            return None
+        fields = set(self.fields)
+        if self.drop_removed:
+            fields |= {'body', 'selftext'}
+        if self.exclude_authors:
+            fields.add('author')
+        if self.min_score is not None:
+            fields.add('score')
+        return sorted(fields)
+
+
+    def apply(self, data:list) -> list:
+        """Drop unwanted posts and fields
+
+        Args:
+            data (list): Posts as dicts, or raw JSON bytes.
+
+        Returns:
+            list: The posts to keep. Decoded raw posts are returned as dicts.
+        """
+        if not self.active:
+            return data
+
+        kept = [record for record in map(self.filter_record, data) if record is not None]
+        self.count(len(data), len(data) - len(kept))
+
+        return kept
+
+
+    def filter_record(self, record):
+        """A post without the unwanted fields, or None if it should be dropped"""
+        if isinstance(record, bytes):
+            if not self.decode:
+                return record
+            record = json.loads(record)
+        if self.has_predicates and not self.keep(record):
+            return None
+        return self.project(record)
+
+
+    def count(self, records_in:int, records_dropped:int):
+        with self.lock:
+            self.records_in += records_in
+            self.records_dropped += records_dropped
+
+
+    def keep(self, record:dict) -> bool:
+        """Whether a post passes the predicates"""
+        if self.drop_removed and (record.get('body') in REMOVED_BODIES or record.get('selftext') in REMOVED_BODIES):
+            return False
+        if self.exclude_authors and str(record.get('author')).lower() in self.exclude_authors:
+            return False
+        if self.min_score is not None:
+            score = record.get('score')
+            if not isinstance(score, (int, float)) or score < self.min_score:
+                return False
+        return True
+
+
+    def project(self, record:dict) -> dict:
+        """Only the allowed fields of a post, without the excluded ones"""
+        if self.fields is not None:
+            record = {key: value for key, value in record.items() if key in self.fields}
+        if self.exclude_fields:
+            record = {key: value for key, value in record.items() if key not in self.exclude_fields}
+        return record
+
+
+    def stats(self) -> str:
+        return f"Filtered {self.records_dropped} of {self.records_in} posts."
@@ -0,0 +1,214 @@
+# Cache Pushshift responses on disk so crawls can be replayed without
+# downloading the same pages again
+
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+CACHE_MODES = ['use', 'replay', 'refresh']
+
+
+class CacheMissError(Exception):
+    """Raised in replay mode when a page isn't in the cache"""
+
+
+class CachedResponse:
+    """The parts of a requests.Response that PushshiftResponse reads"""
+
+    status_code = 200
+    ok = True
+    headers = {}
+
+    def __init__(self, content:bytes) -> None:
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def cache_key(endpoint:str, params:dict) -> str:
+    """Canonical form of a query. Param order and the order and case of
+    subreddits don't change the results, so they don't change the key."""
+    canonical = dict(params)
+    if 'subreddit' in canonical:
+        canonical['subreddit'] = ','.join(sorted(set(s.lower() for s in str(canonical['subreddit']).split(','))))
+    return f"{endpoint}?{urlencode(sorted((key, str(value)) for key, value in canonical.items()))}"
+
+
+class ResponseCache:
+    """Content-addressed cache of response bodies.
+
+    Bodies are stored gzipped in files named after the SHA-256 of the
+    canonical query, with a SQLite index of their size and when they were
+    stored and last used. Entries older than ttl seconds are dropped. When
+    the cache holds more than max_bytes, the least recently used entries are
+    evicted.
+
+    Modes:
+        use: serve cached pages and cache pages fetched from Pushshift.
+        replay: only serve cached pages. A page that isn't cached raises CacheMissError.
+        refresh: always fetch from Pushshift and replace cached pages.
+    """
+
+    def __init__(self, cloudwatch_logger, directory:str, mode:str='use', max_bytes:int=10 * 1024 ** 3, ttl:float=None, compression_level:int=6) -> None:
+        if mode not in CACHE_MODES:
+            raise Exception(f'Unknown cache mode {mode}. Choose from {CACHE_MODES}.')
+
+        self.cloudwatch = cloudwatch_logger
+        self.directory = directory
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+
+        # Track stats
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # The index can be rebuilt from nothing, so it doesn't need to survive a crash
+        self.db = sqlite3.connect(os.path.join(self.directory, 'index.db'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=OFF')
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                digest TEXT PRIMARY KEY,
+                key TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                used_at REAL NOT NULL)''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+
+    def get(self, endpoint:str, params:dict):
+        """Get a cached response for a query
+
+        Returns:
+            CachedResponse: The cached response, or None if it isn't cached or the mode is refresh.
+
+        Raises:
+            CacheMissError: The query isn't cached and the mode is replay.
+        """
+        if self.mode == 'refresh':
+            return None
+
+        key = cache_key(endpoint, params)
+        digest = self._digest(key)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT stored_at FROM responses WHERE digest = ?', (digest,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[0] > self.ttl:
+                self._delete(digest)
+                row = None
+            if row is not None:
+                self.db.execute('UPDATE responses SET used_at = ? WHERE digest = ?', (now, digest))
+                self.db.commit()
+
+        content = None
+        if row is not None:
+            try:
+                with open(self._path(digest), 'rb') as f:
+                    content = gzip.decompress(f.read())
+            except (OSError, EOFError):
+                # The file was removed or is truncated. Forget it.
+                with self.lock:
+                    self._delete(digest)
+
+        with self.lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if content is None:
+            if self.mode == 'replay':
+                message = f"ERROR: Page not in response cache {self.directory} and replaying without network. Query: {key}"
+                self.cloudwatch.log(message)
+                raise CacheMissError(message)
+            return None
+
+        return CachedResponse(content)
+
+
+    def put(self, endpoint:str, params:dict, content:bytes):
+        """Store a response body, evicting the least recently used if the cache is full"""
+        key = cache_key(endpoint, params)
+        digest = self._digest(key)
+        path = self._path(digest)
+        data = gzip.compress(content, compresslevel=self.compression_level, mtime=0)
+
+        # Write the file before indexing it, so the index never points at a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT size FROM responses WHERE digest = ?', (digest,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses (digest, key, size, stored_at, used_at) VALUES (?, ?, ?, ?, ?)',
+                (digest, key, len(data), now, now))
+            self.total_bytes += len(data)
+            self.stores += 1
+            self._evict()
+            self.db.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+    def stats(self) -> str:
+        return (f"Response cache ({self.mode}): {self.hits} hits, {self.misses} misses, {self.stores} stored, "
+                f"{self.evictions} evicted. {round(self.total_bytes / 1024 ** 2, 1)} MiB cached.")
+
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits. Call while holding the lock."""
+        while self.total_bytes > self.max_bytes:
+            rows = self.db.execute('SELECT digest FROM responses ORDER BY used_at LIMIT 100').fetchall()
+            if not rows:
+                break
+            for (digest,) in rows:
+                self._delete(digest)
+                self.evictions += 1
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+
+    def _delete(self, digest:str):
+        """Remove an entry and its file. Call while holding the lock."""
+        row = self.db.execute('SELECT size FROM responses WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            return
+        self.db.execute('DELETE FROM responses WHERE digest = ?', (digest,))
+        self.total_bytes -= row[0]
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+
+    def _digest(self, key:str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+    def _path(self, digest:str) -> str:
+        # Spread files over 256 directories
+        return os.path.join(self.directory, digest[:2], f'{digest}.json.gz')
@@ -0,0 +1,130 @@
+# Serializers that turn posts into JSON lines, and compressors for the records
+# sent to Firehose. orjson and zstandard are optional and only imported when
+# they are used.
+
+import gzip
+import json
+import threading
+
+from utils.metrics import Metrics
+from utils.record_filter import RecordFilter
+
+SERIALIZERS = ['json', 'orjson']
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+
+
+class JsonSerializer:
+    """Serialize posts with the standard library json module"""
+    name = 'json'
+
+    def dumps(self, record:dict) -> bytes:
+        """Newline terminated, UTF-8 encoded JSON line"""
+        return (json.dumps(record) + '\n').encode('utf-8')
+
+
+class OrjsonSerializer:
+    """Serialize posts with orjson, which writes UTF-8 bytes directly"""
+    name = 'orjson'
+
+    def __init__(self) -> None:
+        import orjson
+        self.orjson = orjson
+        self.option = orjson.OPT_APPEND_NEWLINE
+
+    def dumps(self, record:dict) -> bytes:
+        """Newline terminated, UTF-8 encoded JSON line"""
+        return self.orjson.dumps(record, option=self.option)
+
+
+class GzipCompressor:
+    """Compress each record into a gzip member. Concatenated members are a
+    valid gzip file, so objects written to S3 can be read with gunzip."""
+    name = 'gzip'
+
+    def __init__(self, level:int=6) -> None:
+        self.level = level
+
+    def compress(self, data:bytes) -> bytes:
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+
+class ZstdCompressor:
+    """Compress each record into a zstd frame. Concatenated frames are a valid
+    zstd file."""
+    name = 'zstd'
+
+    def __init__(self, level:int=3) -> None:
+        import zstandard
+        self.zstandard = zstandard
+        self.level = level
+
+        # Compression contexts can't be shared between threads
+        self.local = threading.local()
+
+    def compress(self, data:bytes) -> bytes:
+        compressor = getattr(self.local, 'compressor', None)
+        if compressor is None:
+            compressor = self.local.compressor = self.zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(data)
+
+
+def get_serializer(name:str='json'):
+    """Get a serializer by name
+
+    Args:
+        name (str, optional): json or orjson. Defaults to json.
+
+    Returns:
+        A serializer with a dumps(record) method returning a JSON line.
+    """
+    if name == 'json':
+        return JsonSerializer()
+    if name == 'orjson':
+        try:
+            return OrjsonSerializer()
+        except ImportError:
+            raise Exception('The orjson serializer needs orjson. Install it with: pip install orjson')
+
+    raise Exception(f'Unknown serializer {name}. Choose from {SERIALIZERS}.')
+
+
+def filter_records(data:list, record_filter:RecordFilter, metrics:Metrics) -> list:
+    """Drop unwanted posts and fields with the record filter, if there is one"""
+    if record_filter is None or not record_filter.active:
+        return data
+    with metrics.timer('filter'):
+        kept = record_filter.apply(data)
+    metrics.count('records_filtered', len(data) - len(kept))
+    return kept
+
+
+def serialize_records(data:list, serializer, metrics:Metrics) -> list:
+    """Convert records to newline terminated, UTF-8 encoded JSON lines.
+    Records that are already raw JSON bytes are passed through."""
+    dumps = serializer.dumps
+    with metrics.timer('serialization'):
+        return [record + b'\n' if isinstance(record, bytes) else dumps(record) for record in data]
+
+
+def get_compressor(name:str=None, level:int=None):
+    """Get a compressor by name
+
+    Args:
+        name (str, optional): none, gzip or zstd. Defaults to None (no compression).
+        level (int, optional): Compression level. Defaults to the compressor's default.
+
+    Returns:
+        A compressor with a compress(data) method, or None.
+    """
+    if name is None or name == 'none':
+        return None
+    kwargs = {} if level is None else {'level': level}
+    if name == 'gzip':
+        return GzipCompressor(**kwargs)
+    if name == 'zstd':
+        try:
+            return ZstdCompressor(**kwargs)
+        except ImportError:
+            raise Exception('zstd compression needs zstandard. Install it with: pip install zstandard')
+
+    raise Exception(f'Unknown compression {name}. Choose from {COMPRESSIONS}.')
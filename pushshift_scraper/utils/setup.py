@@ -0,0 +1,457 @@
+# Settings and services shared by the scraper and the job scheduler
+
+import argparse
+import configparser
+import os
+
+from utils import aws
+from utils.cloudwatch import CloudWatchLog
+from utils.firehose import Firehose
+from utils.local_logs import MetadataLog
+from utils.local_sink import LocalSink, SINKS
+from utils.memory_budget import MemoryBudget
+from utils.metrics import Metrics, DESTINATIONS
+from utils.process_pool import DecodePool
+from utils.pushshift_api import PushshiftAPI
+from utils.query_window import WindowPlanner
+from utils.rate_limiter import AdaptiveRateLimiter
+from utils.record_filter import RecordFilter
+from utils.response_cache import ResponseCache, CACHE_MODES
+from utils.serialization import SERIALIZERS, COMPRESSIONS
+from utils.spool import Spool
+from utils.startup import StartupTimer
+
+
+def _optional(config:configparser.ConfigParser, section:str, key:str, convert=str):
+    """A setting that may be left empty, converted if it isn't"""
+    value = config.get(section, key, fallback=None) or None
+    return convert(value) if value is not None else None
+
+
+def _list(config:configparser.ConfigParser, section:str, key:str) -> list:
+    """A comma separated setting"""
+    return [item.strip() for item in config.get(section, key, fallback='').split(',') if item.strip()]
+
+
+class Settings:
+    """Settings from settings.cfg, overridden by command line arguments.
+
+    add_arguments() adds the arguments both entry points take, and override()
+    applies them. Arguments only one entry point takes are applied by that
+    script.
+    """
+
+    def __init__(self, filename:str='pushshift_scraper/settings.cfg') -> None:
+        config = configparser.ConfigParser()
+        config.read(filename)
+
+        self.local_log_filename = config['local_log']['filename']
+        self.checkpoint_filename = _optional(config, 'local_log', 'checkpoint_filename')
+        self.local_log_history = config.getboolean('local_log', 'history', fallback=True)
+        self.local_log_max_bytes = config.getint('local_log', 'history_max_bytes', fallback=100 * 1024 * 1024)
+        self.local_log_backups = config.getint('local_log', 'history_backups', fallback=5)
+        self.ingest_lag = config.getint('local_log', 'ingest_lag', fallback=3600)
+        self.cloudwatch_log_group = config['cloudwatch']['log_group']
+        self.cloudwatch_log_stream = config['cloudwatch']['log_stream']
+        self.cloudwatch_flush_interval = config.getfloat('cloudwatch', 'flush_interval', fallback=5.0)
+        self.cloudwatch_create_log_stream = config.getboolean('cloudwatch', 'create_log_stream', fallback=True)
+        self.cloudwatch_remote = True
+        self.aws_max_pool_connections = config.getint('aws', 'max_pool_connections', fallback=50)
+        self.firehose_test = config['firehose']['test_destination']
+        self.firehose_comments = config['firehose']['comments_destination']
+        self.firehose_submissions = config['firehose']['submissions_destination']
+        self.firehose_buffered = config.getboolean('firehose', 'buffered', fallback=False)
+        self.firehose_max_latency = config.getfloat('firehose', 'max_latency', fallback=60.0)
+        self.firehose_max_retries = config.getint('firehose', 'max_retries', fallback=8)
+        self.serializer = config.get('firehose', 'serializer', fallback='json') or 'json'
+        self.firehose_compression = _optional(config, 'firehose', 'compression')
+        self.firehose_compression_level = _optional(config, 'firehose', 'compression_level', int)
+        self.sink = config.get('output', 'sink', fallback='firehose') or 'firehose'
+        self.local_directory = config.get('local_sink', 'directory', fallback='output') or 'output'
+        self.local_partition_format = config.get('local_sink', 'partition_format', fallback='year=%Y/month=%m/day=%d', raw=True)
+        self.local_compression = config.get('local_sink', 'compression', fallback='gzip') or None
+        self.local_compression_level = _optional(config, 'local_sink', 'compression_level', int)
+        self.local_max_file_bytes = config.getint('local_sink', 'max_file_bytes', fallback=128 * 1024 * 1024)
+        self.local_buffer_bytes = config.getint('local_sink', 'buffer_bytes', fallback=8 * 1024 * 1024)
+        self.local_max_latency = config.getfloat('local_sink', 'max_latency', fallback=60.0)
+        self.spool_directory = _optional(config, 'spool', 'directory')
+        self.spool_segment_bytes = config.getint('spool', 'segment_bytes', fallback=8 * 1024 * 1024)
+        self.spool_max_bytes = config.getint('spool', 'max_bytes', fallback=1024 * 1024 * 1024)
+        self.spool_fsync_interval = config.getfloat('spool', 'fsync_interval', fallback=1.0)
+        self.rate_limit = config.getfloat('rate_limit', 'requests_per_minute', fallback=100)
+        self.rate_limit_min = config.getfloat('rate_limit', 'min_requests_per_minute', fallback=6)
+        self.rate_limit_max = config.getfloat('rate_limit', 'max_requests_per_minute', fallback=240)
+        self.rate_limit_target_latency = config.getfloat('rate_limit', 'target_latency', fallback=2.0)
+        self.rate_limit_state_file = _optional(config, 'rate_limit', 'state_file')
+        self.pushshift_passthrough = config.getboolean('pushshift', 'passthrough', fallback=False)
+        self.pushshift_base_url = config.get('pushshift', 'base_url', fallback=None) or 'https://api.pushshift.io'
+        self.pushshift_connect_timeout = config.getfloat('pushshift', 'connect_timeout', fallback=10.0)
+        self.pushshift_read_timeout = config.getfloat('pushshift', 'read_timeout', fallback=60.0)
+        self.pushshift_hedge_percentile = _optional(config, 'pushshift', 'hedge_percentile', float)
+        self.pushshift_incomplete_retries = config.getint('pushshift', 'incomplete_retries', fallback=2)
+        self.pushshift_memory_budget = _optional(config, 'pushshift', 'memory_budget', int)
+        self.process_workers = config.getint('processes', 'workers', fallback=0)
+        self.window_target_results = _optional(config, 'window', 'target_results', int)
+        self.window_min_seconds = config.getint('window', 'min_seconds', fallback=60)
+        self.window_max_seconds = config.getint('window', 'max_seconds', fallback=365 * 24 * 3600)
+        self.window_initial_seconds = config.getint('window', 'initial_seconds', fallback=3600)
+        self.pipeline_queue_size = config.getint('pipeline', 'queue_size', fallback=4)
+        self.shard_workers = config.getint('sharding', 'workers', fallback=4)
+        self.shard_checkpoint_filename = config.get('sharding', 'checkpoint_filename', fallback='shards.json')
+        self.shard_min_seconds = config.getint('sharding', 'min_shard_seconds', fallback=3600)
+        self.follow_min_interval = config.getfloat('follow', 'min_interval', fallback=30.0)
+        self.follow_max_interval = config.getfloat('follow', 'max_interval', fallback=900.0)
+        self.follow_target_posts = config.getint('follow', 'target_posts', fallback=50)
+        self.follow_max_batch = config.getint('follow', 'max_batch', fallback=25)
+        self.scheduler_workers = config.getint('scheduler', 'workers', fallback=4)
+        self.scheduler_progress_interval = config.getint('scheduler', 'progress_interval', fallback=100)
+        self.metrics_destination = config.get('metrics', 'destination', fallback='none') or 'none'
+        self.metrics_interval = config.getfloat('metrics', 'interval', fallback=60.0)
+        self.metrics_namespace = config.get('metrics', 'namespace', fallback='PushshiftScraper')
+        self.metrics_filename = _optional(config, 'metrics', 'filename')
+        self.cache_directory = _optional(config, 'cache', 'directory')
+        self.cache_mode = config.get('cache', 'mode', fallback='use') or 'use'
+        self.cache_max_bytes = config.getint('cache', 'max_bytes', fallback=10 * 1024 ** 3)
+        self.cache_ttl = _optional(config, 'cache', 'ttl', float)
+        self.filter_fields = _list(config, 'filter', 'fields')
+        self.filter_exclude_fields = _list(config, 'filter', 'exclude_fields')
+        self.filter_drop_removed = config.getboolean('filter', 'drop_removed', fallback=False)
+        self.filter_exclude_authors = _list(config, 'filter', 'exclude_authors')
+        self.filter_min_score = _optional(config, 'filter', 'min_score', int)
+
+
+    @staticmethod
+    def add_arguments(parser:argparse.ArgumentParser):
+        """Add the arguments both entry points take"""
+        parser.add_argument('--local_log', help='Local log file to write metadata to.')
+        parser.add_argument('--checkpoints', help='SQLite file to store resume checkpoints in.')
+        parser.add_argument('--no_history', action='store_true', help='Do not write the metadata of every page to the local log.')
+        parser.add_argument('--ingest_lag', type=int, help='Seconds Pushshift may take to ingest new posts. Coverage is not recorded past this many seconds ago.')
+        parser.add_argument('--cloudwatch_log_group', help='Cloudwatch log group to write to.')
+        parser.add_argument('--cloudwatch_log_stream', help='Cloudwatch log stream to write to.')
+        parser.add_argument('--no_cloudwatch', action='store_true', help='Only print log messages, without sending them to CloudWatch.')
+        parser.add_argument('--no_create_log_stream', action='store_true', help='Do not create the Cloudwatch log stream. Use if it already exists.')
+        parser.add_argument('--test', action='store_true', help='Do a test run.')
+        parser.add_argument('--buffer_firehose', action='store_true', help='Pack posts from several pages into full Firehose batches.')
+        parser.add_argument('--serializer', choices=SERIALIZERS, help='JSON serializer to use for posts sent to Firehose.')
+        parser.add_argument('--compression', choices=COMPRESSIONS, help='Compress each Firehose record, or local files.')
+        parser.add_argument('--sink', choices=SINKS, help='Where to send posts: firehose, or local files.')
+        parser.add_argument('--output_dir', help='Directory to write posts to with --sink local. The job scheduler writes each delivery stream to a subdirectory.')
+        parser.add_argument('--spool', help='Spool results to this directory and send them to Firehose in the background. The job scheduler spools each delivery stream to a subdirectory.')
+        parser.add_argument('--memory_budget', type=int, help='Bytes of fetched posts to hold in memory before waiting for the sink.')
+        parser.add_argument('--processes', type=int, help='Decode, filter and serialize pages in this many worker processes. 0 to decode in the main process.')
+        parser.add_argument('--window_target_results', type=int, help='Limit searches to windows expected to match this many posts.')
+        parser.add_argument('--no_window', action='store_true', help='Do not limit searches to windows sized to the density of posts.')
+        parser.add_argument('--hedge_percentile', type=float, help='Send a second request when a page is slower than this percentile of recent requests.')
+        parser.add_argument('--no_hedge', action='store_true', help='Do not send a second request when a page is slow.')
+        parser.add_argument('--passthrough', action='store_true', help='Send posts to Firehose as returned by Pushshift without decoding them.')
+        parser.add_argument('--metrics', choices=DESTINATIONS, help='Where to report stage timings and counters: cloudwatch, file, both or none.')
+        parser.add_argument('--metrics_file', help='Local file to append metrics to.')
+        parser.add_argument('--cache', help='Directory to cache Pushshift responses in.')
+        parser.add_argument('--cache_mode', choices=CACHE_MODES, help='use: serve and store cached pages. replay: only serve cached pages. refresh: fetch every page again.')
+        parser.add_argument('--fields', nargs='+', help='Only request and send these fields of each post.')
+        parser.add_argument('--exclude_fields', nargs='+', help='Remove these fields from each post before sending it.')
+        parser.add_argument('--drop_removed', action='store_true', help='Drop posts whose body or selftext is [removed] or [deleted].')
+        parser.add_argument('--exclude_authors', nargs='+', help='Drop posts by these authors.')
+        parser.add_argument('--min_score', type=int, help='Drop posts with a lower score.')
+
+
+    def override(self, args:dict):
+        """Override settings.cfg with the arguments added by add_arguments()"""
+        if args['local_log'] is not None:
+            self.local_log_filename = args['local_log']
+        if args['checkpoints'] is not None:
+            self.checkpoint_filename = args['checkpoints']
+        if args['no_history']:
+            self.local_log_history = False
+        if args['ingest_lag'] is not None:
+            self.ingest_lag = args['ingest_lag']
+        if args['cloudwatch_log_group'] is not None:
+            self.cloudwatch_log_group = args['cloudwatch_log_group']
+        if args['cloudwatch_log_stream'] is not None:
+            self.cloudwatch_log_stream = args['cloudwatch_log_stream']
+        if args['no_cloudwatch']:
+            self.cloudwatch_remote = False
+        if args['no_create_log_stream']:
+            self.cloudwatch_create_log_stream = False
+        if args['buffer_firehose']:
+            self.firehose_buffered = True
+        if args['serializer'] is not None:
+            self.serializer = args['serializer']
+        if args['compression'] is not None:
+            self.firehose_compression = args['compression']
+            self.local_compression = args['compression']
+        if args['sink'] is not None:
+            self.sink = args['sink']
+        if args['output_dir'] is not None:
+            self.local_directory = args['output_dir']
+        if args['spool'] is not None:
+            self.spool_directory = args['spool']
+        if args['memory_budget'] is not None:
+            self.pushshift_memory_budget = args['memory_budget']
+        if args['processes'] is not None:
+            self.process_workers = args['processes']
+        if args['window_target_results'] is not None:
+            self.window_target_results = args['window_target_results']
+        if args['no_window']:
+            self.window_target_results = None
+        if args['hedge_percentile'] is not None:
+            self.pushshift_hedge_percentile = args['hedge_percentile']
+        if args['no_hedge']:
+            self.pushshift_hedge_percentile = None
+        if args['passthrough']:
+            self.pushshift_passthrough = True
+        if args['metrics'] is not None:
+            self.metrics_destination = args['metrics']
+        if args['metrics_file'] is not None:
+            self.metrics_filename = args['metrics_file']
+        if args['cache'] is not None:
+            self.cache_directory = args['cache']
+        if args['cache_mode'] is not None:
+            self.cache_mode = args['cache_mode']
+        if args['fields'] is not None:
+            self.filter_fields = args['fields']
+        if args['exclude_fields'] is not None:
+            self.filter_exclude_fields = args['exclude_fields']
+        if args['drop_removed']:
+            self.filter_drop_removed = True
+        if args['exclude_authors'] is not None:
+            self.filter_exclude_authors = args['exclude_authors']
+        if args['min_score'] is not None:
+            self.filter_min_score = args['min_score']
+
+
+    def describe(self) -> str:
+        """Lines for the 'Using parameters' log message"""
+        return f"""Passthrough: {self.pushshift_passthrough}
+        Pushshift timeouts: {self.pushshift_connect_timeout}s connect, {self.pushshift_read_timeout}s read (hedge at p{self.pushshift_hedge_percentile})
+        Memory budget: {self.pushshift_memory_budget} bytes
+        Worker processes: {self.process_workers}
+        Query windows: {self.window_target_results} posts ({self.window_min_seconds}s to {self.window_max_seconds}s)
+        Local log: {self.local_log_filename} (history {self.local_log_history}, ingest lag {self.ingest_lag}s)
+        Cloudwatch log group:{self.cloudwatch_log_group}
+        Cloudwatch log stream: {self.cloudwatch_log_stream}
+        Firehose buffered: {self.firehose_buffered} (max latency {self.firehose_max_latency}s)
+        Firehose serializer: {self.serializer} (compression {self.firehose_compression})
+        Spool: {self.spool_directory}
+        Metrics: {self.metrics_destination} (every {self.metrics_interval}s)
+        Response cache: {self.cache_directory} ({self.cache_mode})
+        Fields: {self.filter_fields or 'all'} (excluding {self.filter_exclude_fields})
+        Filters: drop removed {self.filter_drop_removed}, excluded authors {self.filter_exclude_authors}, min score {self.filter_min_score}"""
+
+
+def create_cloudwatch(settings:Settings) -> CloudWatchLog:
+    """CloudWatch logging. Without a log group, messages are only printed.
+
+    AWS clients are created in the background from one shared session.
+    """
+    aws.configure(max_pool_connections=settings.aws_max_pool_connections)
+    return CloudWatchLog(
+        log_group=settings.cloudwatch_log_group,
+        log_stream=settings.cloudwatch_log_stream,
+        flush_interval=settings.cloudwatch_flush_interval,
+        create_stream=settings.cloudwatch_create_log_stream,
+        remote=settings.cloudwatch_remote and settings.cloudwatch_log_group not in (None, '', 'None'))
+
+
+def create_metrics(settings:Settings, cloudwatch_logger:CloudWatchLog, dimensions:dict=None) -> Metrics:
+    """Time each stage and report metrics every metrics_interval seconds
+
+    Without a CloudWatch log stream to send them to, metrics meant for
+    CloudWatch are only written to the metrics file, if that was asked for too.
+    """
+    destination = settings.metrics_destination
+    if not cloudwatch_logger.remote and destination in ('cloudwatch', 'both'):
+        destination = 'file' if destination == 'both' else 'none'
+        cloudwatch_logger.log(f"Not sending metrics to CloudWatch without a log stream. Metrics destination: {destination}.")
+    return Metrics(
+        cloudwatch_logger=cloudwatch_logger,
+        namespace=settings.metrics_namespace,
+        dimensions=dimensions,
+        interval=settings.metrics_interval,
+        destination=destination,
+        filename=settings.metrics_filename)
+
+
+def create_record_filter(settings:Settings) -> RecordFilter:
+    """Drop unwanted posts and fields before they are serialized
+
+    The fields to keep are also requested from Pushshift so the rest aren't
+    downloaded.
+    """
+    return RecordFilter(
+        fields=settings.filter_fields,
+        exclude_fields=settings.filter_exclude_fields,
+        drop_removed=settings.filter_drop_removed,
+        exclude_authors=settings.filter_exclude_authors,
+        min_score=settings.filter_min_score)
+
+
+def create_decode_pool(settings:Settings, cloudwatch_logger:CloudWatchLog, record_filter:RecordFilter, metrics:Metrics, fetchers:int=1) -> tuple:
+    """Optionally decode, filter and serialize pages in worker processes
+
+    Each fetching thread waits for its page to be decoded, so worker processes
+    are only used when several threads fetch at once.
+
+    Args:
+        fetchers (int, optional): Threads fetching pages at once. Defaults to 1.
+
+    Returns:
+        tuple: The DecodePool, or None, and the record filter for sinks to
+            apply. Pages from the pool arrive at the sink already filtered.
+    """
+    if settings.process_workers <= 0:
+        return None, record_filter
+    if fetchers <= 1:
+        cloudwatch_logger.log(f"WARNING: Ignoring {settings.process_workers} worker processes. Pages are fetched one at a time, so they would be decoded one at a time too. Use them with --shards or several scheduler workers.")
+        return None, record_filter
+    decode_pool = DecodePool(
+        workers=settings.process_workers,
+        serializer=settings.serializer,
+        record_filter=record_filter,
+        metrics=metrics)
+    return decode_pool, None
+
+
+def create_sink(settings:Settings, cloudwatch_logger:CloudWatchLog, delivery_stream:str, prefix:str, metrics:Metrics, record_filter:RecordFilter, subdirectory:str=None):
+    """A sink for one delivery stream. Sinks all have the same interface as Firehose.
+
+    Args:
+        delivery_stream (str): Firehose delivery stream.
+        prefix (str): Prefix of local files.
+        subdirectory (str, optional): Subdirectory of the local and spool
+            directories to write to. Defaults to None.
+    """
+    if settings.sink == 'local':
+        # Write date-partitioned files to upload to S3 in bulk later
+        return LocalSink(
+            cloudwatch_logger=cloudwatch_logger,
+            directory=os.path.join(settings.local_directory, subdirectory or ''),
+            prefix=prefix,
+            partition_format=settings.local_partition_format,
+            max_file_bytes=settings.local_max_file_bytes,
+            buffer_bytes=settings.local_buffer_bytes,
+            max_latency=settings.local_max_latency,
+            serializer=settings.serializer,
+            compression=settings.local_compression,
+            compression_level=settings.local_compression_level,
+            metrics=metrics,
+            record_filter=record_filter)
+
+    sink = Firehose(
+        cloudwatch_logger=cloudwatch_logger,
+        delivery_stream=delivery_stream,
+        buffered=settings.firehose_buffered,
+        max_latency=settings.firehose_max_latency,
+        max_retries=settings.firehose_max_retries,
+        serializer=settings.serializer,
+        compression=settings.firehose_compression,
+        compression_level=settings.firehose_compression_level,
+        metrics=metrics,
+        record_filter=record_filter)
+
+    # Optionally spool results to local disk so crawling doesn't depend on
+    # Firehose being available.
+    if settings.spool_directory is not None:
+        sink = Spool(
+            firehose=sink,
+            cloudwatch_logger=cloudwatch_logger,
+            directory=os.path.join(settings.spool_directory, subdirectory or ''),
+            segment_bytes=settings.spool_segment_bytes,
+            max_bytes=settings.spool_max_bytes,
+            fsync_interval=settings.spool_fsync_interval,
+            max_latency=settings.firehose_max_latency)
+    return sink
+
+
+def create_metadata_log(settings:Settings, cloudwatch_logger:CloudWatchLog, metrics:Metrics, filter_subreddits:list=None, post_type:str=None) -> MetadataLog:
+    """Local metadata log and checkpoints, to pick up where a crawl left off"""
+    return MetadataLog(
+        cloudwatch_logger=cloudwatch_logger,
+        filename=settings.local_log_filename,
+        filter_subreddits=filter_subreddits,
+        post_type=post_type,
+        checkpoint_filename=settings.checkpoint_filename,
+        history=settings.local_log_history,
+        history_max_bytes=settings.local_log_max_bytes,
+        history_backups=settings.local_log_backups,
+        metrics=metrics,
+        ingest_lag=settings.ingest_lag)
+
+
+def create_api(settings:Settings, cloudwatch_logger:CloudWatchLog, metrics:Metrics, record_filter:RecordFilter, decode_pool:DecodePool=None, pool_maxsize:int=10, startup:StartupTimer=None) -> PushshiftAPI:
+    """The Pushshift API with its rate limiter, response cache, memory budget and window planner
+
+    The rate adapts to how Pushshift is responding. Processes that use the
+    same state file share one rate limit.
+    """
+    rate_limiter = AdaptiveRateLimiter(
+        rate=settings.rate_limit / 60,
+        min_rate=settings.rate_limit_min / 60,
+        max_rate=settings.rate_limit_max / 60,
+        target_latency=settings.rate_limit_target_latency,
+        state_file=settings.rate_limit_state_file,
+        metrics=metrics)
+
+    # Optionally cache responses on disk to rerun crawls without Pushshift
+    cache = None
+    if settings.cache_directory is not None:
+        cache = ResponseCache(
+            cloudwatch_logger=cloudwatch_logger,
+            directory=settings.cache_directory,
+            mode=settings.cache_mode,
+            max_bytes=settings.cache_max_bytes,
+            ttl=settings.cache_ttl)
+
+    # Pages fetched by the pipeline and shard workers count against one
+    # budget until their posts are handed to the sink. Posts buffered by the
+    # sinks aren't counted, they're limited by the sinks' own batch sizes
+    memory_budget = MemoryBudget(settings.pushshift_memory_budget) if settings.pushshift_memory_budget is not None else None
+
+    # Optionally search windows of time sized to the density of posts
+    window_planner = None
+    if settings.window_target_results is not None:
+        window_planner = WindowPlanner(
+            target_results=settings.window_target_results,
+            min_seconds=settings.window_min_seconds,
+            max_seconds=settings.window_max_seconds,
+            initial_seconds=settings.window_initial_seconds)
+
+    return PushshiftAPI(
+        cloudwatch_logger=cloudwatch_logger,
+        pool_maxsize=pool_maxsize,
+        rate_limiter=rate_limiter,
+        passthrough=settings.pushshift_passthrough,
+        base_url=settings.pushshift_base_url,
+        metrics=metrics,
+        cache=cache,
+        fields=record_filter.api_fields(),
+        connect_timeout=settings.pushshift_connect_timeout,
+        read_timeout=settings.pushshift_read_timeout,
+        hedge_percentile=settings.pushshift_hedge_percentile,
+        incomplete_retries=settings.pushshift_incomplete_retries,
+        memory_budget=memory_budget,
+        decode_pool=decode_pool,
+        window_planner=window_planner,
+        startup=startup)
+
+
+def close_services(sinks:list, api:PushshiftAPI, metrics:Metrics):
+    """Send anything still buffered and stop background work"""
+    for sink in sinks:
+        sink.close()
+    metrics.close()
+    if api.cache is not None:
+        api.cache.close()
+    if api.decode_pool is not None:
+        api.decode_pool.close()
+
+
+def service_stats(api:PushshiftAPI, record_filter:RecordFilter) -> str:
+    """Stats of the filter, response cache and window planner"""
+    stats = [record_filter.stats()]
+    if api.cache is not None:
+        stats.append(api.cache.stats())
+    if api.window_planner is not None:
+        stats.append(api.window_planner.stats())
+    return ' '.join(stats)
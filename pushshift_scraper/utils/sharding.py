@@ -0,0 +1,320 @@
+# Crawl a long time range as several concurrent time windows (shards)
+
+import os
+import json
+import threading
+from datetime import datetime
+from functools import partial
+
+from utils.pushshift_api import NoResultsError
+
+# Reddit launched on 2005-06-23. Used as the lower bound when --after is not set.
+REDDIT_EPOCH = 1119484800
+
+
+class Shard:
+    """A time window crawled backwards from 'before' to 'after'.
+
+    Both bounds are exclusive, matching the Pushshift 'before' and 'after'
+    params. 'cursor' is the 'before' param of the next request.
+    """
+    def __init__(self, after:int, before:int, cursor:int=None, done:bool=False) -> None:
+        self.after = after
+        self.before = before
+        self.cursor = before if cursor is None else cursor
+        self.done = done
+        self.owner = None
+
+        # Posts already returned at second cursor - 1, which the next page overlaps
+        self.seen = None
+
+        # Progress that has been delivered to Firehose. This is what gets
+        # checkpointed, since buffered pages may not have been sent yet.
+        self.delivered_cursor = self.cursor
+        self.delivered_done = done
+
+    def remaining(self) -> int:
+        """Seconds of the window that have not been crawled yet"""
+        if self.done:
+            return 0
+        return max(self.cursor - self.after - 1, 0)
+
+    def to_dict(self) -> dict:
+        return {
+            'after': self.after,
+            'before': self.before,
+            'cursor': self.delivered_cursor,
+            'done': self.delivered_done
+        }
+
+    @classmethod
+    def from_dict(cls, d:dict):
+        return cls(after=d['after'], before=d['before'], cursor=d['cursor'], done=d['done'])
+
+
+class ShardedCrawler:
+    """Crawl [after, before] as N time windows in parallel.
+
+    All workers share one PushshiftAPI instance, so they share its rate limit
+    and connection pool. Each shard has its own cursor, and shard progress is
+    saved to a checkpoint file after every page so a restart resumes every
+    shard where it left off. When a worker finishes its shard and no shards
+    are pending, it splits the largest shard still being crawled.
+    """
+
+    def __init__(self, api, firehose, metadata_log, cloudwatch_logger, checkpoint_filename:str, num_workers:int=4, min_shard_seconds:int=3600) -> None:
+        self.api = api
+        self.firehose = firehose
+        self.metadata_log = metadata_log
+        self.cloudwatch = cloudwatch_logger
+        self.checkpoint_filename = checkpoint_filename
+        self.num_workers = num_workers
+        self.min_shard_seconds = min_shard_seconds
+
+        self.lock = threading.Lock()
+        self.shards = []
+        self.job = None
+        self.post_type = None
+        self.subreddits = None
+        self.error = None
+        self.stopped = False
+        self.last_result = None
+
+
+    def run(self, post_type:str, subreddits:list, before:int=None, after:int=None, size:int=100, num_shards:int=None, no_resume:bool=False, max_requests:int=None):
+        """Crawl all shards until Pushshift runs out of results in each of them.
+
+        Args:
+            post_type (str): Submissions or comments.
+            subreddits (list): List of subreddits to search.
+            before (int, optional): Max created_utc of posts to get (epoch timestamp). Defaults to now.
+            after (int, optional): Min created_utc of posts to get (epoch timestamp). Defaults to REDDIT_EPOCH.
+            size (int, optional): Number of results per page. Defaults to 100.
+            num_shards (int, optional): Number of windows to split the range into. Defaults to num_workers.
+            no_resume (bool, optional): Ignore an existing checkpoint file. Defaults to False.
+            max_requests (int, optional): Stop after this many requests. Defaults to None.
+
+        Returns:
+            PushshiftResponse: The last result written to the metadata log.
+        """
+        if num_shards is None:
+            num_shards = self.num_workers
+
+        # The checkpoint is for the job as it was asked for, so an open-ended
+        # crawl resumes on the next run and the order of subreddits doesn't matter
+        self.job = {
+            'post_type': post_type,
+            'subreddits': sorted(set(s.lower() for s in subreddits)),
+            'after': after,
+            'before': before
+        }
+        self.post_type = post_type
+        self.subreddits = subreddits
+        self.size = size
+        self.max_requests = max_requests
+
+        if no_resume or not self._load_checkpoint():
+            if before is None:
+                before = int(datetime.utcnow().timestamp()) + 1
+            if after is None:
+                after = REDDIT_EPOCH
+
+            # Only crawl time ranges that haven't been delivered already
+            gaps = [(after + 1, before - 1)]
+            if not no_resume:
+                gaps = self.metadata_log.uncovered(after + 1, before - 1)
+            self.shards = self._split_gaps(gaps, num_shards)
+            self._save_checkpoint()
+
+        pending = [shard for shard in self.shards if not shard.done]
+        self.cloudwatch.log(f"Crawling {len(pending)} of {len(self.shards)} shards with {self.num_workers} workers.")
+
+        workers = [threading.Thread(target=self._worker, name=f'shard-{i}', daemon=True) for i in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.last_result
+
+
+    def _split_gaps(self, gaps:list, num_shards:int) -> list:
+        """Split inclusive (lo, hi) gaps into about num_shards windows in proportion to their length"""
+        total = sum(hi - lo + 1 for lo, hi in gaps)
+        shards = []
+        for lo, hi in gaps:
+            n = max(1, round(num_shards * (hi - lo + 1) / total))
+            shards.extend(self._split_range(lo - 1, hi + 1, n))
+
+        return shards
+
+
+    def _split_range(self, after:int, before:int, num_shards:int) -> list:
+        """Split (after, before) into num_shards windows of equal length, newest first"""
+        width = max((before - after) // num_shards, 1)
+        shards = []
+        upper = before
+        while upper - 1 > after and len(shards) < num_shards:
+            lower = after if len(shards) == num_shards - 1 else max(upper - width - 1, after)
+            shards.append(Shard(after=lower, before=upper))
+            upper = lower + 1
+
+        return shards
+
+
+    def _next_shard(self, worker_name:str):
+        """Claim a pending shard, or split the largest shard being crawled"""
+        with self.lock:
+            if self.error is not None or self._max_requests_reached():
+                return None
+
+            for shard in self.shards:
+                if not shard.done and shard.owner is None:
+                    shard.owner = worker_name
+                    return shard
+
+            # Rebalance: take the older half of the largest shard still running
+            running = [shard for shard in self.shards if not shard.done and shard.owner is not None]
+            if not running:
+                return None
+            largest = max(running, key=lambda shard: shard.remaining())
+            if largest.remaining() < 2 * self.min_shard_seconds:
+                return None
+
+            mid = largest.after + largest.remaining() // 2
+            new_shard = Shard(after=largest.after, before=mid + 1)
+            new_shard.owner = worker_name
+            largest.after = mid
+            self.shards.append(new_shard)
+            self._save_checkpoint()
+            self.cloudwatch.log(f"Split shard ({largest.after}, {largest.cursor}) off ({new_shard.after}, {new_shard.before}).")
+
+            return new_shard
+
+
+    def _worker(self):
+        worker_name = threading.current_thread().name
+        try:
+            while True:
+                shard = self._next_shard(worker_name)
+                if shard is None:
+                    break
+                self._crawl_shard(shard)
+        except Exception as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+                    self.cloudwatch.log(f"ERROR: Shard worker {worker_name} stopped. Exception {e}")
+
+
+    def _crawl_shard(self, shard:Shard):
+        while not shard.done:
+            with self.lock:
+                if self.error is not None or self._max_requests_reached():
+                    shard.owner = None
+                    return
+                after = shard.after
+                before = shard.cursor
+                seen = shard.seen
+
+            try:
+                result = self.api.get(
+                    post_type=self.post_type,
+                    subreddits=self.subreddits,
+                    before=before,
+                    after=after,
+                    size=self.size,
+                    seen=seen)
+            except NoResultsError as e:
+                with self.lock:
+                    shard.done = True
+                # Mark the shard done once the pages before it are delivered.
+                # The rest of a shard that ended on an incomplete search isn't covered.
+                coverage = None if e.incomplete else (after + 1, before - 1)
+                self.firehose.send_result([], callback=partial(self._page_delivered, shard, shard.cursor, True, None, coverage))
+                break
+
+            # The shard may have been split while the request was in flight.
+            # Records below the new lower bound belong to another shard.
+            with self.lock:
+                after = shard.after
+                shard.cursor = result.min_created_at + 1
+                shard.seen = result.seen
+                if shard.remaining() == 0:
+                    shard.done = True
+                cursor = shard.cursor
+                done = shard.done
+            data = [record for record, created_utc in zip(result.data, result.created_utcs) if created_utc > after and record is not None]
+            result.release()
+            coverage = (max(result.min_created_at + 1, after + 1), before - 1)
+
+            self.firehose.send_result(data, callback=partial(self._page_delivered, shard, cursor, done, result, coverage))
+
+            # Record progress at regular intervals
+            self.api.log_progress()
+
+        shard.owner = None
+
+
+    def _page_delivered(self, shard:Shard, cursor:int, done:bool, result, coverage:tuple):
+        """Checkpoint a shard once Firehose has delivered its page"""
+        with self.lock:
+            if result is not None:
+                self.metadata_log.add_result_metadata(result, coverage=coverage)
+                self.last_result = result
+            elif coverage is not None:
+                self.metadata_log.add_coverage(*coverage)
+            shard.delivered_cursor = cursor
+            shard.delivered_done = done
+            self._save_checkpoint()
+
+
+    def _max_requests_reached(self) -> bool:
+        """Check if a test run should stop. Call while holding the lock."""
+        if not self.stopped and self.max_requests is not None and self.api.request_count >= self.max_requests:
+            self.cloudwatch.log("Stopping test.")
+            self.stopped = True
+        return self.stopped
+
+
+    def _load_checkpoint(self) -> bool:
+        """Load shards from the checkpoint file if it was written for the same job"""
+        if not os.path.exists(self.checkpoint_filename):
+            return False
+
+        with open(self.checkpoint_filename, 'r') as f:
+            checkpoint = json.load(f)
+
+        if checkpoint.get('job') != self.job:
+            self.cloudwatch.log(f"Shard checkpoint {self.checkpoint_filename} is for a different job. Starting new shards.")
+            return False
+
+        shards = [Shard.from_dict(d) for d in checkpoint['shards']]
+        if all(shard.done for shard in shards):
+            # Ranges of incomplete pages were left out of the coverage, so plan new shards from its gaps
+            self.cloudwatch.log(f"All shards in {self.checkpoint_filename} are done. Starting new shards from the gaps in coverage.")
+            return False
+
+        self.shards = shards
+        self.cloudwatch.log(f"Resuming shards from {self.checkpoint_filename}.")
+
+        return True
+
+
+    def _save_checkpoint(self):
+        """Write shard cursors to the checkpoint file. Call while holding the lock."""
+        checkpoint = {
+            'job': self.job,
+            'shards': [shard.to_dict() for shard in self.shards]
+        }
+
+        # Write to a temporary file and rename so the checkpoint is never half written
+        tmp_filename = f'{self.checkpoint_filename}.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_filename, self.checkpoint_filename)
+
+        return True
@@ -0,0 +1,264 @@
+# Write-ahead buffer between the crawler and Firehose. Pages are appended to
+# segment files on local disk and shipped to Firehose by a background worker,
+# so crawling can continue while Firehose is unavailable or throttling.
+
+import os
+import threading
+import time
+
+from utils.firehose import is_retryable
+
+SEALED_SUFFIX = '.ndjson'
+OPEN_SUFFIX = '.ndjson.open'
+QUARANTINE_DIRECTORY = 'quarantine'
+
+
+class Spool:
+    """Disk-backed spool with the same send_result interface as Firehose.
+
+    Posts are appended to an open NDJSON segment. Segments are sealed once
+    they reach segment_bytes or are max_latency seconds old, then a drain
+    worker sends them to Firehose and deletes them. Writes are fsynced in
+    batches, and a page's callback runs once the fsync covering it has
+    completed, so checkpoints only move forward for pages that are safe on
+    disk. When the spool holds more than max_bytes, send_result blocks until
+    the drain worker catches up.
+
+    Segments that fail with errors worth retrying are retried with backoff
+    until they're sent. Segments that can never be sent, e.g. with a post
+    larger than a Firehose record, are moved to the quarantine subdirectory
+    so they don't hold up the segments after them.
+    """
+
+    def __init__(self, firehose, cloudwatch_logger, directory:str, segment_bytes:int=8 * 1024 * 1024, max_bytes:int=1024 * 1024 * 1024, fsync_interval:float=1.0, max_latency:float=60.0) -> None:
+        self.firehose = firehose
+        self.cloudwatch = cloudwatch_logger
+        self.metrics = firehose.metrics
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.max_latency = max_latency
+
+        self.lock = threading.Condition()
+        self.closing = False
+
+        # Open segment
+        self.segment = None
+        self.segment_filename = None
+        self.segment_size = 0
+        self.segment_started = None
+        self.next_segment = 0
+
+        # Pages written since the last fsync
+        self.pending_callbacks = []
+        self.last_fsync = time.monotonic()
+
+        # Track stats
+        self.spooled_bytes = 0
+        self.pages_spooled = 0
+        self.segments_sent = 0
+        self.segments_quarantined = 0
+        self.drain_failures = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+
+        self.drain_thread = threading.Thread(target=self._drain, name='spool-drain', daemon=True)
+        self.drain_thread.start()
+
+
+    def send_result(self, data:list, callback=None):
+        """Append Pushshift results to the spool
+
+        Args:
+            data (list): A list of records
+            callback (callable, optional): Called without arguments once the
+                records have been fsynced to the spool. Defaults to None.
+
+        Returns:
+            bool: Returns True if successful
+        """
+        lines = self.firehose.serialize(data)
+        page = b''.join(lines)
+
+        with self.lock:
+            # Backpressure: wait for the drain worker to free up space
+            if self.spooled_bytes + len(page) > self.max_bytes and self.spooled_bytes > 0:
+                self.cloudwatch.log(f"WARNING: Spool {self.directory} is full ({self.spooled_bytes} bytes). Waiting for Firehose.")
+                self._seal_segment()
+                with self.metrics.timer('spool_full_wait'):
+                    while self.spooled_bytes + len(page) > self.max_bytes and self.spooled_bytes > 0:
+                        self.lock.wait(timeout=1)
+
+            if page:
+                if self.segment is None:
+                    self._open_segment()
+                self.segment.write(page)
+                self.segment_size += len(page)
+                self.spooled_bytes += len(page)
+
+            self.pages_spooled += 1
+            if callback is not None:
+                self.pending_callbacks.append(callback)
+
+            if time.monotonic() - self.last_fsync >= self.fsync_interval:
+                self._fsync()
+
+            if self.segment_size >= self.segment_bytes:
+                self._seal_segment()
+
+        return True
+
+
+    def flush(self):
+        """Fsync the open segment and run callbacks for pages written to it"""
+        with self.lock:
+            self._fsync()
+
+        return True
+
+
+    def close(self):
+        """Seal the open segment and send everything left in the spool.
+        Segments that can't be sent stay on disk for the next run."""
+        with self.lock:
+            self._seal_segment()
+            self.closing = True
+            self.lock.notify_all()
+
+        self.drain_thread.join()
+        self.firehose.close()
+
+        remaining = self._sealed_segments()
+        if remaining:
+            self.cloudwatch.log(f"WARNING: {len(remaining)} spool segments in {self.directory} were not sent to Firehose. They will be sent on the next run.")
+
+
+    def stats(self) -> str:
+        return (f"Spooled {self.pages_spooled} pages. Sent {self.segments_sent} segments. "
+                f"Drain failures: {self.drain_failures}. Quarantined {self.segments_quarantined} segments. {self.firehose.stats()}")
+
+
+    def _recover(self):
+        """Seal segments left open by a previous run, dropping any partial last line"""
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(OPEN_SUFFIX):
+                with open(path, 'rb+') as f:
+                    data = f.read()
+                    f.truncate(data.rfind(b'\n') + 1)
+                os.replace(path, path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+
+        sealed = self._sealed_segments()
+        for path in sealed:
+            self.spooled_bytes += os.path.getsize(path)
+        if sealed:
+            self.next_segment = self._segment_number(sealed[-1]) + 1
+            self.cloudwatch.log(f"Found {len(sealed)} unsent segments ({self.spooled_bytes} bytes) in spool {self.directory}.")
+
+
+    def _open_segment(self):
+        self.segment_filename = os.path.join(self.directory, f'{self.next_segment:012d}{OPEN_SUFFIX}')
+        self.segment = open(self.segment_filename, 'ab')
+        self.segment_size = 0
+        self.segment_started = time.monotonic()
+        self.next_segment += 1
+
+
+    def _fsync(self):
+        """Make written pages durable and run their callbacks. Call while holding the lock."""
+        if self.segment is not None:
+            with self.metrics.timer('spool_fsync'):
+                self.segment.flush()
+                os.fsync(self.segment.fileno())
+        self.last_fsync = time.monotonic()
+
+        callbacks = self.pending_callbacks
+        self.pending_callbacks = []
+        for callback in callbacks:
+            callback()
+
+
+    def _seal_segment(self):
+        """Close the open segment and hand it to the drain worker. Call while holding the lock."""
+        self._fsync()
+        if self.segment is None:
+            return
+
+        self.segment.close()
+        os.replace(self.segment_filename, self.segment_filename[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        self.segment = None
+        self.segment_filename = None
+        self.segment_started = None
+        self.lock.notify_all()
+
+
+    def _sealed_segments(self) -> list:
+        filenames = sorted(f for f in os.listdir(self.directory) if f.endswith(SEALED_SUFFIX))
+        return [os.path.join(self.directory, f) for f in filenames]
+
+
+    def _segment_number(self, path:str) -> int:
+        return int(os.path.basename(path)[:-len(SEALED_SUFFIX)])
+
+
+    def _drain(self):
+        """Send sealed segments to Firehose in order and delete them once sent"""
+        failures = 0
+        while True:
+            with self.lock:
+                # Fsync and seal by time so callbacks and Firehose aren't held up on a quiet crawl
+                if self.pending_callbacks and time.monotonic() - self.last_fsync >= self.fsync_interval:
+                    self._fsync()
+                if self.segment_started is not None and time.monotonic() - self.segment_started >= self.max_latency:
+                    self._seal_segment()
+
+                segments = self._sealed_segments()
+                if not segments:
+                    if self.closing:
+                        return
+                    self.lock.wait(timeout=min(1.0, self.fsync_interval))
+                    continue
+
+            for path in segments:
+                with open(path, 'rb') as f:
+                    lines = f.read().splitlines(keepends=True)
+                size = sum(len(line) for line in lines)
+
+                try:
+                    self.firehose.send_lines(lines)
+                except Exception as e:
+                    if not is_retryable(e):
+                        self._quarantine(path, size, e)
+                        continue
+                    failures += 1
+                    self.drain_failures += 1
+                    self.cloudwatch.log(f"WARNING: Failed to send spool segment {path} to Firehose. Crawling continues. Exception {e}")
+                    # Wait longer after each consecutive failure, up to 5 minutes.
+                    # Closing wakes the worker for one last attempt.
+                    with self.lock:
+                        if self.closing:
+                            return
+                        self.lock.wait(timeout=min(300, 2 ** failures))
+                    break
+
+                failures = 0
+                os.remove(path)
+                with self.lock:
+                    self.spooled_bytes -= size
+                    self.segments_sent += 1
+                    self.lock.notify_all()
+
+
+    def _quarantine(self, path:str, size:int, e:Exception):
+        """Move a segment that can't be sent out of the way of the drain worker"""
+        quarantine = os.path.join(self.directory, QUARANTINE_DIRECTORY)
+        os.makedirs(quarantine, exist_ok=True)
+        os.replace(path, os.path.join(quarantine, os.path.basename(path)))
+        self.cloudwatch.log(f"ERROR: Spool segment {path} can't be sent to Firehose and was moved to {quarantine}. Exception {e}")
+        self.metrics.count('spool_quarantined')
+        with self.lock:
+            self.spooled_bytes -= size
+            self.segments_quarantined += 1
+            self.lock.notify_all()
@@ -0,0 +1,49 @@
+# Time how long startup takes, up to the first page of posts from Pushshift
+
+import threading
+import time
+
+from utils.metrics import Metrics
+
+
+class StartupTimer:
+    """Durations of the phases of startup and the time to the first page.
+
+    Create it first thing and call phase() at the end of each phase of
+    startup. PushshiftAPI calls first_page() when the first page arrives,
+    which logs how long each phase took and reports them as startup_<phase>
+    stages in the metrics.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.last = self.started
+        self.phases = []
+        self.first_page_seconds = None
+        self.lock = threading.Lock()
+
+
+    def phase(self, name:str):
+        """Record the end of a phase of startup"""
+        now = time.monotonic()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+
+    def first_page(self, cloudwatch_logger, metrics:Metrics):
+        """Record that the first page has arrived and report the timings. Only the first call counts."""
+        with self.lock:
+            if self.first_page_seconds is not None:
+                return
+            self.first_page_seconds = time.monotonic() - self.started
+
+        for name, seconds in self.phases:
+            metrics.observe(f'startup_{name}', seconds)
+        metrics.observe('time_to_first_page', self.first_page_seconds)
+        cloudwatch_logger.log(self.stats())
+
+
+    def stats(self) -> str:
+        phases = ', '.join(f'{name} {round(seconds, 3)}s' for name, seconds in self.phases)
+        first_page = 'not yet' if self.first_page_seconds is None else f'after {round(self.first_page_seconds, 3)}s'
+        return f"Startup: {phases}. First page {first_page}."